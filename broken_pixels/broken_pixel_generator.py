@@ -7,6 +7,7 @@ from pathlib import Path
 import asyncio
 from concurrent.futures import ThreadPoolExecutor
 import numpy as np
+from data_processing.output_profile import apply_output_profile
 
 # Настройка логирования
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -50,7 +51,7 @@ def process_image(image_path, output_dir, relative_path, min_broken_pixels, max_
                     [f"{original_file_name}_broken_pixels.tif", f"{original_file_name}.tif", row, col, channel, broken_value,
                      original_value])
 
-            meta = src.meta  # Метаданные изображения
+            meta = apply_output_profile(src.meta)  # Метаданные изображения с параметрами профиля записи
 
             output_file_path = output_dir / relative_path.with_name(
                 f"{original_file_name}_broken_pixels.tif")  # Путь для сохранения обработанного изображения
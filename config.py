@@ -9,10 +9,29 @@ class FAISSConfig:
     path_to_block_index: str = f'{path_to_index}/block'  # Путь до папки, содержищей блоки индекса
     name_index: str = 'faiss_index.index'  # Название файла, содержащего индекс
     trained_index: str = 'trained_index.index'  # Название файла, содержащего индекс для тренировки
+    name_next_id: str = 'faiss_index_next_id.json'  # Название файла со следующим свободным идентификатором индекса
+    name_ivfdata: str = 'faiss_index.ivfdata'  # Название файла с инвертированными списками индекса на диске
 
     vector_dim: int = int(os.getenv('VECTOR_DIM'))  # Размер вектора
     num_clusters: int = int(os.getenv('NUM_CLUSTERS'))  # Количество векторов
     block_size: int = 1024  # Количество векторов в одном блоке
+    index_block_rows: int = int(os.getenv('INDEX_BLOCK_ROWS', 1000000))  # Количество векторов в одном блоке индекса
+    num_block_workers: int = int(os.getenv('NUM_BLOCK_WORKERS', 0))  # Процессы построения блоков индекса (0 - без блоков)
+    ondisk_index: bool = os.getenv('ONDISK_INDEX', 'False') == 'True'  # True если хранить инвертированные списки на диске
+    mmap_index: bool = os.getenv('MMAP_INDEX', 'False') == 'True'  # True если загружать индекс через mmap (только чтение)
+    # Строка фабрики индекса FAISS (например: IVF{num_clusters},PQ64, OPQ64,IVF{num_clusters},PQ64, IVF{num_clusters},SQ8, HNSW32)
+    index_factory: str = os.getenv('INDEX_FACTORY', 'IVF{num_clusters},PQ64')
+    name_search_params: str = 'search_params.json'  # Название файла с Парето-оптимальными параметрами поиска
+    target_recall: float = float(os.getenv('TARGET_RECALL', 0.9))  # Требуемая полнота при выборе параметров поиска
+    search_chunk_size: int = 16384  # Количество запросов, обрабатываемых за раз при поиске
+    refine_store: str = os.getenv('REFINE_STORE', '')  # Хранилище векторов для переранжирования: fp16, int8 ('' - нет)
+    name_refine_store: str = 'refine_vectors'  # Название файлов хранилища переранжирования (.npy и .json)
+    refine_factor: int = int(os.getenv('REFINE_FACTOR', 4))  # Во сколько раз больше кандидатов искать для переранжирования
+    name_id_filter: str = 'id_filter'  # Каталог с данными плиток для фильтрации поиска по подложке и разрешению
+    max_filter_ranges: int = 32  # Максимальное количество диапазонов faiss_id, которые ищутся по отдельности
+    train_sample_size: int = int(os.getenv('TRAIN_SAMPLE_SIZE', 100000))  # Размер выборки для обучения индекса
+    # Количество векторов, после извлечения которых индекс обучается не дожидаясь окончания (0 - после извлечения)
+    train_after_vectors: int = int(os.getenv('TRAIN_AFTER_VECTORS', 0))
 
     overwriting_indexes = False  # True если удалять ранее созданный индекс
 
@@ -30,9 +49,31 @@ class ExtractingFeaturesConfig:
                                 'crop_80x50', 'crop_80x60', 'crop_80x70', 'crop_80x80']
     use_hog: bool = False
     block_size: int = 512  # Количество элементов layout, которые будет отправляться за раз на сервер
+    upload_max_in_flight: int = int(os.getenv('UPLOAD_MAX_IN_FLIGHT', 4))  # Максимум одновременных запросов отправки на сервер
+    upload_gzip: bool = os.getenv('UPLOAD_GZIP', 'False') == 'True'  # True если сжимать тело запроса gzip
+    path_to_upload_outbox: str = '/data/upload_outbox.jsonl'  # Журнал отправки: блоки faiss_id, не подтвержденные сервером
+    upload_checkpoint_rows: int = int(os.getenv('UPLOAD_CHECKPOINT_ROWS', 262144))  # Через сколько добавленных векторов сохранять индекс вместе с журналом отправки
+    batch_size: int = int(os.getenv('BATCH_SIZE', 32))  # Количество плиток в одном прямом проходе модели
+    num_loader_workers: int = 4  # Количество фоновых потоков чтения плиток
+    prefetch_batches: int = 2  # Количество пакетов плиток, читаемых заранее, пока модель занята
+    inference_backend: str = os.getenv('INFERENCE_BACKEND', 'eager')  # Бэкенд инференса: eager, torchscript, onnx
+    # Динамическое int8 квантование: для eager и torchscript квантуется только полносвязная голова (свертки остаются float32),
+    # для onnx - свертки и матричные умножения
+    quantize_int8: bool = os.getenv('QUANTIZE_INT8', 'False') == 'True'
+    num_intra_threads: int = int(os.getenv('NUM_INTRA_THREADS', 0))  # Потоки внутри операции (0 - по умолчанию)
+    num_inter_threads: int = int(os.getenv('NUM_INTER_THREADS', 0))  # Потоки между операциями (0 - по умолчанию)
+    path_to_exported_model: str = '/weights/embedding_net'  # Путь (без расширения) для экспортированной модели
     load_prepared_vectors: bool = True
-    path_to_prepared_vectors: str = '/data/prepared_vectors.npy'
-    path_to_prepared_vectors_data: str = '/data/prepared_vectors_data.json'
+    path_to_prepared_vectors: str = '/data/prepared_vectors.npy'  # float32, дописывается порциями через memmap
+    prepared_vectors_chunk_rows: int = 65536  # Количество строк, на которое увеличивается файл векторов
+    path_to_prepared_vectors_data: str = '/data/prepared_vectors_data'  # Колоночное хранилище данных векторов
+    path_to_prepared_vectors_data_json: str = '/data/prepared_vectors_data.json'  # Данные векторов в старом формате
+    path_to_prepared_manifest: str = '/data/prepared_vectors_manifest.json'  # Размер и время изменения обработанных плиток
+    incremental_update: bool = False  # True если извлекать признаки только новых и измененных плиток
+    path_to_shards: str = '/data/shards'  # Путь до каталога с результатами шардов извлечения признаков
+    shard_by: str = 'hash'  # Разбиение плиток на шарды: hash - по хешу пути, folder - по папкам разрешений
+    dedup_threshold: float = float(os.getenv('DEDUP_THRESHOLD', 0))  # Косинусное сходство перекрывающихся плиток-дубликатов (0 - не искать)
+    dedup_min_overlap: float = 0.5  # Минимальная доля площади плитки, перекрытая ее дубликатом
     name_model: str = os.getenv("NAME_MODEL")
 
 
@@ -4,6 +4,7 @@ from rasterio.windows import Window
 import numpy as np
 import os
 import logging
+from data_processing.output_profile import apply_output_profile
 
 logger = logging.getLogger(__name__)
 
@@ -42,13 +43,14 @@ def split_image(input_path, output_dir, tile_size):
 
                 # output_path = f"{output_prefix}_{i}_{j}.tiff"
                 output_path = os.path.join(output_dir, f'tile_{i}_{j}.tiff')
-                with rasterio.open(output_path, 'w', driver='GTiff',
-                                   height=window.height,
-                                   width=window.width,
-                                   count=src.count,
-                                   dtype=src.dtypes[0],
-                                   crs=src.crs,
-                                   transform=transform_window) as dst:
+                meta = apply_output_profile({'driver': 'GTiff',
+                                             'height': window.height,
+                                             'width': window.width,
+                                             'count': src.count,
+                                             'dtype': src.dtypes[0],
+                                             'crs': src.crs,
+                                             'transform': transform_window})
+                with rasterio.open(output_path, 'w', **meta) as dst:
                     dst.write(tile)
 
 
@@ -4,10 +4,14 @@ import rasterio
 from rasterio.windows import Window
 from concurrent.futures import ThreadPoolExecutor
 import logging
+from output_profile import apply_output_profile, get_output_profile_from_env
+from stage_cache import StageCache, prepare_output_path
 
 # Настраиваем логирование
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
+CROP_SIZE = 256  # Размер обрезка (пиксели)
+
 def crop_image_sync(input_path_layout, output_base_dir, step_multiplier):
     """
     Обрезает растровое изображение на основе заданного размера и шага.
@@ -26,13 +30,15 @@ def crop_image_sync(input_path_layout, output_base_dir, step_multiplier):
 
     Возвращает:
     -----------
-    None
+    list of str
+        Пути к сохраненным обрезкам.
     """
+    output_paths = []
     with rasterio.open(input_path_layout) as dataset:
         filename = os.path.basename(input_path_layout)
         base_name = os.path.splitext(filename)[0]
         pixel_size_x, pixel_size_y = dataset.res
-        crop_size = 256
+        crop_size = CROP_SIZE
         step_size = int(crop_size * step_multiplier)  # Вычисляем шаг обрезки на основе множителя
         output_dir = os.path.join(output_base_dir, f'crop_{int(pixel_size_x)}x{int(pixel_size_y)}', f'{base_name}_crop')
         os.makedirs(output_dir, exist_ok=True)
@@ -48,7 +54,7 @@ def crop_image_sync(input_path_layout, output_base_dir, step_multiplier):
                 transform = dataset.window_transform(window)
                 output_path = os.path.join(
                     output_dir,
-                    f'{base_name}_crop_256x256_{i}_{j}.tif'
+                    f'{base_name}_crop_{crop_size}x{crop_size}_{i}_{j}.tif'
                 )
                 data = dataset.read(window=window)
                 meta = dataset.meta.copy()
@@ -58,15 +64,31 @@ def crop_image_sync(input_path_layout, output_base_dir, step_multiplier):
                     'width': crop_size,
                     'transform': transform
                 })
+                meta = apply_output_profile(meta)
+                prepare_output_path(output_path)
                 with rasterio.open(output_path, 'w', **meta) as dest:
                     dest.write(data)
+                output_paths.append(output_path)
                 logging.info(f'Cropped image saved to {output_path}')  # Логируем сохранение обрезанного изображения
+    return output_paths
 
-async def crop_image(input_path_layout, output_base_dir, step_multiplier, executor):
+def crop_image_cached_sync(input_path_layout, output_base_dir, step_multiplier, cache):
+    """
+    Обрезает растровое изображение, если изображение или параметры обрезки изменились с прошлого запуска.
+    """
+    params = {'crop_size': CROP_SIZE, 'step_multiplier': step_multiplier, 'profile': get_output_profile_from_env()}
+    cache.run(input_path_layout, input_path_layout, params,
+              lambda: crop_image_sync(input_path_layout, output_base_dir, step_multiplier))
+
+async def crop_image(input_path_layout, output_base_dir, step_multiplier, executor, cache=None):
     loop = asyncio.get_event_loop()
-    await loop.run_in_executor(executor, crop_image_sync, input_path_layout, output_base_dir, step_multiplier)
+    if cache is None:
+        await loop.run_in_executor(executor, crop_image_sync, input_path_layout, output_base_dir, step_multiplier)
+    else:
+        await loop.run_in_executor(executor, crop_image_cached_sync, input_path_layout, output_base_dir,
+                                   step_multiplier, cache)
 
-async def process_directory(input_dir, output_base_dir, step_multiplier, executor):
+async def process_directory(input_dir, output_base_dir, step_multiplier, executor, cache=None):
     """
     Обрабатывает все растровые изображения в указанной директории.
 
@@ -83,6 +105,8 @@ async def process_directory(input_dir, output_base_dir, step_multiplier, executo
         Множитель для шага обрезки изображения.
     executor : concurrent.futures.Executor
         Экзекутор для выполнения асинхронных задач.
+    cache : StageCache
+        Кэш этапа. Если задан, изображения, которые не изменились с прошлого запуска, не обрабатываются.
 
     Возвращает:
     -----------
@@ -93,7 +117,7 @@ async def process_directory(input_dir, output_base_dir, step_multiplier, executo
         for file in files:
             if file.endswith('.tif'):
                 input_path = os.path.join(root, file)
-                tasks.append(crop_image(input_path, output_base_dir, step_multiplier, executor))
+                tasks.append(crop_image(input_path, output_base_dir, step_multiplier, executor, cache))
                 logging.info(f'Started processing {input_path}')  # Логируем начало обработки файла
     await asyncio.gather(*tasks)
     logging.info(f"Processing completed for all files in {input_dir}")  # Логируем завершение обработки директории
@@ -117,8 +141,24 @@ if __name__ == "__main__":
     STEP_MULTIPLIER = float(os.getenv("STEP_MULTIPLIER"))
     logging.info(f"step multiplier: {STEP_MULTIPLIER}")
 
+    # Кэш этапа: content - по хэшу содержимого входного файла, stat - по размеру и времени изменения, off - без кэша
+    STAGE_CACHE = os.getenv("STAGE_CACHE", "content")
+    # Каталог кэша: на той же файловой системе, что и выходные файлы, но вне OUTPUT_BASE_DIR,
+    # каталоги которого читаются как каталоги плиток crop_NxM
+    STAGE_CACHE_DIR = os.getenv("STAGE_CACHE_DIR", "/data/.stage_cache")
+    logging.info(f"Stage cache: {STAGE_CACHE}, directory: {STAGE_CACHE_DIR}")
+    cache = None
+    if STAGE_CACHE != "off":
+        output_base_dir = os.path.join(os.path.abspath(OUTPUT_BASE_DIR), '')
+        if os.path.abspath(STAGE_CACHE_DIR).startswith(output_base_dir):
+            raise ValueError(f"STAGE_CACHE_DIR ({STAGE_CACHE_DIR}) must be outside OUTPUT_BASE_DIR ({OUTPUT_BASE_DIR})")
+        cache = StageCache(STAGE_CACHE_DIR, 'crop_layout', STAGE_CACHE)
+
     # Создаем экзекутор с количеством рабочих потоков, равным количеству ядер процессора
     executor = ThreadPoolExecutor(max_workers=os.cpu_count())
 
     # Запускаем асинхронную обработку директории
-    asyncio.run(process_directory(INPUT_PATH_ROOT_DATASET, OUTPUT_BASE_DIR, STEP_MULTIPLIER, executor))
+    asyncio.run(process_directory(INPUT_PATH_ROOT_DATASET, OUTPUT_BASE_DIR, STEP_MULTIPLIER, executor, cache))
+
+    if cache is not None:
+        cache.save()
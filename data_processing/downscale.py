@@ -1,15 +1,61 @@
 import os
 import asyncio
-from concurrent.futures import ThreadPoolExecutor
+import math
+import warnings
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from multiprocessing import shared_memory
+import numpy as np
 import rasterio
+from rasterio.dtypes import dtype_rev, typename_fwd
 from rasterio.enums import Resampling
+from rasterio.errors import NotGeoreferencedWarning
 from rasterio.transform import Affine
+from rasterio.windows import Window
 import logging
+from output_profile import apply_output_profile, get_output_profile_from_env
+from stage_cache import StageCache, prepare_output_path
 
 # Настраиваем логирование
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
 
+def get_downscale_meta(meta, new_pixel_size):
+    """
+    Вычисляет метаданные изображения с новым размером пикселя.
+
+    Параметры:
+    ----------
+    meta : dict
+        Метаданные исходного растрового изображения.
+    new_pixel_size : tuple
+        Новый размер пикселя в формате (ширина, высота).
+
+    Возвращает:
+    -----------
+    dict
+        Метаданные нового изображения с параметрами профиля записи (см. `output_profile`).
+    """
+    transform = meta['transform']
+    # Создаем новую аффинную трансформацию с учетом нового размера пикселя
+    new_transform = Affine(new_pixel_size[0], 0, transform.c,
+                           0, -new_pixel_size[1], transform.f)
+
+    # Вычисляем новые размеры изображения
+    new_width = int(meta['width'] * (transform.a / new_pixel_size[0]))
+    new_height = int(meta['height'] * (-transform.e / new_pixel_size[1]))
+
+    # Обновляем метаданные для нового изображения
+    new_meta = meta.copy()
+    new_meta.update({
+        'transform': new_transform,
+        'width': new_width,
+        'height': new_height,
+        'driver': 'GTiff',
+        'crs': meta['crs']
+    })
+    return apply_output_profile(new_meta)
+
+
 def save_raster_with_new_pixel_size_sync(input_path, output_path, new_pixel_size):
     """
     Сохраняет растровое изображение с новым размером пикселя.
@@ -31,47 +77,396 @@ def save_raster_with_new_pixel_size_sync(input_path, output_path, new_pixel_size
     None
     """
     with rasterio.open(input_path) as dataset:
-        # Создаем новую аффинную трансформацию с учетом нового размера пикселя
-        new_transform = Affine(new_pixel_size[0], 0, dataset.transform.c,
-                               0, -new_pixel_size[1], dataset.transform.f)
-
-        # Вычисляем новые размеры изображения
-        new_width = int(dataset.width * (dataset.transform.a / new_pixel_size[0]))
-        new_height = int(dataset.height * (-dataset.transform.e / new_pixel_size[1]))
-
-        # Обновляем метаданные для нового изображения
-        new_meta = dataset.meta.copy()
-        new_meta.update({
-            'transform': new_transform,
-            'width': new_width,
-            'height': new_height,
-            'driver': 'GTiff',
-            'crs': dataset.crs
-        })
+        new_meta = get_downscale_meta(dataset.meta, new_pixel_size)
 
         # Считываем данные с измененным размером пикселей
         data = dataset.read(
             out_shape=(
                 dataset.count,
-                new_height,
-                new_width
+                new_meta['height'],
+                new_meta['width']
             ),
             resampling=Resampling.bilinear
         )
 
         # Сохраняем данные в новый файл с обновленными метаданными
+        prepare_output_path(output_path)
         with rasterio.open(output_path, 'w', **new_meta) as dest:
             dest.write(data)
 
     logging.info(f"Saved raster with new pixel size to {output_path}")
 
 
-async def save_raster_with_new_pixel_size(input_path, output_path, new_pixel_size, executor):
+def get_window_height(meta, new_meta, window_bytes):
+    """
+    Вычисляет высоту окна (в строках выходного изображения), при которой чтение и передискретизация окна
+    укладываются в `window_bytes` байт.
+
+    На одну строку выходного изображения приходится сама строка и соответствующие ей строки исходного изображения,
+    запас в 2 раза оставлен на промежуточные буферы GDAL. Если выходное изображение разбито на блоки, окно содержит
+    целое число строк блоков, но не меньше одной.
+    """
+    itemsize = np.dtype(meta['dtype']).itemsize
+    rows_per_output_row = math.ceil(meta['height'] / max(new_meta['height'], 1)) + 1
+    row_bytes = 2 * meta['count'] * itemsize * (new_meta['width'] + meta['width'] * rows_per_output_row)
+    window_height = max(1, min(new_meta['height'], window_bytes // row_bytes))
+    if new_meta.get('tiled'):
+        # Окна выравниваются по строкам блоков, иначе сжатый блок записывался бы несколько раз
+        window_height = max(1, window_height // new_meta['blockysize']) * new_meta['blockysize']
+    return window_height
+
+
+def save_raster_with_new_pixel_size_windowed_sync(input_path, output_path, new_pixel_size, window_bytes):
+    """
+    Сохраняет растровое изображение с новым размером пикселя, обрабатывая его окнами ограниченного размера.
+
+    Выходное изображение строится полосами строк: для каждой полосы читается соответствующая ей часть исходного
+    изображения (окно с дробными границами), передискретизируется и сразу записывается. Поэтому потребление памяти
+    зависит от размера окна, а не от размера снимка, а результат совпадает с `save_raster_with_new_pixel_size_sync`.
+
+    Параметры:
+    ----------
+    input_path : str
+        Путь к входному растровому файлу.
+    output_path : str
+        Путь к выходному растровому файлу.
+    new_pixel_size : tuple
+        Новый размер пикселя в формате (ширина, высота).
+    window_bytes : int
+        Ограничение памяти на обработку одного окна (байт).
+
+    Возвращает:
+    -----------
+    None
+    """
+    with rasterio.open(input_path) as dataset:
+        new_meta = get_downscale_meta(dataset.meta, new_pixel_size)
+        window_height = get_window_height(dataset.meta, new_meta, window_bytes)
+        # Количество строк исходного изображения на одну строку выходного
+        scale_y = dataset.height / new_meta['height'] if new_meta['height'] else 0
+
+        prepare_output_path(output_path)
+        with rasterio.open(output_path, 'w', **new_meta) as dest:
+            for row_start in range(0, new_meta['height'], window_height):
+                row_end = min(new_meta['height'], row_start + window_height)
+                src_window = Window(0, row_start * scale_y, dataset.width, (row_end - row_start) * scale_y)
+                data = dataset.read(
+                    window=src_window,
+                    out_shape=(dataset.count, row_end - row_start, new_meta['width']),
+                    resampling=Resampling.bilinear
+                )
+                dest.write(data, window=Window(0, row_start, new_meta['width'], row_end - row_start))
+
+    logging.info(f"Saved raster with new pixel size to {output_path}")
+
+
+async def save_raster_with_new_pixel_size(input_path, output_path, new_pixel_size, executor, window_bytes=None,
+                                         cache=None, cache_key=None):
     loop = asyncio.get_event_loop()
-    await loop.run_in_executor(executor, save_raster_with_new_pixel_size_sync, input_path, output_path, new_pixel_size)
+    if window_bytes is None:
+        await loop.run_in_executor(executor, save_raster_with_new_pixel_size_sync,
+                                   input_path, output_path, new_pixel_size)
+    else:
+        await loop.run_in_executor(executor, save_raster_with_new_pixel_size_windowed_sync,
+                                   input_path, output_path, new_pixel_size, window_bytes)
+    if cache is not None:
+        await loop.run_in_executor(executor, cache.commit, output_path, cache_key, [output_path])
+
+
+def copy_original(input_path, original_output_path, window_bytes=None, cache=None):
+    """
+    Копирует оригинальный растровый файл в поддиректорию 'original', перезаписывая его через профиль записи.
+
+    Параметры:
+    ----------
+    input_path : str
+        Путь к входному растровому файлу.
+    original_output_path : str
+        Путь к копии.
+    window_bytes : int
+        Ограничение памяти на обработку одного окна (байт). Если задано, изображение перезаписывается полосами строк,
+        иначе читается в память целиком. Результат в обоих случаях одинаковый.
+    cache : StageCache
+        Кэш этапа. Если задан, неизмененный оригинал повторно не копируется.
+
+    Возвращает:
+    -----------
+    None
+    """
+    key = get_cached_original_key(cache, input_path, original_output_path)
+    if cache is not None and key is None:
+        return
+
+    prepare_output_path(original_output_path)
+    with rasterio.open(input_path) as src:
+        meta = apply_output_profile(src.meta)
+        with rasterio.open(original_output_path, 'w', **meta) as dest:
+            if window_bytes is None:
+                dest.write(src.read())
+            else:
+                window_height = get_window_height(src.meta, meta, window_bytes)
+                for row_start in range(0, src.height, window_height):
+                    window = Window(0, row_start, src.width, min(window_height, src.height - row_start))
+                    dest.write(src.read(window=window), window=window)
+    logging.info(f"Copied original raster to {original_output_path}")
+
+    if cache is not None:
+        cache.commit(original_output_path, key, [original_output_path])
+
+
+def get_cached_original_key(cache, input_path, original_output_path):
+    """
+    Вычисляет ключ задачи копирования оригинала.
+
+    Возвращает:
+    -----------
+    str
+        Ключ задачи или None, если кэш не задан или задача уже выполнена и ее можно пропустить.
+    """
+    if cache is None:
+        return None
+    key = cache.get_key(input_path, {'output': 'original', 'profile': get_output_profile_from_env()})
+    if cache.restore(original_output_path, key):
+        logging.info(f"Skipped unchanged {original_output_path}")
+        return None
+    return key
+
+
+def get_cached_key(cache, input_path, output_path, res):
+    """
+    Вычисляет ключ задачи построения разрешения `res`.
+
+    Возвращает:
+    -----------
+    str
+        Ключ задачи или None, если кэш не задан или задача уже выполнена и ее можно пропустить.
+    """
+    if cache is None:
+        return None
+    key = cache.get_key(input_path, {'resolution': list(res), 'profile': get_output_profile_from_env()})
+    if cache.restore(output_path, key):
+        logging.info(f"Skipped unchanged {output_path}")
+        return None
+    return key
 
 
-async def downscale(input_dir, output_dir, resolutions, executor):
+def get_tif_files(input_dir):
+    """
+    Возвращает пути ко всем файлам с расширением '.tif' в указанной директории и ее поддиректориях.
+    """
+    tif_files = []
+    for root, _, files in os.walk(input_dir):
+        for file in files:
+            if file.endswith('.tif'):
+                tif_files.append(os.path.join(root, file))
+    return tif_files
+
+
+def get_downscale_output_path(output_dir, base_name, res):
+    downscale_dir = os.path.join(output_dir, 'downscale', f'{base_name}_downscale')
+    os.makedirs(downscale_dir, exist_ok=True)
+    return os.path.join(downscale_dir, f'{base_name}_downscale_{res[0]}x{res[1]}.tif')
+
+
+def save_pyramid_level_sync(shm_name, shape, src_meta, output_path, new_pixel_size):
+    """
+    Сохраняет растровое изображение с новым размером пикселя из уже декодированного исходного изображения.
+
+    Исходное изображение находится в разделяемой памяти и открывается как набор данных GDAL MEM без копирования,
+    поэтому передискретизация выполняется тем же чтением `read(out_shape=...)`, что и в
+    `save_raster_with_new_pixel_size_sync`, и результат совпадает с ним побайтно.
+
+    Параметры:
+    ----------
+    shm_name : str
+        Имя блока разделяемой памяти с исходным изображением.
+    shape : tuple
+        Размер исходного изображения (каналы, высота, ширина).
+    src_meta : dict
+        Метаданные исходного изображения.
+    output_path : str
+        Путь к выходному растровому файлу.
+    new_pixel_size : tuple
+        Новый размер пикселя в формате (ширина, высота).
+
+    Возвращает:
+    -----------
+    None
+    """
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        source = np.ndarray(shape, dtype=src_meta['dtype'], buffer=shm.buf)
+        count, height, width = shape
+        itemsize = source.dtype.itemsize
+        mem_path = (f"MEM:::DATAPOINTER={source.ctypes.data},PIXELS={width},LINES={height},BANDS={count},"
+                    f"DATATYPE={typename_fwd[dtype_rev[source.dtype.name]]},PIXELOFFSET={itemsize},"
+                    f"LINEOFFSET={width * itemsize},BANDOFFSET={width * height * itemsize}")
+        new_meta = get_downscale_meta(src_meta, new_pixel_size)
+
+        # Открытие MEM по указателю в GDAL >= 3.10 разрешается явно
+        with rasterio.Env(GDAL_MEM_ENABLE_OPEN='YES'), warnings.catch_warnings():
+            warnings.simplefilter('ignore', NotGeoreferencedWarning)
+            with rasterio.open(mem_path, 'r+') as dataset:
+                # Значение nodata учитывается при передискретизации, как и при чтении исходного файла
+                if src_meta.get('nodata') is not None:
+                    dataset.nodata = src_meta['nodata']
+                data = dataset.read(
+                    out_shape=(count, new_meta['height'], new_meta['width']),
+                    resampling=Resampling.bilinear
+                )
+        del source
+
+        prepare_output_path(output_path)
+        with rasterio.open(output_path, 'w', **new_meta) as dest:
+            dest.write(data)
+    finally:
+        shm.close()
+
+    logging.info(f"Saved raster with new pixel size to {output_path}")
+
+
+def save_original_sync(shm_name, shape, src_meta, original_output_path):
+    """
+    Перезаписывает оригинал из уже декодированного исходного изображения через профиль записи,
+    так же как `copy_original`, но без повторного чтения файла.
+
+    Параметры:
+    ----------
+    shm_name : str
+        Имя блока разделяемой памяти с исходным изображением.
+    shape : tuple
+        Размер исходного изображения (каналы, высота, ширина).
+    src_meta : dict
+        Метаданные исходного изображения.
+    original_output_path : str
+        Путь к копии.
+
+    Возвращает:
+    -----------
+    None
+    """
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        source = np.ndarray(shape, dtype=src_meta['dtype'], buffer=shm.buf)
+        prepare_output_path(original_output_path)
+        with rasterio.open(original_output_path, 'w', **apply_output_profile(src_meta)) as dest:
+            dest.write(source)
+        del source
+    finally:
+        shm.close()
+
+    logging.info(f"Copied original raster to {original_output_path}")
+
+
+def decode_to_shared_memory(input_path):
+    """
+    Декодирует растровое изображение один раз и помещает его в разделяемую память.
+
+    Возвращает:
+    -----------
+    tuple
+        Блок разделяемой памяти, размер изображения (каналы, высота, ширина) и метаданные изображения.
+    """
+    with rasterio.open(input_path) as src:
+        meta = src.meta.copy()
+        shape = (src.count, src.height, src.width)
+        shm = shared_memory.SharedMemory(create=True, size=max(int(np.prod(shape)) * np.dtype(meta['dtype']).itemsize, 1))
+        try:
+            src.read(out=np.ndarray(shape, dtype=meta['dtype'], buffer=shm.buf))
+        except BaseException:
+            shm.close()
+            shm.unlink()
+            raise
+    return shm, shape, meta
+
+
+def release_shared_memory(shm, futures, levels=(), cache=None):
+    """
+    Ожидает завершения всех уровней пирамиды изображения, освобождает разделяемую память
+    и записывает построенные уровни (путь, ключ) в кэш этапа.
+    """
+    try:
+        for future in futures:
+            future.result()
+    finally:
+        shm.close()
+        shm.unlink()
+
+    if cache is not None:
+        for output_path, key in levels:
+            cache.commit(output_path, key, [output_path])
+
+
+def downscale_pyramid(input_dir, output_dir, resolutions, max_workers=None, max_sources_in_memory=2, cache=None):
+    """
+    Уменьшает масштаб растровых изображений, декодируя каждое изображение один раз.
+
+    Каждое изображение читается один раз в разделяемую память, после чего все разрешения строятся из него
+    в процессах-обработчиках, в том числе перезапись оригинала в поддиректорию 'original' через профиль записи.
+    Пока обрабатываются разрешения одного изображения, декодируется следующее, в памяти одновременно находится
+    не больше `max_sources_in_memory` исходных изображений. Результат совпадает с результатом функции `downscale`.
+
+    Параметры:
+    ----------
+    input_dir : str
+        Путь к директории, содержащей входные файлы.
+    output_dir : str
+        Путь к директории, куда будут сохранены уменьшенные копии файлов.
+    resolutions : list of tuple
+        Список разрешений в формате (ширина, высота), к которым нужно привести изображения.
+    max_workers : int
+        Количество процессов-обработчиков. По умолчанию равно количеству ядер процессора.
+    max_sources_in_memory : int
+        Максимальное количество декодированных изображений в разделяемой памяти.
+    cache : StageCache
+        Кэш этапа. Если задан, неизмененные разрешения пропускаются, а изображение, для которого все
+        разрешения уже построены, не декодируется.
+
+    Возвращает:
+    -----------
+    None
+    """
+    pending = []
+    with ProcessPoolExecutor(max_workers=max_workers or os.cpu_count()) as executor:
+        try:
+            for input_path in get_tif_files(input_dir):
+                filename = os.path.basename(input_path)
+                base_name = os.path.splitext(filename)[0]
+
+                original_dir = os.path.join(output_dir, 'original')
+                os.makedirs(original_dir, exist_ok=True)
+                original_output_path = os.path.join(original_dir, filename)
+                original_key = get_cached_original_key(cache, input_path, original_output_path)
+                save_original = cache is None or original_key is not None
+
+                levels = []
+                for res in resolutions:
+                    output_path = get_downscale_output_path(output_dir, base_name, res)
+                    key = get_cached_key(cache, input_path, output_path, res)
+                    if cache is None or key is not None:
+                        levels.append((res, output_path, key))
+                if not levels and not save_original:
+                    continue
+
+                shm, shape, meta = decode_to_shared_memory(input_path)
+                futures = [executor.submit(save_pyramid_level_sync, shm.name, shape, meta, output_path, res)
+                           for res, output_path, _ in levels]
+                outputs = [(output_path, key) for _, output_path, key in levels]
+                if save_original:
+                    futures.append(executor.submit(save_original_sync, shm.name, shape, meta, original_output_path))
+                    outputs.append((original_output_path, original_key))
+                pending.append((shm, futures, outputs))
+
+                while len(pending) >= max_sources_in_memory:
+                    release_shared_memory(*pending.pop(0), cache=cache)
+        finally:
+            while pending:
+                release_shared_memory(*pending.pop(0), cache=cache)
+
+    logging.info(f"Downscale completed for all rasters in {input_dir}")
+
+
+async def downscale(input_dir, output_dir, resolutions, executor, window_bytes=None, cache=None):
     """
     Асинхронно уменьшает масштаб растровых изображений в указанной директории.
 
@@ -87,6 +482,11 @@ async def downscale(input_dir, output_dir, resolutions, executor):
         Список разрешений в формате (ширина, высота), к которым нужно привести изображения.
     executor : concurrent.futures.Executor
         Экзекутор для выполнения асинхронных задач.
+    window_bytes : int
+        Ограничение памяти на одну задачу (байт). Если задано, изображения обрабатываются окнами
+        (см. `save_raster_with_new_pixel_size_windowed_sync`), в том числе при перезаписи оригинала.
+    cache : StageCache
+        Кэш этапа. Если задан, задачи с неизмененными входным файлом и параметрами пропускаются.
 
     Возвращает:
     -----------
@@ -107,18 +507,16 @@ async def downscale(input_dir, output_dir, resolutions, executor):
                 # Путь для сохранения оригинального файла
                 original_output_path = os.path.join(original_dir, filename)
                 # Копируем оригинальный файл в новую директорию
-                with rasterio.open(input_path) as src:
-                    with rasterio.open(original_output_path, 'w', **src.meta) as dest:
-                        dest.write(src.read())
-
-                logging.info(f"Copied original raster to {original_output_path}")
+                copy_original(input_path, original_output_path, window_bytes, cache)
 
                 # Создаем уменьшенные копии для каждого разрешения
                 for res in resolutions:
-                    downscale_dir = os.path.join(output_dir, 'downscale', f'{base_name}_downscale')
-                    os.makedirs(downscale_dir, exist_ok=True)
-                    output_path = os.path.join(downscale_dir, f'{base_name}_downscale_{res[0]}x{res[1]}.tif')
-                    tasks.append(save_raster_with_new_pixel_size(input_path, output_path, res, executor))
+                    output_path = get_downscale_output_path(output_dir, base_name, res)
+                    key = get_cached_key(cache, input_path, output_path, res)
+                    if cache is not None and key is None:
+                        continue
+                    tasks.append(save_raster_with_new_pixel_size(input_path, output_path, res, executor, window_bytes,
+                                                                 cache, key))
 
     # Ожидаем завершения всех задач
     await asyncio.gather(*tasks)
@@ -147,8 +545,40 @@ if __name__ == "__main__":
         (80, 50), (80, 60), (80, 70), (80, 80)
     ]
 
-    # Создаем экзекутор с количеством рабочих потоков, равным количеству ядер процессора
-    executor = ThreadPoolExecutor(max_workers=os.cpu_count())
+    # Режим работы: per_resolution - каждое разрешение читает исходный файл заново,
+    # pyramid - исходный файл декодируется один раз и передается процессам через разделяемую память,
+    # windowed - изображения обрабатываются окнами в пределах DOWNSCALE_MEMORY_MB
+    DOWNSCALE_MODE = os.getenv("DOWNSCALE_MODE", "per_resolution")
+    logging.info(f"Downscale mode: {DOWNSCALE_MODE}")
+
+    # Кэш этапа: content - по хэшу содержимого входного файла, stat - по размеру и времени изменения, off - без кэша
+    STAGE_CACHE = os.getenv("STAGE_CACHE", "content")
+    # Каталог кэша (общий для этапов), должен находиться на той же файловой системе, что и выходные файлы
+    STAGE_CACHE_DIR = os.getenv("STAGE_CACHE_DIR", "/data/.stage_cache")
+    logging.info(f"Stage cache: {STAGE_CACHE}, directory: {STAGE_CACHE_DIR}")
+    cache = StageCache(STAGE_CACHE_DIR, 'downscale', STAGE_CACHE) if STAGE_CACHE != "off" else None
+
+    if DOWNSCALE_MODE == "pyramid":
+        downscale_pyramid(INPUT_PATH_ROOT_DATASET, OUTPUT_DIR, resolutions, cache=cache)
+    elif DOWNSCALE_MODE == "per_resolution":
+        # Создаем экзекутор с количеством рабочих потоков, равным количеству ядер процессора
+        executor = ThreadPoolExecutor(max_workers=os.cpu_count())
+
+        # Запускаем асинхронную функцию downscale
+        asyncio.run(downscale(INPUT_PATH_ROOT_DATASET, OUTPUT_DIR, resolutions, executor, cache=cache))
+    elif DOWNSCALE_MODE == "windowed":
+        # Общее ограничение памяти (МБ): четверть отдается кэшу блоков GDAL, остальное делится между потоками
+        DOWNSCALE_MEMORY_MB = int(os.getenv("DOWNSCALE_MEMORY_MB", 1024))
+        DOWNSCALE_WORKERS = int(os.getenv("DOWNSCALE_WORKERS", os.cpu_count()))
+        logging.info(f"Memory budget: {DOWNSCALE_MEMORY_MB} MB, workers: {DOWNSCALE_WORKERS}")
+
+        gdal_cache_mb = max(DOWNSCALE_MEMORY_MB // 4, 1)
+        window_bytes = (DOWNSCALE_MEMORY_MB - gdal_cache_mb) * 2 ** 20 // DOWNSCALE_WORKERS
+        executor = ThreadPoolExecutor(max_workers=DOWNSCALE_WORKERS)
+        with rasterio.Env(GDAL_CACHEMAX=gdal_cache_mb):
+            asyncio.run(downscale(INPUT_PATH_ROOT_DATASET, OUTPUT_DIR, resolutions, executor, window_bytes, cache))
+    else:
+        raise ValueError(f"Unknown DOWNSCALE_MODE: {DOWNSCALE_MODE}. Use 'per_resolution', 'pyramid' or 'windowed'")
 
-    # Запускаем асинхронную функцию downscale
-    asyncio.run(downscale(INPUT_PATH_ROOT_DATASET, OUTPUT_DIR, resolutions, executor))
+    if cache is not None:
+        cache.save()
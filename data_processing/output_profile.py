@@ -0,0 +1,107 @@
+'''
+Данный модуль содержит общий профиль записи GeoTIFF для всех этапов, сохраняющих снимки и плитки:
+разбиение на блоки, алгоритм сжатия, предиктор и количество потоков сжатия GDAL
+'''
+import os
+
+# Готовые профили записи. none - как раньше: без разбиения на блоки и без сжатия
+OUTPUT_PROFILES = {
+    'none': {},
+    'deflate': {'tiled': True, 'blocksize': 256, 'compress': 'deflate', 'predictor': 'auto'},
+    'zstd': {'tiled': True, 'blocksize': 256, 'compress': 'zstd', 'predictor': 'auto'},
+    'lzw': {'tiled': True, 'blocksize': 256, 'compress': 'lzw', 'predictor': 'auto'},
+}
+
+
+def get_output_profile(name='none', **overrides):
+    """
+    Возвращает профиль записи GeoTIFF.
+
+    Параметры:
+    ----------
+    name : str
+        Название готового профиля из `OUTPUT_PROFILES`.
+    overrides : dict
+        Значения, заменяющие значения готового профиля:
+        tiled (bool) - разбиение на блоки, blocksize (int) - размер блока (кратен 16),
+        compress (str) - алгоритм сжатия ('deflate', 'zstd', 'lzw' или 'none'),
+        predictor (int или 'auto') - предиктор (1 - нет, 2 - горизонтальный, 3 - для чисел с плавающей запятой,
+        'auto' - 2 для целочисленных данных и 3 для чисел с плавающей запятой),
+        level (int) - уровень сжатия, num_threads (int или 'ALL_CPUS') - количество потоков сжатия GDAL.
+
+    Возвращает:
+    -----------
+    dict
+        Профиль записи.
+    """
+    if name not in OUTPUT_PROFILES:
+        raise ValueError(f"Unknown output profile: {name}. Use one of {', '.join(OUTPUT_PROFILES)}")
+    profile = dict(OUTPUT_PROFILES[name])
+    profile.update({key: value for key, value in overrides.items() if value is not None})
+    if profile.get('compress') in (None, 'none'):
+        profile.pop('compress', None)
+        profile.pop('predictor', None)
+        profile.pop('level', None)
+    return profile
+
+
+def get_output_profile_from_env():
+    """
+    Возвращает профиль записи, заданный переменными окружения: OUTPUT_PROFILE - название готового профиля
+    (по умолчанию none), OUTPUT_TILED, OUTPUT_BLOCKSIZE, OUTPUT_COMPRESS, OUTPUT_PREDICTOR, OUTPUT_LEVEL,
+    OUTPUT_NUM_THREADS - замена отдельных значений. Переменные читаются при каждом вызове.
+    """
+    def get_value(name, convert=str):
+        value = os.getenv(name)
+        return convert(value) if value else None
+
+    def to_int_or_keyword(value):
+        return value if not value.isdigit() else int(value)
+
+    return get_output_profile(
+        os.getenv('OUTPUT_PROFILE', 'none'),
+        tiled=get_value('OUTPUT_TILED', lambda value: value.lower() in ('true', '1', 'yes')),
+        blocksize=get_value('OUTPUT_BLOCKSIZE', int),
+        compress=get_value('OUTPUT_COMPRESS', str.lower),
+        predictor=get_value('OUTPUT_PREDICTOR', to_int_or_keyword),
+        level=get_value('OUTPUT_LEVEL', int),
+        num_threads=get_value('OUTPUT_NUM_THREADS', to_int_or_keyword),
+    )
+
+
+def apply_output_profile(meta, profile=None):
+    """
+    Дополняет метаданные записываемого изображения параметрами профиля записи.
+
+    Параметры:
+    ----------
+    meta : dict
+        Метаданные изображения (как `dataset.meta`).
+    profile : dict
+        Профиль записи. По умолчанию профиль из переменных окружения (см. `get_output_profile_from_env`).
+
+    Возвращает:
+    -----------
+    dict
+        Новые метаданные с параметрами создания GeoTIFF.
+    """
+    profile = get_output_profile_from_env() if profile is None else profile
+    new_meta = dict(meta)
+    if profile.get('tiled'):
+        new_meta.update({'tiled': True, 'blockxsize': profile.get('blocksize', 256),
+                         'blockysize': profile.get('blocksize', 256)})
+    compress = profile.get('compress')
+    if compress:
+        new_meta['compress'] = compress
+        predictor = profile.get('predictor', 1)
+        if predictor == 'auto':
+            predictor = 3 if str(meta['dtype']).startswith('float') else 2
+        new_meta['predictor'] = predictor
+        if profile.get('level') is not None:
+            # Название параметра уровня сжатия зависит от алгоритма
+            level_option = {'deflate': 'zlevel', 'zstd': 'zstd_level'}.get(compress.lower())
+            if level_option is not None:
+                new_meta[level_option] = profile['level']
+    if profile.get('num_threads') is not None:
+        new_meta['num_threads'] = str(profile['num_threads'])
+    return new_meta
@@ -0,0 +1,125 @@
+'''
+Данный скрипт содержит замер записи плиток GeoTIFF с разными профилями записи (см. output_profile): скорость записи,
+скорость чтения записанных плиток и объем на диске. Плитки вырезаются из снимка так же, как в crop_layout,
+и читаются в память заранее, поэтому чтение снимка в замер не входит. Чтение записанных плиток выполняется сразу
+после записи и обычно попадает в кэш страниц, то есть показывает затраты на распаковку, а не на чтение с диска
+
+Запуск: python data_processing/output_profile_benchmark.py --input /data/original/layout_2021-06-15.tif --num-crops 1000
+'''
+import argparse
+import os
+import shutil
+import tempfile
+import time
+import rasterio
+from rasterio.windows import Window
+from output_profile import OUTPUT_PROFILES, apply_output_profile, get_output_profile
+
+
+def read_crops(input_path, crop_size, num_crops):
+    '''Функция для чтения первых `num_crops` плиток снимка (по сетке без перекрытия) и их метаданных'''
+    crops = []
+    with rasterio.open(input_path) as dataset:
+        meta = dataset.meta.copy()
+        meta.update({'driver': 'GTiff', 'height': crop_size, 'width': crop_size})
+        for j in range(dataset.height // crop_size):
+            for i in range(dataset.width // crop_size):
+                if len(crops) == num_crops:
+                    return meta, crops
+                window = Window(i * crop_size, j * crop_size, crop_size, crop_size)
+                crops.append((dataset.window_transform(window), dataset.read(window=window)))
+    return meta, crops
+
+
+def write_crops(crops, meta, output_dir, profile):
+    '''Функция для записи плиток с профилем записи, возвращает пути к записанным файлам'''
+    paths = []
+    for ind, (transform, data) in enumerate(crops):
+        path = os.path.join(output_dir, f'crop_{ind}.tif')
+        with rasterio.open(path, 'w', **apply_output_profile(dict(meta, transform=transform), profile)) as dest:
+            dest.write(data)
+        paths.append(path)
+    return paths
+
+
+def read_back(paths):
+    for path in paths:
+        with rasterio.open(path) as dataset:
+            dataset.read()
+
+
+def benchmark_profiles(input_path, profiles, crop_size=256, num_crops=1000, output_dir=None):
+    '''
+    Функция для замера профилей записи
+
+    Parameters
+    -------------
+    input_path: `str`
+        Путь до снимка, из которого вырезаются плитки
+    profiles: `Dict[str, dict]`
+        Проверяемые профили записи {название: профиль}
+    crop_size: `int`
+        Размер плитки
+    num_crops: `int`
+        Количество записываемых плиток
+    output_dir: `str`
+        Каталог для записи плиток (должен быть на проверяемом диске). По умолчанию временный каталог
+
+    Returns
+    -------------
+    `Dict[str, dict]`
+        Для каждого профиля: скорость записи и чтения (МБ/с несжатых данных), размер файлов и занятое место (МБ)
+    '''
+    meta, crops = read_crops(input_path, crop_size, num_crops)
+    if not crops:
+        raise ValueError(f'Снимок {input_path} меньше размера плитки {crop_size}')
+    raw_mb = sum(data.nbytes for _, data in crops) / 2 ** 20
+
+    print(f'Плиток: {len(crops)} ({crop_size}x{crop_size}, {meta["count"]} кан., {meta["dtype"]}), '
+          f'несжатых данных: {raw_mb:.1f} МБ')
+    print(f'{"профиль":<12}{"запись, МБ/с":>14}{"чтение, МБ/с":>14}{"размер, МБ":>12}{"на диске, МБ":>14}{"сжатие":>8}')
+    results = {}
+    for name, profile in profiles.items():
+        profile_dir = tempfile.mkdtemp(prefix=f'{name}_', dir=output_dir)
+        try:
+            start_time = time.perf_counter()
+            paths = write_crops(crops, meta, profile_dir, profile)
+            write_time = time.perf_counter() - start_time
+
+            start_time = time.perf_counter()
+            read_back(paths)
+            read_time = time.perf_counter() - start_time
+
+            stats = [os.stat(path) for path in paths]
+            size_mb = sum(stat.st_size for stat in stats) / 2 ** 20
+            # Занятое место учитывает округление каждого файла до блока файловой системы
+            disk_mb = sum(stat.st_blocks * 512 for stat in stats) / 2 ** 20
+        finally:
+            shutil.rmtree(profile_dir, ignore_errors=True)
+
+        results[name] = {'write_mb_s': raw_mb / write_time, 'read_mb_s': raw_mb / read_time,
+                         'size_mb': size_mb, 'disk_mb': disk_mb}
+        print(f'{name:<12}{results[name]["write_mb_s"]:>14.1f}{results[name]["read_mb_s"]:>14.1f}'
+              f'{size_mb:>12.2f}{disk_mb:>14.2f}{raw_mb / max(size_mb, 1e-9):>8.2f}')
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Замер профилей записи GeoTIFF')
+    parser.add_argument('--input', type=str, required=True, help='Путь до снимка, из которого вырезаются плитки')
+    parser.add_argument('--profiles', type=str, nargs='+', default=list(OUTPUT_PROFILES),
+                        choices=list(OUTPUT_PROFILES), help='Проверяемые профили записи')
+    parser.add_argument('--crop-size', type=int, default=256, help='Размер плитки')
+    parser.add_argument('--num-crops', type=int, default=1000, help='Количество записываемых плиток')
+    parser.add_argument('--level', type=int, default=None, help='Уровень сжатия (по умолчанию уровень GDAL)')
+    parser.add_argument('--num-threads', type=str, default=None, help='Количество потоков сжатия GDAL')
+    parser.add_argument('--output-dir', type=str, default=None,
+                        help='Каталог для записи плиток на проверяемом диске (по умолчанию временный каталог)')
+    args = parser.parse_args()
+
+    num_threads = int(args.num_threads) if args.num_threads and args.num_threads.isdigit() else args.num_threads
+    benchmark_profiles(args.input,
+                       {name: get_output_profile(name, blocksize=args.crop_size, level=args.level,
+                                                 num_threads=num_threads)
+                        for name in args.profiles},
+                       args.crop_size, args.num_crops, args.output_dir)
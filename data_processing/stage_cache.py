@@ -0,0 +1,251 @@
+'''
+Данный модуль содержит кэш этапов обработки снимков (downscale, crop_layout): задача этапа пропускается,
+если входной файл и параметры этапа не изменились, а одинаковые по содержимому выходные файлы хранятся
+один раз и связываются жесткими ссылками
+'''
+import hashlib
+import json
+import logging
+import os
+import threading
+
+
+def prepare_output_path(output_path):
+    """
+    Удаляет существующий выходной файл перед записью.
+
+    Выходной файл может быть жесткой ссылкой на объект кэша, запись поверх него изменила бы объект
+    и все выходные файлы с тем же содержимым. После удаления запись создает новый файл.
+    """
+    if os.path.lexists(output_path):
+        os.remove(output_path)
+
+
+def hash_file(path, chunk_size=2 ** 20):
+    """
+    Вычисляет SHA-256 содержимого файла.
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class StageCache:
+    """
+    Кэш этапа обработки снимков.
+
+    Ключ задачи - хэш содержимого входного файла (или его размера и времени изменения) и параметров этапа.
+    Манифест (JSON Lines, только дозапись) хранит для каждой задачи ее ключ и выходные файлы с хэшами содержимого,
+    поэтому при прерванном запуске выполненные задачи не теряются. Выходные файлы связываются жесткими ссылками
+    с объектами в `objects/<sha256>`: одинаковые результаты хранятся на диске один раз, а удаленный выходной файл
+    восстанавливается из объекта без повторной обработки.
+
+    Параметры:
+    ----------
+    cache_dir : str
+        Директория кэша. Должна находиться на той же файловой системе, что и выходные файлы.
+    stage : str
+        Название этапа (имя файла манифеста).
+    hash_mode : str
+        'content' - ключ по SHA-256 содержимого входного файла (хэш повторно вычисляется только при изменении
+        размера или времени изменения), 'stat' - ключ по размеру и времени изменения входного файла.
+    """
+
+    def __init__(self, cache_dir, stage, hash_mode='content'):
+        if hash_mode not in ('content', 'stat'):
+            raise ValueError(f"Unknown hash mode: {hash_mode}. Use 'content' or 'stat'")
+        self.cache_dir = cache_dir
+        self.stage = stage
+        self.hash_mode = hash_mode
+        self.path = os.path.join(cache_dir, f'{stage}.jsonl')
+        self.objects_dir = os.path.join(cache_dir, 'objects')
+        self.inputs = {}
+        self.tasks = {}
+        self._lock = threading.Lock()
+        self._load()
+
+    def get_key(self, input_path, params):
+        """
+        Вычисляет ключ задачи по входному файлу и параметрам этапа.
+
+        Параметры:
+        ----------
+        input_path : str
+            Путь к входному файлу.
+        params : dict
+            Параметры этапа, влияющие на результат (сериализуемые в JSON).
+
+        Возвращает:
+        -----------
+        str
+            Ключ задачи.
+        """
+        data = json.dumps([self.stage, self._fingerprint(input_path), params], sort_keys=True)
+        return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+    def restore(self, name, key):
+        """
+        Проверяет, что задача уже выполнена с тем же ключом, и восстанавливает удаленные или измененные
+        выходные файлы из объектов кэша.
+
+        Параметры:
+        ----------
+        name : str
+            Имя задачи (например, путь к выходному файлу).
+        key : str
+            Ключ задачи.
+
+        Возвращает:
+        -----------
+        bool
+            True, если задачу можно пропустить.
+        """
+        with self._lock:
+            task = self.tasks.get(name)
+        if task is None or task['key'] != key:
+            return False
+
+        for output_path, digest, size, mtime_ns in task['outputs']:
+            if os.path.exists(output_path):
+                stat = os.stat(output_path)
+                if (stat.st_size, stat.st_mtime_ns) == (size, mtime_ns):
+                    continue
+            object_path = self._object_path(digest)
+            if not os.path.exists(object_path):
+                return False
+            self._link(object_path, output_path)
+        return True
+
+    def commit(self, name, key, output_paths):
+        """
+        Записывает выполненную задачу в манифест. Выходной файл, содержимое которого уже есть в кэше,
+        заменяется жесткой ссылкой на объект, иначе сам становится объектом.
+
+        Параметры:
+        ----------
+        name : str
+            Имя задачи.
+        key : str
+            Ключ задачи.
+        output_paths : list of str
+            Пути к выходным файлам задачи.
+        """
+        outputs = []
+        for output_path in output_paths:
+            digest = hash_file(output_path)
+            object_path = self._object_path(digest)
+            with self._lock:
+                try:
+                    if not os.path.exists(object_path):
+                        os.makedirs(os.path.dirname(object_path), exist_ok=True)
+                        os.link(output_path, object_path)
+                    elif not os.path.samefile(object_path, output_path):
+                        self._link(object_path, output_path)
+                except OSError as e:
+                    # Файловая система без жестких ссылок: задачи пропускаются, но одинаковые результаты не объединяются
+                    logging.warning(f"Failed to link {output_path} to the stage cache: {e}")
+            stat = os.stat(output_path)
+            outputs.append([output_path, digest, stat.st_size, stat.st_mtime_ns])
+
+        with self._lock:
+            self.tasks[name] = {'key': key, 'outputs': outputs}
+            self._write({'task': name, 'key': key, 'outputs': outputs})
+
+    def run(self, name, input_path, params, produce):
+        """
+        Выполняет задачу, если ее результат отсутствует в кэше.
+
+        Параметры:
+        ----------
+        name : str
+            Имя задачи.
+        input_path : str
+            Путь к входному файлу.
+        params : dict
+            Параметры этапа.
+        produce : callable
+            Функция без аргументов, выполняющая задачу и возвращающая список путей к выходным файлам.
+
+        Возвращает:
+        -----------
+        bool
+            True, если задача выполнена, False, если пропущена.
+        """
+        key = self.get_key(input_path, params)
+        if self.restore(name, key):
+            logging.info(f"Skipped unchanged {name}")
+            return False
+        self.commit(name, key, produce())
+        return True
+
+    def save(self):
+        """
+        Перезаписывает манифест, оставляя только актуальные записи, и удаляет объекты,
+        на которые больше не ссылается ни один выходной файл.
+        """
+        with self._lock:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            path_to_tmp = self.path + '.tmp'
+            with open(path_to_tmp, 'w') as f:
+                for input_path, (size, mtime_ns, digest) in self.inputs.items():
+                    f.write(json.dumps({'input': input_path, 'size': size, 'mtime_ns': mtime_ns, 'digest': digest}) + '\n')
+                for name, task in self.tasks.items():
+                    f.write(json.dumps({'task': name, 'key': task['key'], 'outputs': task['outputs']}) + '\n')
+            os.replace(path_to_tmp, self.path)
+
+            if not os.path.isdir(self.objects_dir):
+                return
+            for root, _, files in os.walk(self.objects_dir):
+                for file in files:
+                    object_path = os.path.join(root, file)
+                    if os.stat(object_path).st_nlink == 1:
+                        os.remove(object_path)
+
+    def _fingerprint(self, input_path):
+        stat = os.stat(input_path)
+        if self.hash_mode == 'stat':
+            return f'{stat.st_size}:{stat.st_mtime_ns}'
+
+        with self._lock:
+            entry = self.inputs.get(input_path)
+        if entry is not None and tuple(entry[:2]) == (stat.st_size, stat.st_mtime_ns):
+            return entry[2]
+
+        digest = hash_file(input_path)
+        with self._lock:
+            self.inputs[input_path] = [stat.st_size, stat.st_mtime_ns, digest]
+            self._write({'input': input_path, 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'digest': digest})
+        return digest
+
+    def _object_path(self, digest):
+        return os.path.join(self.objects_dir, digest[:2], digest)
+
+    @staticmethod
+    def _link(object_path, output_path):
+        path_to_tmp = output_path + '.tmp'
+        prepare_output_path(path_to_tmp)
+        os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+        os.link(object_path, path_to_tmp)
+        os.replace(path_to_tmp, output_path)
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, 'r') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # Последняя строка могла быть записана не полностью при аварийном завершении
+                    continue
+                if 'input' in entry:
+                    self.inputs[entry['input']] = [entry['size'], entry['mtime_ns'], entry['digest']]
+                elif 'task' in entry:
+                    self.tasks[entry['task']] = {'key': entry['key'], 'outputs': entry['outputs']}
+
+    def _write(self, entry):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(entry) + '\n')
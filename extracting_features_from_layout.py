@@ -1,22 +1,37 @@
 '''Данный модель содержит скрипт для преобразования сгенерированных слоев подложки в вектор и запись их в базу данных'''
 import os
+import re
 
 os.environ["KMP_DUPLICATE_LIB_OK"] = "TRUE"
-from typing import List, Dict
+from typing import Callable, List, Dict, Tuple
 from faiss_search.faiss_interface import FAISS
+from faiss_search.index_builder import IndexBuilder
 from config import ExtractingFeaturesConfig, FAISSConfig
 from PIL import Image
 import numpy as np
-from utils.api_requests import ApiClient
-import rasterio
-from shapely.geometry import Polygon
+from utils.api_requests import ApiClient, UploadQueue
 from tqdm import tqdm
-from utils.transform import transform_polygon
+from utils.transform import transform_footprints
 import torch
 import argparse
+import copy
+import functools
 import json
-from utils.convert_crop import convert_tif2img
-from dtl_siamese_network import SiameseNet, TorhModelFeatureExtraction, ResNet, hog_feature_extraction, ResNet2
+import multiprocessing
+import shutil
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+import time
+from utils.convert_crop import convert_tif2img, convert_array2img, convert_arrays2batch
+from utils.tile_loader import TileLoader
+from utils.npy_store import NpyStore
+from utils.tile_manifest import TileManifest
+from utils.upload_outbox import UploadOutbox
+from utils.metadata_store import TileMetadataStore
+from utils.dedup import find_aliases
+from utils.inference_backend import EmbeddingBackend, compare_backends
+from dtl_siamese_network import SiameseNet, ResNet, ResNet2
+from dtl_siamese_network.data.transforms import get_test_transforms
 import logging
 
 logger = logging.getLogger(__name__)
@@ -24,28 +39,43 @@ logger.setLevel(logging.INFO)
 
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 PATH_TO_MODEL_WEIGHT = '/weights/checkpoint_efficientnet_b0.pth'
+TILE_CRS = "EPSG:32637"  # Система координат плиток
+OUTPUT_CRS = "EPSG:4326"  # Система координат углов плиток, отправляемых на сервер
+TEST_TRANSFORM = get_test_transforms()  # Те же преобразования, что и в SiameseNet.predict
+IMAGE_SIZE = 256  # Размер входа модели (Resize в тестовых преобразованиях)
+
+
+def collect_tiles(path_to_data: str, layout_names: List[str] = None) -> List[Tuple[str, Dict]]:
+    '''
+    Функция для получения списка плиток набора данных и их сопутствующей информации.
+    Если заданы `layout_names`, читаются только каталоги плиток указанных подложек
+    '''
+    tiles = []
+    for folder_crop in sorted(os.listdir(path_to_data)):
+        # Пропускаются каталоги, не являющиеся каталогами плиток crop_NxM (например, служебные)
+        match = re.fullmatch(r'crop_(\d+)x(\d+)', folder_crop)
+        if folder_crop == 'crop_10x10' or match is None:
+            continue
+
+        path_to_folder_crop = os.path.join(path_to_data, folder_crop)
+        if not os.path.isdir(path_to_folder_crop):
+            continue
+        dim_space_x, dim_space_y = match.groups()
+
+        for folder_layout_crop in sorted(os.listdir(path_to_folder_crop)):
+            if layout_names is not None and folder_layout_crop.replace('_crop', '') not in layout_names:
+                continue
+            path_to_layout_crop = os.path.join(path_to_folder_crop, folder_layout_crop)
 
+            for filename in sorted(os.listdir(path_to_layout_crop)):
+                tiles.append((os.path.join(path_to_layout_crop, filename), {
+                    "layout_name": folder_layout_crop.replace('_crop', ''),
+                    "dim_space_x": int(dim_space_x),
+                    "dim_space_y": int(dim_space_y),
+                    "filename": filename
+                }))
 
-def read_image(path_to_image: str):
-    '''Функция для чтения изображения и извлечения координат углов'''
-
-    with rasterio.open(path_to_image) as dataset:
-        # Чтение данных изображения
-        image_data = dataset.read()
-
-        # Получение трансформации изображения
-        transform = dataset.transform
-        upper_left = (transform[2], transform[5])  # координаты левого верхнего угла
-        lower_right = (transform[2] + transform[0] * dataset.width,  # X координата правого нижнего угла
-                       transform[5] + transform[4] * dataset.height)
-        polygon = transform_polygon(Polygon([
-            (upper_left[0], upper_left[1]),
-            (lower_right[0], upper_left[1]),
-            (lower_right[0], lower_right[1]),
-            (upper_left[0], lower_right[1])
-        ]),"EPSG:32637", "EPSG:4326" )
-
-        return image_data, polygon
+    return tiles
 
 
 def send_data_for_server(api_client, data: List[Dict]):
@@ -53,31 +83,31 @@ def send_data_for_server(api_client, data: List[Dict]):
     return response
 
 
-def normalize(image):
-    # max_value = 4096
-    image = np.log1p(image.astype(np.float32))
-    min_value = np.min(image)
-    max_value = np.max(image)
-    # линейное преобразование для нормирования пикселей
-    image = ((image - min_value) / (max_value - min_value)) * 255
+def check_response(response):
+    if not 200 <= response.status_code < 300:
+        raise RuntimeError(f'Ошибка при добавлении слоя в БД: код ответа {response.status_code}')
 
-    return image.astype(np.uint8)
 
+def acknowledge(outbox: UploadOutbox, start: int, end: int, response):
+    '''Функция для записи в журнал отправки диапазона faiss_id, принятого сервером'''
+    check_response(response)
+    outbox.ack(start, end)
 
-def pipeline_extracting_features(path_to_weight, name_model):
-    faiss_config = FAISSConfig()
-    d = faiss_config.vector_dim
-    logger.info(f'\t\t Количество кластеров: {faiss_config.num_clusters}')
-    logger.info(f'\t\t Путь до модели: {path_to_weight}')
 
-    extracting_features_config = ExtractingFeaturesConfig()
+def create_upload_queue(extracting_features_config: ExtractingFeaturesConfig) -> UploadQueue:
+    '''
+    Функция для создания очереди фоновой отправки данных векторов на сервер через пул соединений.
+    Ошибка отправки блока не прерывает заполнение индекса: блок остается неподтвержденным в журнале отправки
+    '''
+    api_client = ApiClient(extracting_features_config.server_url,
+                           pool_size=extracting_features_config.upload_max_in_flight,
+                           compress=extracting_features_config.upload_gzip)
+    return UploadQueue(functools.partial(send_data_for_server, api_client),
+                       extracting_features_config.upload_max_in_flight, fail_fast=False)
 
-    api_client = ApiClient(extracting_features_config.server_url)
 
-    train_vector = np.empty((0, d))
-    data = []
-    # Объявление faiss
-    db_faiss = FAISS(faiss_config)
+def load_model(path_to_weight, name_model):
+    '''Функция для загрузки модели извлечения признаков'''
     if name_model == 'resnet':
         embedding_net = ResNet()
     else:
@@ -85,9 +115,592 @@ def pipeline_extracting_features(path_to_weight, name_model):
 
     model = SiameseNet(embedding_net)
     print(f'Имя модели: {name_model}')
-    model.load_state_dict(torch.load(path_to_weight))
+    model.load_state_dict(torch.load(path_to_weight, map_location=device))
     model.eval()
     model.to(device)
+    return model
+
+
+def create_backend(model, extracting_features_config: ExtractingFeaturesConfig,
+                   backend: str = None, quantize: bool = None) -> EmbeddingBackend:
+    '''Функция для создания бэкенда инференса ветви SiameseNet, вычисляющей вектор признаков'''
+    backend = backend or extracting_features_config.inference_backend
+    quantize = extracting_features_config.quantize_int8 if quantize is None else quantize
+    path_to_export = None
+    if backend != 'eager':
+        path_to_export = extracting_features_config.path_to_exported_model
+
+    return EmbeddingBackend(model.embedding_net, backend, quantize, device=device, path_to_export=path_to_export,
+                            num_intra_threads=extracting_features_config.num_intra_threads,
+                            num_inter_threads=extracting_features_config.num_inter_threads)
+
+
+def to_batch(images: List[Image.Image]) -> torch.Tensor:
+    '''Функция для преобразования изображений в пакет (N, 3, H, W) теми же преобразованиями, что и SiameseNet.predict'''
+    return torch.stack([TEST_TRANSFORM(image) for image in images])
+
+
+def preprocess_tiles(pixels: List[np.ndarray], out: np.ndarray = None) -> torch.Tensor:
+    '''
+    Функция для преобразования прочитанных плиток в пакет (N, 3, H, W). Плитки размера входа модели
+    обрабатываются векторизованно в буфер `out`, остальные (требуется Resize) - через изображения PIL
+    '''
+    if all(tile.shape == (3, IMAGE_SIZE, IMAGE_SIZE) for tile in pixels):
+        return torch.from_numpy(convert_arrays2batch(pixels, out))
+    return to_batch([convert_array2img(tile) for tile in pixels])
+
+
+def predict_batch(backend: EmbeddingBackend, images: List[Image.Image]) -> np.ndarray:
+    '''Функция для извлечения векторов признаков пакета изображений за один прямой проход модели'''
+    return backend(to_batch(images))
+
+
+def benchmark_batch_sizes(backend: EmbeddingBackend, images: List[Image.Image], batch_sizes: List[int],
+                          repeats: int = 3):
+    '''
+    Функция для подбора размера пакета: замеряет скорость извлечения признаков (изобр./сек)
+    для каждого размера пакета на одних и тех же изображениях
+
+    Parameters
+    -------------
+    backend: `EmbeddingBackend`
+        Бэкенд инференса модели извлечения признаков
+    images: `List[Image.Image]`
+        Изображения, на которых производится замер
+    batch_sizes: `List[int]`
+        Проверяемые размеры пакета
+    repeats: `int`
+        Количество повторов замера, берется лучший результат
+
+    Returns
+    -------------
+    `Dict[int, float]`
+        Скорость (изобр./сек) для каждого размера пакета
+    '''
+    # Прогрев модели, чтобы первый замер не включал инициализацию
+    predict_batch(backend, images[:1])
+
+    results = {}
+    for batch_size in batch_sizes:
+        best_time = float('inf')
+        for _ in range(repeats):
+            start_time = time.perf_counter()
+            for start in range(0, len(images), batch_size):
+                predict_batch(backend, images[start: start + batch_size])
+            best_time = min(best_time, time.perf_counter() - start_time)
+
+        results[batch_size] = len(images) / best_time
+        print(f'Размер пакета {batch_size}: {results[batch_size]:.1f} изобр./сек')
+
+    best_batch_size = max(results, key=results.get)
+    print(f'Лучший размер пакета: {best_batch_size}')
+    return results
+
+
+def extract_features(backend: EmbeddingBackend, tiles: List[Tuple[str, Dict]], extracting_features_config: ExtractingFeaturesConfig,
+                     metadata_store: TileMetadataStore, vector_store: NpyStore = None,
+                     index_builder: IndexBuilder = None) -> NpyStore:
+    '''
+    Функция для извлечения векторов признаков плиток и их дозаписи в хранилища векторов и данных плиток на диске
+
+    Parameters
+    -------------
+    backend: `EmbeddingBackend`
+        Бэкенд инференса модели извлечения признаков
+    tiles: `List[Tuple[str, Dict]]`
+        Пары (путь до плитки, сопутствующие данные плитки)
+    extracting_features_config: `ExtractingFeaturesConfig`
+        Конфигурация pipeline извлечения признаков
+    metadata_store: `TileMetadataStore`
+        Хранилище, в которое дописываются данные плиток
+    vector_store: `NpyStore`
+        Хранилище, в которое дописываются вектора. Если не задано, создается по размеру первого вектора
+    index_builder: `IndexBuilder`
+        Построитель индекса FAISS, получающий вектора по мере извлечения (выборка для обучения)
+
+    Returns
+    -------------
+    `NpyStore`
+        Хранилище векторов признаков
+    '''
+    batch_size = extracting_features_config.batch_size
+    num_images, inference_time = 0, 0.0
+
+    tile_loader = TileLoader(tiles, batch_size,
+                             num_workers=extracting_features_config.num_loader_workers,
+                             prefetch_batches=extracting_features_config.prefetch_batches)
+    # Буфер входа модели переиспользуется между пакетами: результат прямого прохода копируется до следующего пакета
+    input_buffer = np.empty((batch_size, 3, IMAGE_SIZE, IMAGE_SIZE), dtype=np.float32)
+    progress_bar = tqdm(total=len(tiles), desc='Извлечение признаков из плиток', ncols=180)
+    for batch in tile_loader:
+        batch_input = preprocess_tiles(batch.pixels, input_buffer)
+        corners = transform_footprints(batch.transforms,
+                                       [pixels.shape[2] for pixels in batch.pixels],
+                                       [pixels.shape[1] for pixels in batch.pixels],
+                                       TILE_CRS, OUTPUT_CRS)
+
+        start_time = time.perf_counter()
+        feature_vectors = backend(batch_input)
+        inference_time += time.perf_counter() - start_time
+        num_images += len(batch.items)
+        progress_bar.update(len(batch.items))
+        progress_bar.set_postfix({'изобр./сек': f'{num_images / inference_time:.1f}'})
+
+        if vector_store is None:
+            vector_store = NpyStore.create(extracting_features_config.path_to_prepared_vectors,
+                                           (feature_vectors.shape[1],), dtype=np.float32,
+                                           chunk_rows=extracting_features_config.prepared_vectors_chunk_rows)
+        vector_store.append(feature_vectors)
+        metadata_store.append(batch.items, corners)
+        if index_builder is not None:
+            index_builder.update(feature_vectors, vector_store.array)
+    progress_bar.close()
+
+    if num_images:
+        print(f'Скорость извлечения признаков (размер пакета {batch_size}): '
+              f'{num_images / inference_time:.1f} изобр./сек')
+
+    return vector_store
+
+
+def split_blocks(start: int, end: int, block_size: int) -> List[Tuple[int, int]]:
+    return [(start_block, min(start_block + block_size, end)) for start_block in range(start, end, block_size)]
+
+
+def get_excluded_rows(metadata_store: TileMetadataStore) -> np.ndarray:
+    '''Функция для получения отсортированных номеров строк, вектора которых не входят в индекс: удаленных и дубликатов'''
+    aliases = metadata_store.aliases()
+    return np.union1d(metadata_store.deleted_rows(), np.flatnonzero(aliases != np.arange(len(aliases))))
+
+
+def upload_vectors(upload_queue: UploadQueue, outbox: UploadOutbox, metadata_store: TileMetadataStore,
+                   blocks: List[Tuple[int, int]], excluded_rows: np.ndarray = None):
+    '''
+    Функция для постановки в очередь отправки на сервер данных векторов блоков faiss_id [start, end)
+    (кроме не входящих в индекс: удаленных и дубликатов, по умолчанию `get_excluded_rows`). Блоки отправляются
+    в фоне, принятые сервером блоки записываются в журнал отправки
+    '''
+    if excluded_rows is None:
+        excluded_rows = get_excluded_rows(metadata_store)
+    for start_block, end_block in blocks:
+        layers = [metadata_store.get_record(row) for row in
+                  np.setdiff1d(np.arange(start_block, end_block), excluded_rows, assume_unique=True).tolist()]
+        if not layers:
+            outbox.ack(start_block, end_block)
+            continue
+        for layer in layers:
+            layer['layout_name'] = '_'.join(layer['layout_name'].split('_')[:2])
+        upload_queue.submit(layers, on_done=functools.partial(acknowledge, outbox, start_block, end_block))
+
+
+def checkpoint(db_faiss: FAISS, outbox: UploadOutbox, blocks: List[Tuple[int, int]], on_checkpoint: Callable = None):
+    '''
+    Функция для сохранения индекса FAISS (и, через `on_checkpoint`, манифеста плиток) вместе с записью
+    в журнал отправки блоков, добавленных в индекс. Блоки записываются до сохранения индекса, поэтому
+    каждый сохраненный в индексе faiss_id либо подтвержден сервером, либо будет отправлен повторно.
+    После сохранения в журнал записывается отметка, по которой при следующем запуске журнал сопоставляется с индексом.
+    Блоки необходимо ставить в очередь отправки только после сохранения
+    '''
+    outbox.add_pending(blocks)
+    db_faiss.save()
+    if on_checkpoint is not None:
+        on_checkpoint()
+    outbox.add_checkpoint(db_faiss.next_id)
+
+
+def finish_uploads(upload_queue: UploadQueue, outbox: UploadOutbox):
+    '''Функция для ожидания отправки всех блоков, после подтверждения всех блоков журнал отправки удаляется'''
+    try:
+        upload_queue.join()
+    except Exception as e:
+        raise RuntimeError(f'Сервер не подтвердил блоков: {len(outbox.pending())}. Индекс сохранен, неподтвержденные '
+                           f'блоки будут отправлены повторно при следующем запуске') from e
+    outbox.clear()
+
+
+def replay_outbox(upload_queue: UploadQueue, outbox: UploadOutbox,
+                  extracting_features_config: ExtractingFeaturesConfig, next_id: int = None) -> bool:
+    '''
+    Функция для повторной отправки блоков, не подтвержденных сервером при предыдущем запуске
+
+    Parameters
+    -------------
+    next_id: `int`
+        Следующий свободный faiss_id сохраненного индекса. Блоки за его пределами записаны в журнал,
+        но индекс с ними не был сохранен, поэтому они не отправлялись и не отправляются повторно
+
+    Returns
+    -------------
+    `bool`
+        True если в журнале были неподтвержденные блоки
+    '''
+    blocks = [(start, end) for start, end in outbox.pending() if next_id is None or end <= next_id]
+    if not blocks:
+        return False
+
+    print(f'Повторная отправка неподтвержденных сервером блоков: {len(blocks)}')
+    upload_vectors(upload_queue, outbox, load_metadata_store(extracting_features_config), blocks)
+    finish_uploads(upload_queue, outbox)
+    return True
+
+
+def load_metadata_store(extracting_features_config: ExtractingFeaturesConfig) -> TileMetadataStore:
+    '''
+    Функция для загрузки хранилища данных плиток. Данные в старом формате (список словарей в JSON)
+    однократно преобразуются в колоночное хранилище
+    '''
+    if not os.path.exists(extracting_features_config.path_to_prepared_vectors_data) and \
+            os.path.exists(extracting_features_config.path_to_prepared_vectors_data_json):
+        print('Преобразую данные векторов из JSON в колоночное хранилище...')
+        with open(extracting_features_config.path_to_prepared_vectors_data_json, 'r') as f:
+            records = json.load(f)
+        return TileMetadataStore.from_records(extracting_features_config.path_to_prepared_vectors_data, records)
+
+    return TileMetadataStore(extracting_features_config.path_to_prepared_vectors_data)
+
+
+def load_manifest(extracting_features_config: ExtractingFeaturesConfig,
+                  metadata_store: TileMetadataStore) -> TileManifest:
+    '''
+    Функция для загрузки манифеста плиток. Если манифест отсутствует (например, вектора были загружены заранее),
+    он восстанавливается по данным векторов, а текущие файлы плиток считаются неизмененными
+    '''
+    if os.path.exists(extracting_features_config.path_to_prepared_manifest):
+        return TileManifest.load(extracting_features_config.path_to_prepared_manifest)
+
+    print('Манифест плиток не найден, восстанавливаю его по данным векторов...')
+    manifest = TileManifest()
+    deleted_rows = set(metadata_store.deleted_rows().tolist())
+    for row in range(len(metadata_store)):
+        if row in deleted_rows:
+            continue
+        dim_space_x, dim_space_y = metadata_store.resolution(row)
+        path_to_tile = os.path.join(extracting_features_config.path_to_data,
+                                    f'crop_{dim_space_x}x{dim_space_y}',
+                                    f'{metadata_store.layout_name(row)}_crop', metadata_store.filename(row))
+        if os.path.exists(path_to_tile):
+            manifest.add(path_to_tile, row)
+    return manifest
+
+
+def update_prepared_vectors(backend: EmbeddingBackend, db_faiss: FAISS, upload_queue: UploadQueue, outbox: UploadOutbox,
+                            faiss_config: FAISSConfig, extracting_features_config: ExtractingFeaturesConfig):
+    '''
+    Функция для инкрементального обновления: признаки извлекаются только из новых и измененных плиток
+    (по пути, размеру и времени изменения файла), их вектора дописываются в подготовленные вектора
+    и в существующий индекс FAISS без его переобучения. Вектора измененных и удаленных плиток удаляются из индекса
+    '''
+    metadata_store = load_metadata_store(extracting_features_config)
+
+    tiles = collect_tiles(extracting_features_config.path_to_data)
+    paths = [path_to_tile for path_to_tile, _ in tiles]
+    manifest = load_manifest(extracting_features_config, metadata_store)
+    changed, stale_rows = manifest.diff(paths)
+    print(f'Новых и измененных плиток: {len(changed)}, устаревших векторов: {len(stale_rows)}')
+    if not changed and not stale_rows:
+        return
+
+    changed = set(changed)
+    new_tiles = [(path_to_tile, item) for path_to_tile, item in tiles if path_to_tile in changed]
+
+    start_row = append_tiles(backend, db_faiss, new_tiles, extracting_features_config, metadata_store)
+
+    def save_manifest(end_row: int):
+        # В манифест попадают только плитки, вектора которых уже сохранены в индексе
+        for row, (path_to_tile, _) in enumerate(new_tiles[:end_row - start_row], start_row):
+            manifest.add(path_to_tile, row)
+        manifest.remove_missing(paths)
+        manifest.save(extracting_features_config.path_to_prepared_manifest)
+
+    apply_index_update(db_faiss, upload_queue, outbox, faiss_config, extracting_features_config, metadata_store,
+                       start_row, stale_rows, save_manifest)
+
+
+def replace_layouts(backend: EmbeddingBackend, db_faiss: FAISS, upload_queue: UploadQueue, outbox: UploadOutbox,
+                    faiss_config: FAISSConfig, extracting_features_config: ExtractingFeaturesConfig,
+                    layout_names: List[str]):
+    '''
+    Функция для замены векторов повторно обработанных подложек: все их вектора удаляются из индекса FAISS
+    и помечаются удаленными в данных векторов, а признаки извлекаются заново только из плиток этих подложек
+    и добавляются с новыми faiss_id. Индекс не переобучается, время работы пропорционально размеру подложек
+    '''
+    metadata_store = load_metadata_store(extracting_features_config)
+    manifest = load_manifest(extracting_features_config, metadata_store)
+    stale_rows = metadata_store.layout_rows(layout_names)
+    tiles = collect_tiles(extracting_features_config.path_to_data, layout_names)
+    print(f'Плиток подложек {", ".join(layout_names)}: {len(tiles)}, заменяемых векторов: {len(stale_rows)}')
+
+    start_row = append_tiles(backend, db_faiss, tiles, extracting_features_config, metadata_store)
+
+    def save_manifest(end_row: int):
+        manifest.remove_rows(stale_rows.tolist())
+        for row, (path_to_tile, _) in enumerate(tiles[:end_row - start_row], start_row):
+            manifest.add(path_to_tile, row)
+        manifest.save(extracting_features_config.path_to_prepared_manifest)
+
+    apply_index_update(db_faiss, upload_queue, outbox, faiss_config, extracting_features_config, metadata_store,
+                       start_row, stale_rows, save_manifest)
+
+
+def append_tiles(backend: EmbeddingBackend, db_faiss: FAISS, tiles: List[Tuple[str, Dict]],
+                 extracting_features_config: ExtractingFeaturesConfig, metadata_store: TileMetadataStore) -> int:
+    '''Функция для дозаписи векторов признаков плиток после подготовленных векторов, возвращает первый новый faiss_id'''
+    # Индекс изменяется, поэтому читается в память целиком
+    db_faiss.load(mmap=False)
+    vector_store = NpyStore.open(extracting_features_config.path_to_prepared_vectors,
+                                 chunk_rows=extracting_features_config.prepared_vectors_chunk_rows)
+    start_row = len(vector_store)
+    if start_row < db_faiss.next_id:
+        raise RuntimeError(f'В индексе FAISS есть идентификаторы до {db_faiss.next_id - 1}, а подготовленных векторов '
+                           f'только {start_row}: новые faiss_id совпадут с существующими')
+    vector_store = extract_features(backend, tiles, extracting_features_config, metadata_store, vector_store)
+    vector_store.close()
+    return start_row
+
+
+def apply_index_update(db_faiss: FAISS, upload_queue: UploadQueue, outbox: UploadOutbox, faiss_config: FAISSConfig,
+                       extracting_features_config: ExtractingFeaturesConfig, metadata_store: TileMetadataStore,
+                       start_row: int, stale_rows: List[int], on_checkpoint: Callable[[int], None] = None):
+    '''
+    Функция для применения изменений к загруженному индексу FAISS: устаревшие вектора удаляются из индекса
+    и помечаются удаленными, вектора с faiss_id от `start_row` добавляются в индекс и отправляются на сервер.
+    Каждые `upload_checkpoint_rows` векторов индекс сохраняется вместе с журналом отправки, после чего
+    вызывается `on_checkpoint` с faiss_id, до которого вектора сохранены в индексе
+    '''
+    metadata_store.mark_deleted(stale_rows)
+    metadata_store.close()
+    vectors = NpyStore.load(extracting_features_config.path_to_prepared_vectors)
+    is_representative = find_duplicates(vectors, metadata_store, start_row, extracting_features_config)
+
+    print(f'Удалено векторов из FAISS: {db_faiss.remove(stale_rows)}')
+    db_faiss.update_refine_store(vectors)
+    db_faiss.update_id_filter(extracting_features_config.path_to_prepared_vectors_data)
+
+    blocks = split_blocks(start_row, len(vectors), faiss_config.block_size)
+    checkpoint_start = 0
+    for num_block, (start_block, end_block) in enumerate(blocks):
+        ids = start_block + np.flatnonzero(is_representative[start_block - start_row: end_block - start_row])
+        db_faiss.add(vectors[ids], ids=ids)
+
+        if end_block - blocks[checkpoint_start][0] >= extracting_features_config.upload_checkpoint_rows or \
+                num_block == len(blocks) - 1:
+            checkpoint_blocks = blocks[checkpoint_start: num_block + 1]
+            checkpoint(db_faiss, outbox, checkpoint_blocks, on_checkpoint and functools.partial(on_checkpoint, end_block))
+            upload_vectors(upload_queue, outbox, metadata_store, checkpoint_blocks)
+            checkpoint_start = num_block + 1
+    if not blocks:
+        checkpoint(db_faiss, outbox, [], on_checkpoint and functools.partial(on_checkpoint, start_row))
+
+    print(f'Количество векторов в FAISS: {db_faiss.index.ntotal}')
+    finish_uploads(upload_queue, outbox)
+
+
+def find_duplicates(vectors: np.ndarray, metadata_store: TileMetadataStore, start_row: int,
+                    extracting_features_config: ExtractingFeaturesConfig) -> np.ndarray:
+    '''
+    Функция для поиска почти одинаковых перекрывающихся плиток среди векторов с faiss_id от `start_row`
+    (если задан `dedup_threshold`). Представители групп записываются в данные векторов
+
+    Returns
+    -------------
+    `np.ndarray`
+        Маска (N - start_row,): True если вектор добавляется в индекс (представитель группы)
+    '''
+    rows = np.arange(start_row, len(vectors))
+    if extracting_features_config.dedup_threshold <= 0:
+        # Представители, записанные запуском с поиском дубликатов, не должны исключать строки из индекса и отправки
+        if np.any(metadata_store.aliases()[start_row:] != rows):
+            metadata_store.set_aliases(start_row, rows)
+        return np.ones(len(rows), dtype=bool)
+
+    aliases = find_aliases(vectors, metadata_store, start_row, len(vectors), extracting_features_config.dedup_threshold,
+                           extracting_features_config.dedup_min_overlap)
+    metadata_store.set_aliases(start_row, aliases)
+    print(f'Дубликатов перекрывающихся плиток: {np.count_nonzero(aliases != rows)} из {len(rows)}')
+    return aliases == rows
+
+
+def extract_prepared_vectors(backend: EmbeddingBackend, tiles: List[Tuple[str, Dict]],
+                             extracting_features_config: ExtractingFeaturesConfig, index_builder: IndexBuilder = None):
+    '''Функция для извлечения признаков плиток в подготовленные вектора, данные векторов и манифест плиток'''
+    metadata_store = TileMetadataStore.create(extracting_features_config.path_to_prepared_vectors_data)
+    vector_store = extract_features(backend, tiles, extracting_features_config, metadata_store,
+                                    index_builder=index_builder)
+
+    print('Записываю вектора на диск')
+    # Вектора признаков уже записаны на диск по мере извлечения, остается обрезать файл до их количества
+    if vector_store is None:
+        vector_store = NpyStore.create(extracting_features_config.path_to_prepared_vectors, (FAISSConfig.vector_dim,))
+    vector_store.close()
+
+    print('Записываю данные векторов на диск')
+    metadata_store.close()
+
+    manifest = TileManifest()
+    for row, (path_to_tile, _) in enumerate(tiles):
+        manifest.add(path_to_tile, row)
+    manifest.save(extracting_features_config.path_to_prepared_manifest)
+
+
+def partition_tiles(tiles: List[Tuple[str, Dict]], num_shards: int, shard_by: str,
+                    path_to_data: str) -> List[List[Tuple[str, Dict]]]:
+    '''
+    Функция для разбиения списка плиток на шарды
+
+    Parameters
+    -------------
+    tiles: `List[Tuple[str, Dict]]`
+        Пары (путь до плитки, сопутствующие данные плитки)
+    num_shards: `int`
+        Количество шардов
+    shard_by: `str`
+        Способ разбиения: `folder` - папки разрешений распределяются по шардам по кругу,
+        `hash` - по хешу пути плитки относительно каталога набора данных (равномерно, независимо от машины)
+    path_to_data: `str`
+        Путь до нарезанного набора данных
+    '''
+    shards = [[] for _ in range(num_shards)]
+    if shard_by == 'folder':
+        folders = sorted({os.path.relpath(path_to_tile, path_to_data).split(os.sep)[0] for path_to_tile, _ in tiles})
+        folder_shard = {folder: ind % num_shards for ind, folder in enumerate(folders)}
+        for path_to_tile, item in tiles:
+            shards[folder_shard[os.path.relpath(path_to_tile, path_to_data).split(os.sep)[0]]].append((path_to_tile, item))
+    elif shard_by == 'hash':
+        for path_to_tile, item in tiles:
+            relative_path = os.path.relpath(path_to_tile, path_to_data).replace(os.sep, '/')
+            shards[zlib.crc32(relative_path.encode('utf-8')) % num_shards].append((path_to_tile, item))
+    else:
+        raise ValueError(f'Неизвестный способ разбиения на шарды: {shard_by}')
+
+    return shards
+
+
+def get_shard_config(extracting_features_config: ExtractingFeaturesConfig, shard_index: int) -> ExtractingFeaturesConfig:
+    '''Функция для получения конфигурации шарда: шард пишет вектора, их данные и манифест в свой каталог'''
+    path_to_shard = os.path.join(extracting_features_config.path_to_shards, f'shard_{shard_index:03d}')
+    shard_config = copy.copy(extracting_features_config)
+    shard_config.path_to_prepared_vectors = os.path.join(path_to_shard, 'prepared_vectors.npy')
+    shard_config.path_to_prepared_vectors_data = os.path.join(path_to_shard, 'prepared_vectors_data')
+    shard_config.path_to_prepared_manifest = os.path.join(path_to_shard, 'prepared_vectors_manifest.json')
+    shard_config.path_to_exported_model = os.path.join(path_to_shard, 'embedding_net')
+    return shard_config
+
+
+def extract_shard(path_to_weight, name_model, shard_index: int, num_shards: int, num_intra_threads: int = 0):
+    '''Функция для извлечения признаков одного шарда плиток (в отдельном процессе или на отдельной машине)'''
+    extracting_features_config = ExtractingFeaturesConfig()
+    if num_intra_threads > 0:
+        extracting_features_config.num_intra_threads = num_intra_threads
+
+    tiles = collect_tiles(extracting_features_config.path_to_data)
+    tiles = partition_tiles(tiles, num_shards, extracting_features_config.shard_by,
+                            extracting_features_config.path_to_data)[shard_index]
+    print(f'Шард {shard_index + 1}/{num_shards}: {len(tiles)} плиток')
+
+    shard_config = get_shard_config(extracting_features_config, shard_index)
+    backend = create_backend(load_model(path_to_weight, name_model), shard_config)
+    extract_prepared_vectors(backend, tiles, shard_config)
+
+
+def run_shards(path_to_weight, name_model, num_shards: int):
+    '''Функция для параллельного извлечения признаков всех шардов в отдельных процессах'''
+    num_intra_threads = ExtractingFeaturesConfig.num_intra_threads or max(1, os.cpu_count() // num_shards)
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=num_shards, mp_context=context) as executor:
+        futures = [executor.submit(extract_shard, path_to_weight, name_model, shard_index, num_shards,
+                                   num_intra_threads)
+                   for shard_index in range(num_shards)]
+        for future in futures:
+            future.result()
+
+
+def merge_shards(extracting_features_config: ExtractingFeaturesConfig, num_shards: int):
+    '''
+    Функция для объединения шардов в подготовленные вектора. Шарды объединяются по порядку номеров,
+    поэтому faiss_id (номер строки) каждой плитки одинаков при любом количестве процессов и машин
+    '''
+    print(f'Объединяю {num_shards} шардов...')
+    vector_store = None
+    metadata_store = TileMetadataStore.create(extracting_features_config.path_to_prepared_vectors_data)
+    manifest = TileManifest()
+    chunk_rows = extracting_features_config.prepared_vectors_chunk_rows
+
+    for shard_index in range(num_shards):
+        shard_config = get_shard_config(extracting_features_config, shard_index)
+        if not os.path.exists(shard_config.path_to_prepared_manifest):
+            raise FileNotFoundError(f'Шард {shard_index} не найден или не завершен: {shard_config.path_to_prepared_manifest}')
+
+        vectors = NpyStore.load(shard_config.path_to_prepared_vectors)
+        if vector_store is None:
+            vector_store = NpyStore.create(extracting_features_config.path_to_prepared_vectors, vectors.shape[1:],
+                                           dtype=np.float32, chunk_rows=chunk_rows)
+        offset = len(vector_store)
+        for start in range(0, len(vectors), chunk_rows):
+            vector_store.append(vectors[start: start + chunk_rows])
+
+        metadata_store.extend(TileMetadataStore(shard_config.path_to_prepared_vectors_data))
+        for path_to_tile, (size, mtime_ns, row) in TileManifest.load(shard_config.path_to_prepared_manifest).entries.items():
+            manifest.add(path_to_tile, row + offset, (size, mtime_ns))
+        print(f'Шард {shard_index + 1}/{num_shards}: {len(vectors)} векторов, faiss_id с {offset}')
+
+    vector_store.close()
+    metadata_store.close()
+    manifest.save(extracting_features_config.path_to_prepared_manifest)
+
+
+def pipeline_replace_layouts(path_to_weight, name_model, layout_names: List[str]):
+    faiss_config = FAISSConfig()
+    extracting_features_config = ExtractingFeaturesConfig()
+    backend = create_backend(load_model(path_to_weight, name_model), extracting_features_config)
+    outbox = UploadOutbox(extracting_features_config.path_to_upload_outbox)
+    with create_upload_queue(extracting_features_config) as upload_queue:
+        replay_outbox(upload_queue, outbox, extracting_features_config)
+        replace_layouts(backend, FAISS(faiss_config), upload_queue, outbox, faiss_config, extracting_features_config,
+                        layout_names)
+
+
+def pipeline_extracting_features(path_to_weight, name_model, num_shards: int = 1, merge_only: bool = False):
+    faiss_config = FAISSConfig()
+    logger.info(f'\t\t Количество кластеров: {faiss_config.num_clusters}')
+    logger.info(f'\t\t Путь до модели: {path_to_weight}')
+
+    extracting_features_config = ExtractingFeaturesConfig()
+
+    upload_queue = create_upload_queue(extracting_features_config)
+    outbox = UploadOutbox(extracting_features_config.path_to_upload_outbox)
+
+    # Объявление faiss
+    db_faiss = FAISS(faiss_config)
+
+    if extracting_features_config.incremental_update and \
+            os.path.exists(extracting_features_config.path_to_prepared_vectors) and \
+            (os.path.exists(extracting_features_config.path_to_prepared_vectors_data) or
+             os.path.exists(extracting_features_config.path_to_prepared_vectors_data_json)) and \
+            os.path.exists(os.path.join(faiss_config.path_to_index, faiss_config.name_index)):
+        print('Инкрементальное обновление подготовленных векторов и индекса FAISS...')
+        backend = create_backend(load_model(path_to_weight, name_model), extracting_features_config)
+        replay_outbox(upload_queue, outbox, extracting_features_config)
+        update_prepared_vectors(backend, db_faiss, upload_queue, outbox, faiss_config, extracting_features_config)
+        upload_queue.close()
+        return
+
+    # Журнал с отметкой о сохранении индекса остался от прерванного построения: блоки, вошедшие в сохраненный индекс,
+    # отправляются повторно при любом load_prepared_vectors, а с сохраненными векторами построение продолжается
+    # со следующей строки без повторного извлечения, обучения и заполнения индекса
+    start_row = 0
+    if outbox.last_checkpoint() is not None and \
+            os.path.exists(os.path.join(faiss_config.path_to_index, faiss_config.name_index)):
+        db_faiss.load(mmap=False)
+        replay_outbox(upload_queue, outbox, extracting_features_config, db_faiss.next_id)
+        if extracting_features_config.load_prepared_vectors and \
+                os.path.exists(extracting_features_config.path_to_prepared_vectors):
+            start_row = db_faiss.next_id
+            print(f'Продолжение прерванного построения индекса FAISS со строки {start_row}')
+        else:
+            db_faiss = FAISS(faiss_config)
+    if not start_row:
+        # Все вектора будут отправлены заново
+        outbox.clear()
 
     if not extracting_features_config.load_prepared_vectors and os.path.exists(extracting_features_config.path_to_prepared_vectors):
         print('Удаляю предварительно подготовленные вектора')
@@ -95,92 +708,117 @@ def pipeline_extracting_features(path_to_weight, name_model):
 
     if not extracting_features_config.load_prepared_vectors and os.path.exists(extracting_features_config.path_to_prepared_vectors_data):
         print('Удаляю данные предварительно подготовленных векторов...')
-        os.remove(extracting_features_config.path_to_prepared_vectors_data)
+        shutil.rmtree(extracting_features_config.path_to_prepared_vectors_data)
 
-    if not extracting_features_config.load_prepared_vectors or not os.path.exists(extracting_features_config.path_to_prepared_vectors):
+    # Индекс обучается на резервуарной выборке, собираемой по мере извлечения векторов
+    # Индекс в памяти с инвертированными списками на диске строится только блоками
+    num_block_workers = max(faiss_config.num_block_workers, int(faiss_config.ondisk_index))
+    index_builder = IndexBuilder(db_faiss, faiss_config.train_sample_size, faiss_config.train_after_vectors,
+                                 faiss_config.block_size, num_block_workers=num_block_workers)
+    index_builder.num_added = start_row
 
-        for folder_crop in os.listdir(ExtractingFeaturesConfig.path_to_data):
-            if folder_crop == 'crop_10x10':
-                continue
-
-            path_to_folder_crop = os.path.join(ExtractingFeaturesConfig.path_to_data, folder_crop)
-
-            for folder_layout_crop in os.listdir(path_to_folder_crop):
-                print(folder_layout_crop)
-                path_to_layout_crop = os.path.join(path_to_folder_crop, folder_layout_crop)
-
-                for filename in tqdm(os.listdir(path_to_layout_crop),
-                                     desc=f'Перебираю файлы в папке {folder_crop}/{folder_layout_crop}',
-                                     ncols=180):
-                    path_to_filename = os.path.join(path_to_layout_crop, filename)
-                    image, polygon = read_image(path_to_filename)
-
-                    image = convert_tif2img(path_to_filename, (1,2,3))
-                    with torch.no_grad():
-                        feature_vector = model.predict(image, device=device)
-                        feature_vector = feature_vector.cpu().detach().numpy()
-
-                    try:
-                        train_vector = np.vstack((train_vector, feature_vector))
-                    except ValueError as e:
-                        print(f'Произошла ошибка: {e}. Был неверно указан размер векторов и он автоматически исправлен. ')
-                        train_vector = np.empty((0, feature_vector.shape[1]))
-                        train_vector = np.vstack((train_vector, feature_vector))
-                        faiss_config.vector_dim = feature_vector.shape[1]
-
-                    dim_space_x, dim_space_y = folder_crop.replace("crop_", "").split("x")
-                    data.append({
-                        'faiss_id': None,
-                        "polygon_coordinates": str(polygon),
-                        "layout_name": folder_layout_crop.replace('_crop', ''),
-                        "dim_space_x": int(dim_space_x),
-                        "dim_space_y": int(dim_space_y),
-                        "filename": filename
-                    })
-
-
-        print('Записываю вектора на диск')
-        # Запись векторов признаков на диск
-        np.save(extracting_features_config.path_to_prepared_vectors, train_vector)
-
-        print('Записываю данные векторов на диск')
-        # Запись данных векторов на диск
-        with open(extracting_features_config.path_to_prepared_vectors_data, 'w') as f:
-            json.dump(data, f)
+    if start_row:
+        print('Загружаю предварительно полученные вектора...')
+    elif num_shards > 1:
+        if not merge_only:
+            run_shards(path_to_weight, name_model, num_shards)
+        merge_shards(extracting_features_config, num_shards)
+    elif not extracting_features_config.load_prepared_vectors or not os.path.exists(extracting_features_config.path_to_prepared_vectors):
+        tiles = collect_tiles(extracting_features_config.path_to_data)
+        print(f'Количество плиток для извлечения признаков: {len(tiles)}')
+        backend = create_backend(load_model(path_to_weight, name_model), extracting_features_config)
+        print(f'Бэкенд инференса: {backend.name}')
+        extract_prepared_vectors(backend, tiles, extracting_features_config, index_builder)
     else:
         print('Загружаю предварительно полученные вектора...')
-        # Загрузка веторов признаков
-        train_vector = np.load(extracting_features_config.path_to_prepared_vectors)
-
-        print('Загружаю предварительно полученные данные векторов...')
-        # Загрузка данных векторов с диска
-        with open(extracting_features_config.path_to_prepared_vectors_data, 'r') as f:
-            data = json.load(f)
-
-    print(f'Количество векторов для обучения FAISS {train_vector.shape}')
-    print('Обучение FAISS...')
-    print(f'Размер выборки для обучения: {train_vector.shape}')
-    db_faiss.training(train_vectors=train_vector)
-    print("Обучение заверешно...")
-
-    for start_block in range(0, train_vector.shape[0], faiss_config.block_size):
-        # print(f'start {start_block} end {start_block + faiss_config.block_size}')
-        index = db_faiss.add(train_vector[start_block: start_block + faiss_config.block_size])
-        for ind_data, ind_vec in zip(range(start_block, start_block + faiss_config.block_size), index):
-            data[ind_data]['faiss_id'] = ind_vec
-            data[ind_data]['layout_name'] = '_'.join(data[ind_data]['layout_name'].split('_')[:2])
-
-        response = send_data_for_server(api_client, data[start_block: start_block + faiss_config.block_size])
-
-        if not 200 <= response.status_code < 300:
-            raise "Ошибка при добавлении слоя в БД"
-        # print(response.json())
-    print(f'Количество векторов в FAISS: {db_faiss.index.ntotal}')
-    db_faiss.save()
 
+    # Загрузка веторов признаков
+    train_vector = NpyStore.load(extracting_features_config.path_to_prepared_vectors)
+
+    print('Загружаю данные векторов...')
+    metadata_store = load_metadata_store(extracting_features_config)
+
+    # Если вектора не проходили через построитель индекса во время извлечения, выборка формируется по файлу
+    if not index_builder.is_trained and index_builder.sampler.num_seen != train_vector.shape[0]:
+        index_builder.update_from(train_vector, extracting_features_config.prepared_vectors_chunk_rows)
+
+    # Вектора дубликатов и подложек, замененных без перестроения индекса, остаются в подготовленных векторах,
+    # но в индекс не попадают (построитель добавляет вектора по мере извлечения, поэтому они удаляются после)
+    find_duplicates(train_vector, metadata_store, 0, extracting_features_config)
+    excluded_rows = get_excluded_rows(metadata_store)
+
+    # Каждые upload_checkpoint_rows добавленных векторов индекс сохраняется вместе с журналом отправки,
+    # после чего добавленные блоки отправляются, пока в индекс добавляются следующие
+    saved_rows = start_row
+
+    def upload_saved_blocks(end: int):
+        nonlocal saved_rows
+        blocks = split_blocks(saved_rows, end, faiss_config.block_size)
+        checkpoint(index_builder.db_faiss, outbox, blocks)
+        upload_vectors(upload_queue, outbox, metadata_store, blocks, excluded_rows)
+        saved_rows = end
+
+    def add_block(start: int, end: int):
+        if end - saved_rows >= extracting_features_config.upload_checkpoint_rows:
+            upload_saved_blocks(end)
+
+    print(f'Количество векторов для добавления в FAISS {train_vector.shape}')
+    db_faiss = index_builder.finish(train_vector, extracting_features_config.path_to_prepared_vectors, add_block)
+    db_faiss.remove(excluded_rows)
+    db_faiss.update_refine_store(train_vector, rebuild=True)
+    db_faiss.update_id_filter(extracting_features_config.path_to_prepared_vectors_data)
+    print(f'Количество векторов в FAISS: {db_faiss.index.ntotal}')
+    upload_saved_blocks(train_vector.shape[0])
+    finish_uploads(upload_queue, outbox)
+    upload_queue.close()
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Извлечение признаков из плиток подложки и загрузка их в FAISS')
+    parser.add_argument('--benchmark-batch-sizes', type=int, nargs='+', default=None,
+                        help='Замерить скорость извлечения признаков для указанных размеров пакета и завершить работу')
+    parser.add_argument('--compare-backends', type=str, nargs='+', default=None,
+                        help='Сравнить бэкенды инференса (например: torchscript torchscript-int8 onnx onnx-int8) '
+                             'с eager float32 по скорости и отклонению векторов и завершить работу')
+    parser.add_argument('--benchmark-num-images', type=int, default=256,
+                        help='Количество плиток, на которых производится замер скорости')
+    parser.add_argument('--num-shards', type=int, default=1,
+                        help='Количество шардов извлечения признаков. Без --shard-index все шарды обрабатываются '
+                             'параллельно в отдельных процессах, после чего объединяются')
+    parser.add_argument('--shard-index', type=int, default=None,
+                        help='Извлечь признаки только указанного шарда (например, на отдельной машине) и завершить работу')
+    parser.add_argument('--merge', action='store_true',
+                        help='Не извлекать признаки, а объединить готовые шарды и продолжить построение индекса')
+    parser.add_argument('--replace-layouts', type=str, nargs='+', default=None,
+                        help='Заменить вектора указанных подложек (названия каталогов без _crop) в существующем '
+                             'индексе, извлекая признаки только из их плиток')
+    args = parser.parse_args()
 
     path_to_weight = os.getenv('PATH_TO_WEIGHT', './weights/resnet50_2_cosine_similarity.pth')
     name_model = os.getenv('NAME_MODEL', 'resnet50')
-    pipeline_extracting_features(path_to_weight, name_model)
+
+    if args.benchmark_batch_sizes or args.compare_backends:
+        extracting_features_config = ExtractingFeaturesConfig()
+        model = load_model(path_to_weight, name_model)
+        images = []
+        for root, _, files in os.walk(extracting_features_config.path_to_data):
+            for filename in files[:args.benchmark_num_images - len(images)]:
+                images.append(convert_tif2img(os.path.join(root, filename), (1, 2, 3)))
+            if len(images) >= args.benchmark_num_images:
+                break
+
+        if args.benchmark_batch_sizes:
+            benchmark_batch_sizes(create_backend(model, extracting_features_config), images,
+                                  args.benchmark_batch_sizes)
+        if args.compare_backends:
+            batch_size = extracting_features_config.batch_size
+            batches = [to_batch(images[start: start + batch_size]) for start in range(0, len(images), batch_size)]
+            backends = [create_backend(model, extracting_features_config, name.replace('-int8', ''),
+                                       name.endswith('-int8'))
+                        for name in args.compare_backends]
+            compare_backends(create_backend(model, extracting_features_config, 'eager', False), backends, batches)
+    elif args.replace_layouts:
+        pipeline_replace_layouts(path_to_weight, name_model, args.replace_layouts)
+    elif args.shard_index is not None:
+        extract_shard(path_to_weight, name_model, args.shard_index, args.num_shards)
+    else:
+        pipeline_extracting_features(path_to_weight, name_model, args.num_shards, args.merge)
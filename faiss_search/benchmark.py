@@ -0,0 +1,150 @@
+'''
+Данный скрипт содержит замер времени загрузки индекса FAISS, занимаемой им памяти и задержки поиска
+при загрузке индекса целиком и через mmap, в холодном (файлы вытеснены из кэша ОС) и теплом кэше
+
+Запуск из корня репозитория: python -m faiss_search.benchmark --num-queries 200 --k 10
+'''
+import argparse
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict
+import numpy as np
+from config import ExtractingFeaturesConfig, FAISSConfig
+from faiss_search.faiss_interface import FAISS
+
+
+def index_files(faiss_config: FAISSConfig):
+    '''Функция для получения путей до файлов индекса (сам индекс и инвертированные списки на диске, если есть)'''
+    paths = [os.path.join(faiss_config.path_to_index, name)
+             for name in (faiss_config.name_index, faiss_config.name_ivfdata)]
+    return [path for path in paths if os.path.exists(path)]
+
+
+def drop_page_cache(faiss_config: FAISSConfig):
+    '''Функция для вытеснения файлов индекса из кэша страниц ОС (posix_fadvise DONTNEED, права root не нужны)'''
+    for path in index_files(faiss_config):
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        finally:
+            os.close(fd)
+
+
+def warm_page_cache(faiss_config: FAISSConfig):
+    '''Функция для чтения файлов индекса, чтобы они оказались в кэше страниц ОС'''
+    for path in index_files(faiss_config):
+        with open(path, 'rb') as f:
+            while f.read(1 << 24):
+                pass
+
+
+def get_rss_mb() -> float:
+    '''Функция для получения резидентной памяти текущего процесса (МБ)'''
+    with open('/proc/self/status', 'r') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) / 1024
+    return float('nan')
+
+
+def measure(mmap: bool, cold: bool, queries: np.ndarray, k: int, repeats: int) -> Dict[str, float]:
+    '''
+    Функция для замера одного режима загрузки (выполняется в отдельном процессе, чтобы память и кэш
+    индекса предыдущего замера не влияли на результат)
+
+    Parameters
+    -------------
+    mmap: `bool`
+        True если загружать индекс через mmap
+    cold: `bool`
+        True если перед загрузкой вытеснить файлы индекса из кэша ОС
+    queries: `np.ndarray`
+        Запросы (N, D), ищутся по одному
+    k: `int`
+        Количество ближайших соседей
+    repeats: `int`
+        Количество повторных проходов по запросам после первого
+
+    Returns
+    -------------
+    `Dict[str, float]`
+        Время загрузки (с), прирост памяти (МБ), медиана и 99-й перцентиль задержки первого и повторных проходов (мс)
+    '''
+    faiss_config = FAISSConfig()
+    if cold:
+        drop_page_cache(faiss_config)
+    else:
+        warm_page_cache(faiss_config)
+
+    rss_before = get_rss_mb()
+    start_time = time.perf_counter()
+    db_faiss = FAISS(faiss_config)
+    db_faiss.load(mmap=mmap)
+    load_time = time.perf_counter() - start_time
+    rss_after_load = get_rss_mb()
+
+    def run_pass():
+        latencies = []
+        for query in queries:
+            start_query = time.perf_counter()
+            db_faiss.search(query[None], k)
+            latencies.append((time.perf_counter() - start_query) * 1000)
+        return np.array(latencies)
+
+    first_pass = run_pass()
+    warm_passes = np.concatenate([run_pass() for _ in range(repeats)]) if repeats else first_pass
+
+    return {'load_s': load_time,
+            'rss_mb': rss_after_load - rss_before,
+            'first_p50_ms': float(np.percentile(first_pass, 50)),
+            'first_p99_ms': float(np.percentile(first_pass, 99)),
+            'warm_p50_ms': float(np.percentile(warm_passes, 50)),
+            'warm_p99_ms': float(np.percentile(warm_passes, 99))}
+
+
+def load_queries(num_queries: int, vector_dim: int, seed: int = 0) -> np.ndarray:
+    '''Функция для получения запросов: случайные подготовленные вектора, если они есть, иначе случайные вектора'''
+    rng = np.random.default_rng(seed)
+    path_to_vectors = ExtractingFeaturesConfig.path_to_prepared_vectors
+    if os.path.exists(path_to_vectors):
+        vectors = np.load(path_to_vectors, mmap_mode='r')
+        rows = np.sort(rng.choice(len(vectors), size=min(num_queries, len(vectors)), replace=False))
+        return np.asarray(vectors[rows], dtype=np.float32)
+    return rng.standard_normal((num_queries, vector_dim)).astype(np.float32)
+
+
+def benchmark_load_modes(num_queries: int = 200, k: int = 10, repeats: int = 3):
+    '''Функция для сравнения загрузки индекса целиком и через mmap в холодном и теплом кэше ОС'''
+    faiss_config = FAISSConfig()
+    queries = load_queries(num_queries, faiss_config.vector_dim)
+    size_mb = sum(os.path.getsize(path) for path in index_files(faiss_config)) / 2 ** 20
+    print(f'Размер файлов индекса: {size_mb:.1f} МБ, запросов: {len(queries)}, k={k}')
+
+    header = f'{"режим":<8}{"кэш":<10}{"загрузка, с":>13}{"память, МБ":>12}' \
+             f'{"1-й p50, мс":>13}{"1-й p99, мс":>13}{"p50, мс":>10}{"p99, мс":>10}'
+    print(header)
+    context = multiprocessing.get_context('spawn')
+    results = {}
+    for mmap in (False, True):
+        for cold in (True, False):
+            with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                result = executor.submit(measure, mmap, cold, queries, k, repeats).result()
+            results[('mmap' if mmap else 'full', 'cold' if cold else 'warm')] = result
+            print(f'{"mmap" if mmap else "full":<8}{"холодный" if cold else "теплый":<10}'
+                  f'{result["load_s"]:>13.3f}{result["rss_mb"]:>12.1f}'
+                  f'{result["first_p50_ms"]:>13.2f}{result["first_p99_ms"]:>13.2f}'
+                  f'{result["warm_p50_ms"]:>10.2f}{result["warm_p99_ms"]:>10.2f}')
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Замер загрузки индекса FAISS целиком и через mmap')
+    parser.add_argument('--num-queries', type=int, default=200, help='Количество запросов')
+    parser.add_argument('--k', type=int, default=10, help='Количество ближайших соседей')
+    parser.add_argument('--repeats', type=int, default=3, help='Количество повторных проходов по запросам')
+    args = parser.parse_args()
+
+    benchmark_load_modes(args.num_queries, args.k, args.repeats)
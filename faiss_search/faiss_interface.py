@@ -1,33 +1,126 @@
 '''https://habr.com/ru/companies/okkamgroup/articles/509204/'''
-from typing import List, Union
+from contextlib import contextmanager
+from typing import List, Tuple, Union
+from concurrent.futures import ProcessPoolExecutor
+import itertools
+import json
+import multiprocessing
 import faiss
+from faiss.contrib.ondisk import merge_ondisk
 import numpy as np
 from config import FAISSConfig
+from faiss_search.refine_store import RefineStore, MISSING_DISTANCE
+from faiss_search.id_filter import IdFilter
 import os
 import shutil
 from pathlib import Path
 
 
+# Параметры поиска, не перебираемые при настройке (порог полисемантического поиска без полисемантического обучения)
+EXCLUDED_SEARCH_PARAMS = ('ht',)
+
+
+def create_index(vector_dim: int, index_factory: str, num_clusters: int) -> faiss.Index:
+    '''
+    Функция для создания индекса по строке фабрики FAISS (`{num_clusters}` подставляется из конфигурации)
+    с метрикой скалярного произведения. Индексы без инвертированных списков (HNSW, Flat) оборачиваются в IDMap,
+    чтобы faiss_id вектора можно было задать явно
+    '''
+    index_factory = index_factory.format(num_clusters=int(num_clusters))
+    index = faiss.index_factory(vector_dim, index_factory, faiss.METRIC_INNER_PRODUCT)
+    if faiss.try_extract_index_ivf(index) is None and not isinstance(index, faiss.IndexIDMap):
+        index = faiss.index_factory(vector_dim, f'IDMap,{index_factory}', faiss.METRIC_INNER_PRODUCT)
+    return index
+
+
+def get_search_parameter_space(index: faiss.Index):
+    '''Функция для получения индекса, к которому применяются параметры поиска, и пространства его параметров'''
+    if isinstance(index, faiss.IndexIDMap):
+        index = faiss.downcast_index(index.index)
+    parameter_space = faiss.ParameterSpace()
+    parameter_space.initialize(index)
+    return index, parameter_space
+
+
+def get_search_param_combinations(index: faiss.Index) -> List[str]:
+    '''Функция для перечисления всех сочетаний параметров поиска индекса в виде строк ParameterSpace'''
+    _, parameter_space = get_search_parameter_space(index)
+    ranges = []
+    for num_range in range(parameter_space.parameter_ranges.size()):
+        parameter_range = parameter_space.parameter_ranges.at(num_range)
+        if parameter_range.name not in EXCLUDED_SEARCH_PARAMS:
+            values = faiss.vector_to_array(parameter_range.values)
+            ranges.append([f'{parameter_range.name}={value:g}' for value in values])
+    return [','.join(combination) for combination in itertools.product(*ranges)]
+
+
+def set_search_params(index: faiss.Index, params: str):
+    '''Функция для применения параметров поиска вида `nprobe=16` или `efSearch=64` (пустая строка - без изменений)'''
+    if params:
+        index, parameter_space = get_search_parameter_space(index)
+        parameter_space.set_index_parameters(index, params)
+
+
+@contextmanager
+def omp_num_threads(num_threads: int = None):
+    '''Контекст для временного ограничения количества потоков OpenMP (настройка общая для процесса)'''
+    if not num_threads:
+        yield
+        return
+    previous_num_threads = faiss.omp_get_max_threads()
+    faiss.omp_set_num_threads(num_threads)
+    try:
+        yield
+    finally:
+        faiss.omp_set_num_threads(previous_num_threads)
+
+
+def _create_block(path_to_trained_index: str, path_to_vectors: str, start: int, end: int, chunk_rows: int,
+                  path_to_block: str, num_threads: int) -> str:
+    '''
+    Функция для заполнения блока индекса (выполняется в отдельном процессе): копия обученного индекса
+    заполняется строками [start, end) файла векторов с faiss_id = номер строки и сохраняется на диск
+    '''
+    faiss.omp_set_num_threads(num_threads)
+    index = faiss.read_index(path_to_trained_index)
+    vectors = np.load(path_to_vectors, mmap_mode='r')
+    for start_chunk in range(start, end, chunk_rows):
+        end_chunk = min(start_chunk + chunk_rows, end)
+        data = np.array(vectors[start_chunk: end_chunk], dtype='float32', order='C')
+        faiss.normalize_L2(data)
+        index.add_with_ids(data, np.arange(start_chunk, end_chunk, dtype='int64'))
+    faiss.write_index(index, path_to_block)
+    return path_to_block
+
+
 class FAISS:
     def __init__(self, parameters: FAISSConfig):
         self.parameters: FAISSConfig = parameters
-        self.index = faiss.index_factory(self.parameters.vector_dim, f"IVF{int(self.parameters.num_clusters)},PQ64", faiss.METRIC_INNER_PRODUCT)
+        self.index = create_index(self.parameters.vector_dim, self.parameters.index_factory, self.parameters.num_clusters)
+        self.search_params = ''
+        self.refine_store = None
+        self.id_filter = None
+        self._sorted_inverted_lists = None
 
-        self._cur_vectors = np.empty((0, self.parameters.vector_dim))
-        self._cur_vectors_ind = np.array([], dtype=np.int8)
         self._cur_ind = 0
         self._cur_num_block = 0
         self.ntotal = None
         # if self.parameters.overwriting_indexes and os.path.exists(self.parameters.path_to_index):
         #     shutil.rmtree(self.parameters.path_to_index)
 
+    @property
+    def index_factory(self) -> str:
+        '''Строка фабрики индекса с подставленным количеством кластеров'''
+        return self.parameters.index_factory.format(num_clusters=int(self.parameters.num_clusters))
+
     def normalize(self, vectors):
         # Нормализация векторов для косинусного расстояния
         faiss.normalize_L2(vectors)
         return vectors
 
     def training(self, train_vectors: np.array):
-        self.index.train(train_vectors)
+        # Обучение на тех же нормализованных векторах, что добавляются в индекс и ищутся
+        self.index.train(self.normalize(np.array(train_vectors, dtype='float32', order='C')))
         self._save_index(os.path.join(self.parameters.path_to_index, self.parameters.trained_index))
         assert self.index.is_trained
 
@@ -40,71 +133,477 @@ class FAISS:
 
         faiss.write_index(self.index, path_to_save)
 
-    # def _create_block(self):
-    #     '''Функция для создания блока индекса'''
-    #     # os.makedirs(self.parameters.path_to_block_index, exist_ok=True)
-    #
-    #     if self._cur_vectors.shape[0] == 0:
-    #         return
-    #
-    #     # index = faiss.read_index(os.path.join(self.parameters.path_to_index, self.parameters.trained_index))
-    #
-    #     self.index.add_with_ids(self._cur_vectors, self._cur_vectors_ind)
-    #     # faiss.write_index(index,
-    #     #                   os.path.join(self.parameters.path_to_block_index, f"block_{self._cur_num_block}.index"))
-    #
-    #     # Обновление информации
-    #     self._cur_num_block += 1
-    #     self._cur_vectors = np.empty((0, self.parameters.vector_dim))
-    #     self._cur_vectors_ind = np.array([])
-
-    def add(self, data: np.array):
-        shape = data.shape
-        if len(shape) == 1:
-            data = [data]
-
-        data = self.normalize(data.astype('float32'))
-
-        mas_data = []
-        indexes = []
-        for item in data:
-            # self.index.add_with_ids(np.array([item]), np.array([self._cur_ind]))
-            indexes.append(self._cur_ind)
-            mas_data.append(item)
-            self._cur_ind += 1
-
-        self.index.add_with_ids(np.array(mas_data), np.array(indexes))
+    @property
+    def next_id(self) -> int:
+        '''Идентификатор, который будет присвоен следующему вектору при добавлении без явных идентификаторов'''
+        return self._cur_ind
+
+    def add(self, data: np.array, ids: Union[range, List[int], np.ndarray] = None) -> np.ndarray:
+        '''
+        Функция для добавления векторов в индекс
+
+        Parameters
+        -------------
+        data: `np.array`
+            Вектора (N, D) или один вектор (D,)
+        ids: `Union[range, List[int], np.ndarray]`
+            Идентификаторы векторов. Если не заданы, выделяется диапазон, начиная с `next_id`
+
+        Returns
+        -------------
+        `np.ndarray`
+            Идентификаторы добавленных векторов (int64)
+        '''
+        # Единственная копия: float32, C-порядок, далее нормализуется на месте и передается в FAISS как есть
+        data = self.normalize(np.array(np.atleast_2d(data), dtype='float32', order='C'))
+
+        if ids is None:
+            indexes = np.arange(self._cur_ind, self._cur_ind + data.shape[0], dtype='int64')
+        elif isinstance(ids, range):
+            indexes = np.arange(ids.start, ids.stop, ids.step, dtype='int64')
+        else:
+            indexes = np.ascontiguousarray(ids, dtype='int64')
+
+        if len(indexes) != data.shape[0]:
+            raise ValueError(f'Количество идентификаторов ({len(indexes)}) не совпадает с количеством векторов ({data.shape[0]})')
+        if len(indexes) == 0:
+            return indexes
+
+        self.index.add_with_ids(data, indexes)
+        self._cur_ind = max(self._cur_ind, int(indexes.max()) + 1)
+        self._sorted_inverted_lists = None
         return indexes
 
-    # def _merge_block(self):
-    #     final_index = faiss.read_index(os.path.join(self.parameters.path_to_index, self.parameters.trained_index))
-    #     # ivfs = []
-    #     for num_block in range(self._cur_num_block):
-    #         block_index = faiss.read_index(
-    #             os.path.join(self.parameters.path_to_block_index, f"block_{num_block}.index"))
-    #         # ivfs.append(block_index.invlists)
-    #         final_index.merge_from(block_index, num_block)
-    #         block_index.own_invlists = False
-    #
-    #     final_index.ntotal = sum(
-    #         block_index.ntotal for block_index in
-    #         [faiss.read_index(os.path.join(self.parameters.path_to_block_index, f"block_{num_block}.index"))
-    #          for num_block in range(self._cur_num_block)])
-    #     return final_index
+    def remove(self, ids: List[int]) -> int:
+        '''Функция для удаления векторов из индекса по их идентификаторам. Возвращает количество удаленных векторов'''
+        if len(ids) == 0:
+            return 0
+        num_removed = self.index.remove_ids(np.array(ids, dtype='int64'))
+        self._sort_inverted_lists()
+        self._sorted_inverted_lists = None
+        return num_removed
+
+    def add_blocks(self, path_to_vectors: str, start: int = 0, end: int = None, num_workers: int = 1) -> int:
+        '''
+        Функция для параллельного построения индекса блоками: процессы заполняют копии обученного индекса
+        (`trained_index`) своими диапазонами строк файла векторов, после чего блоки объединяются. Если задан
+        `ondisk_index`, инвертированные списки объединенного индекса хранятся в файле `name_ivfdata` на диске,
+        что позволяет строить индексы больше оперативной памяти
+
+        Parameters
+        -------------
+        path_to_vectors: `str`
+            Путь до файла векторов .npy, faiss_id вектора - номер его строки
+        start: `int`
+            Первая добавляемая строка
+        end: `int`
+            Строка, до которой добавляются вектора (по умолчанию - до конца файла)
+        num_workers: `int`
+            Количество процессов заполнения блоков
+
+        Returns
+        -------------
+        `int`
+            Количество векторов в индексе
+        '''
+        assert self.index.ntotal == 0, 'Блоки объединяются только в пустой обученный индекс'
+        assert faiss.try_extract_index_ivf(self.index) is not None, 'Блоками строятся только индексы IVF'
+        if end is None:
+            end = len(np.load(path_to_vectors, mmap_mode='r'))
+        path_to_trained_index = os.path.join(self.parameters.path_to_index, self.parameters.trained_index)
+        if not os.path.exists(path_to_trained_index):
+            self._save_index(path_to_trained_index)
+
+        if os.path.exists(self.parameters.path_to_block_index):
+            shutil.rmtree(self.parameters.path_to_block_index)
+        os.makedirs(self.parameters.path_to_block_index, exist_ok=True)
+
+        num_workers = max(1, num_workers)
+        num_threads = max(1, (os.cpu_count() or 1) // num_workers)
+        blocks = [(start_block, min(start_block + self.parameters.index_block_rows, end))
+                  for start_block in range(start, end, self.parameters.index_block_rows)]
+        with ProcessPoolExecutor(max_workers=num_workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+            futures = [executor.submit(_create_block, path_to_trained_index, path_to_vectors, start_block, end_block,
+                                       self.parameters.block_size,
+                                       os.path.join(self.parameters.path_to_block_index, f'block_{num_block}.index'),
+                                       num_threads)
+                       for num_block, (start_block, end_block) in enumerate(blocks)]
+            self._cur_num_block = len(futures)
+            self.index = self._merge_block([future.result() for future in futures])
+
+        shutil.rmtree(self.parameters.path_to_block_index)
+        if blocks:
+            self._cur_ind = max(self._cur_ind, blocks[-1][1])
+        self._sorted_inverted_lists = None
+        return self.index.ntotal
+
+    def _merge_block(self, paths_to_blocks: List[str]):
+        '''Функция для объединения заполненных блоков в обученный индекс (в памяти или с инвертированными списками на диске)'''
+        final_index = faiss.read_index(os.path.join(self.parameters.path_to_index, self.parameters.trained_index))
+        if self.parameters.ondisk_index:
+            path_to_ivfdata = os.path.join(self.parameters.path_to_index, self.parameters.name_ivfdata)
+            if os.path.exists(path_to_ivfdata):
+                os.remove(path_to_ivfdata)
+            merge_ondisk(final_index, paths_to_blocks, path_to_ivfdata)
+            return final_index
+
+        for path_to_block in paths_to_blocks:
+            block_index = faiss.read_index(path_to_block)
+            final_index.merge_from(block_index, 0)
+        return final_index
 
     def save(self):
         # self._create_block()
         # self.index = self._merge_block()
         self._save_index(os.path.join(self.parameters.path_to_index, self.parameters.name_index))
+        self._save_next_id()
+
+    def load(self, mmap: bool = None):
+        '''
+        Функция для загрузки индекса
 
-    def load(self):
-        self.index = faiss.read_index(os.path.join(self.parameters.path_to_index, self.parameters.name_index))
+        Parameters
+        -------------
+        mmap: `bool`
+            True если отображать инвертированные списки индекса в память только для чтения, а не читать файл целиком:
+            время загрузки не зависит от размера индекса, а страницы файла в кэше ОС общие для всех процессов.
+            Такой индекс нельзя изменять (add/remove). По умолчанию берется из `mmap_index` конфигурации
+        '''
+        if mmap is None:
+            mmap = self.parameters.mmap_index
+        # Инвертированные списки, хранящиеся на диске, ищутся рядом с файлом индекса (индекс можно переносить)
+        io_flags = faiss.IO_FLAG_ONDISK_SAME_DIR
+        if mmap:
+            io_flags |= faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY
+        self.index = faiss.read_index(os.path.join(self.parameters.path_to_index, self.parameters.name_index), io_flags)
+        self.search_params = self._load_search_params()
+        set_search_params(self.index, self.search_params)
+        if os.path.exists(self._path_to_refine_store + '.json'):
+            self.refine_store = RefineStore(self._path_to_refine_store)
+        if os.path.exists(self._path_to_id_filter):
+            self.id_filter = IdFilter(self._path_to_id_filter)
+        self._sorted_inverted_lists = None
         self.ntotal = self.index.ntotal
+        self._cur_ind = self._load_next_id()
+
+    @property
+    def _path_to_id_filter(self):
+        return os.path.join(self.parameters.path_to_index, self.parameters.name_id_filter)
+
+    def update_id_filter(self, path_to_metadata_store: str):
+        '''Функция для сохранения рядом с индексом данных плиток, необходимых для фильтрации по подложке и разрешению'''
+        self.id_filter = IdFilter.build(self._path_to_id_filter, path_to_metadata_store)
 
-    def search(self, query_vectors: np.array, k: int):
-        query_vectors = self.normalize(query_vectors.astype('float32'))
-        distances, indices = self.index.search(query_vectors, k)
+    @property
+    def _path_to_refine_store(self):
+        return os.path.join(self.parameters.path_to_index, self.parameters.name_refine_store)
+
+    def update_refine_store(self, vectors: np.ndarray, rebuild: bool = False):
+        '''
+        Функция для записи векторов в хранилище переранжирования (если задан тип `refine_store`):
+        дописываются строки vectors, которых еще нет в хранилище, при rebuild хранилище создается заново
+
+        Parameters
+        -------------
+        vectors: `np.ndarray`
+            Все подготовленные вектора (строка - faiss_id), например memmap файла векторов
+        rebuild: `bool`
+            True если пересоздать хранилище
+        '''
+        qtype = self.parameters.refine_store
+        if not qtype:
+            return
+        if self.refine_store is None and os.path.exists(self._path_to_refine_store + '.json'):
+            self.refine_store = RefineStore(self._path_to_refine_store)
+
+        if rebuild or self.refine_store is None or self.refine_store.qtype != qtype or len(self.refine_store) > len(vectors):
+            self.refine_store = RefineStore.build(self._path_to_refine_store, vectors, qtype,
+                                                  train_size=self.parameters.train_sample_size)
+        else:
+            self.refine_store.append(vectors[len(self.refine_store):])
+
+    @property
+    def _path_to_next_id(self):
+        return os.path.join(self.parameters.path_to_index, self.parameters.name_next_id)
+
+    def _save_next_id(self):
+        path_to_tmp = self._path_to_next_id + '.tmp'
+        with open(path_to_tmp, 'w') as f:
+            json.dump({'next_id': self._cur_ind}, f)
+        os.replace(path_to_tmp, self._path_to_next_id)
+
+    def _load_next_id(self) -> int:
+        '''Функция для чтения счетчика идентификаторов. Для индексов, сохраненных без него, берется максимальный id + 1'''
+        if os.path.exists(self._path_to_next_id):
+            with open(self._path_to_next_id, 'r') as f:
+                return int(json.load(f)['next_id'])
+
+        if isinstance(self.index, faiss.IndexIDMap):
+            ids = faiss.vector_to_array(self.index.id_map)
+            return int(ids.max()) + 1 if len(ids) else 0
+
+        index_ivf = faiss.extract_index_ivf(self.index)
+        invlists = index_ivf.invlists
+        next_id = 0
+        for list_no in range(invlists.nlist):
+            list_size = invlists.list_size(list_no)
+            if list_size:
+                ids = faiss.rev_swig_ptr(invlists.get_ids(list_no), list_size)
+                next_id = max(next_id, int(ids.max()) + 1)
+        return next_id
+
+    def _load_search_params(self) -> str:
+        '''
+        Функция для выбора параметров поиска из Парето-оптимальных настроек, найденных `faiss_search.tuning`:
+        самые быстрые параметры текущей фабрики индекса с полнотой не ниже `target_recall`,
+        а если таких нет - с наибольшей полнотой
+        '''
+        path_to_search_params = os.path.join(self.parameters.path_to_index, self.parameters.name_search_params)
+        if not os.path.exists(path_to_search_params):
+            return ''
+        with open(path_to_search_params, 'r') as f:
+            pareto = [item for item in json.load(f)['pareto'] if item['index_factory'] == self.index_factory]
+        if not pareto:
+            return ''
+
+        suitable = [item for item in pareto if item['recall'] >= self.parameters.target_recall]
+        if suitable:
+            return max(suitable, key=lambda item: item['qps'])['params']
+        return max(pareto, key=lambda item: item['recall'])['params']
+
+    def search(self, query_vectors: np.array, k: int, nprobe: int = None, num_threads: int = None,
+               chunk_size: int = None, out: Tuple[np.ndarray, np.ndarray] = None, refine_factor: int = None,
+               layout_names: List[str] = None, resolutions: List[Tuple[int, int]] = None) -> Tuple[np.ndarray, np.ndarray]:
+        '''
+        Функция для поиска k ближайших векторов. Запросы обрабатываются порциями: каждая порция копируется
+        в один и тот же буфер float32, нормализуется в нем и ищется с записью результатов сразу в выходные массивы.
+        Если загружено хранилище переранжирования, по индексу ищется `k * refine_factor` кандидатов,
+        сходство которых пересчитывается точно, и возвращаются k лучших.
+        При фильтре по подложке или разрешению просматриваются только вектора, удовлетворяющие фильтру
+
+        Parameters
+        -------------
+        query_vectors: `np.array`
+            Запросы (N, D) или один запрос (D,). Не изменяются
+        k: `int`
+            Количество ближайших векторов
+        nprobe: `int`
+            Количество просматриваемых кластеров для этого вызова (только индексы IVF, индекс не изменяется)
+        num_threads: `int`
+            Ограничение количества потоков OpenMP на время вызова
+        chunk_size: `int`
+            Количество запросов в порции (по умолчанию `search_chunk_size` конфигурации)
+        out: `Tuple[np.ndarray, np.ndarray]`
+            Предвыделенные массивы расстояний float32 (N, k) и идентификаторов int64 (N, k)
+        refine_factor: `int`
+            Во сколько раз больше кандидатов искать для переранжирования (по умолчанию `refine_factor`
+            конфигурации, 1 - без переранжирования)
+        layout_names: `List[str]`
+            Искать только среди плиток указанных подложек
+        resolutions: `List[Tuple[int, int]]`
+            Искать только среди плиток указанных разрешений (dim_space_x, dim_space_y)
+
+        Returns
+        -------------
+        `np.ndarray`
+            Скалярные произведения (косинусное сходство) (N, k)
+        `np.ndarray`
+            Идентификаторы (faiss_id) найденных векторов (N, k), -1 если найдено меньше k
+        '''
+        query_vectors = np.atleast_2d(query_vectors)
+        num_queries = query_vectors.shape[0]
+        if out is None:
+            distances = np.empty((num_queries, k), dtype='float32')
+            indices = np.empty((num_queries, k), dtype='int64')
+        else:
+            distances, indices = out
+            if distances.shape != (num_queries, k) or indices.shape != (num_queries, k) or \
+                    distances.dtype != np.float32 or indices.dtype != np.int64 or \
+                    not (distances.flags.c_contiguous and indices.flags.c_contiguous):
+                raise ValueError(f'Выходные массивы должны быть непрерывными float32 и int64 размера {(num_queries, k)}')
+
+        params, selectors = self._get_filtered_search_parameters(nprobe, layout_names, resolutions)  # selectors нужны до конца поиска
+        if refine_factor is None:
+            refine_factor = self.parameters.refine_factor
+        num_candidates = k * refine_factor if self.refine_store is not None and refine_factor > 1 else 0
+
+        with omp_num_threads(num_threads):
+            candidate_distances = candidate_indices = None
+            for start, chunk in self._iterate_query_chunks(query_vectors, chunk_size):
+                end = start + len(chunk)
+                if not num_candidates:
+                    self._search_index(chunk, k, params, distances[start: end], indices[start: end])
+                    continue
+
+                if candidate_distances is None:
+                    candidate_distances = np.empty((len(chunk), num_candidates), dtype='float32')
+                    candidate_indices = np.empty((len(chunk), num_candidates), dtype='int64')
+                self._search_index(chunk, num_candidates, params,
+                                   candidate_distances[:len(chunk)], candidate_indices[:len(chunk)])
+                self.refine_store.rerank(chunk, candidate_indices[:len(chunk)], k,
+                                         out=(distances[start: end], indices[start: end]))
         return distances, indices
+
+    def range_search(self, query_vectors: np.array, threshold: float, nprobe: int = None, num_threads: int = None,
+                     chunk_size: int = None, layout_names: List[str] = None,
+                     resolutions: List[Tuple[int, int]] = None) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        '''
+        Функция для поиска всех векторов с косинусным сходством с запросом больше порога
+
+        Parameters
+        -------------
+        query_vectors: `np.array`
+            Запросы (N, D) или один запрос (D,). Не изменяются
+        threshold: `float`
+            Порог косинусного сходства
+        nprobe: `int`
+            Количество просматриваемых кластеров для этого вызова (только индексы IVF)
+        num_threads: `int`
+            Ограничение количества потоков OpenMP на время вызова
+        chunk_size: `int`
+            Количество запросов в порции (по умолчанию `search_chunk_size` конфигурации)
+        layout_names: `List[str]`
+            Искать только среди плиток указанных подложек
+        resolutions: `List[Tuple[int, int]]`
+            Искать только среди плиток указанных разрешений (dim_space_x, dim_space_y)
+
+        Returns
+        -------------
+        `np.ndarray`
+            Границы результатов запросов (N + 1,): результаты запроса i - [lims[i], lims[i + 1])
+        `np.ndarray`
+            Косинусное сходство найденных векторов
+        `np.ndarray`
+            Идентификаторы (faiss_id) найденных векторов
+        '''
+        query_vectors = np.atleast_2d(query_vectors)
+        params, selectors = self._get_filtered_search_parameters(nprobe, layout_names, resolutions, max_ranges=1)
+        lims, distances, indices = [np.zeros(1, dtype='uint64')], [], []
+        with omp_num_threads(num_threads):
+            for _, chunk in self._iterate_query_chunks(query_vectors, chunk_size):
+                if not params:
+                    lims.append(np.full(len(chunk), lims[-1][-1], dtype='uint64'))
+                    continue
+                chunk_lims, chunk_distances, chunk_indices = self.index.range_search(chunk, threshold, params=params[0])
+                lims.append(chunk_lims[1:] + lims[-1][-1])
+                distances.append(chunk_distances)
+                indices.append(chunk_indices)
+
+        return np.concatenate(lims).astype('int64'), \
+            np.concatenate(distances) if distances else np.empty(0, dtype='float32'), \
+            np.concatenate(indices) if indices else np.empty(0, dtype='int64')
+
+    def _iterate_query_chunks(self, query_vectors: np.ndarray, chunk_size: int = None):
+        '''Функция для перебора нормализованных порций запросов, записываемых в один буфер'''
+        chunk_size = chunk_size or self.parameters.search_chunk_size
+        query_buffer = np.empty((min(chunk_size, query_vectors.shape[0]), query_vectors.shape[1]), dtype='float32')
+        for start in range(0, query_vectors.shape[0], chunk_size):
+            chunk = query_buffer[:min(chunk_size, query_vectors.shape[0] - start)]
+            chunk[:] = query_vectors[start: start + len(chunk)]
+            yield start, self.normalize(chunk)
+
+    def _get_search_parameters(self, nprobe: int = None, selector=None):
+        index_ivf = faiss.try_extract_index_ivf(self.index)
+        if index_ivf is None:
+            if nprobe is not None:
+                raise ValueError('nprobe задается только для индексов IVF')
+            return faiss.SearchParameters(sel=selector) if selector is not None else None
+        if nprobe is None and selector is None:
+            return None
+        return faiss.SearchParametersIVF(nprobe=int(nprobe if nprobe is not None else index_ivf.nprobe), sel=selector)
+
+    def _get_filtered_search_parameters(self, nprobe: int = None, layout_names: List[str] = None,
+                                        resolutions: List[Tuple[int, int]] = None, max_ranges: int = None):
+        '''
+        Функция для получения параметров поиска с фильтром по подложке и разрешению. Если выбранные faiss_id образуют
+        не больше `max_ranges` непрерывных диапазонов, а идентификаторы в инвертированных списках отсортированы
+        (индекс заполнялся по возрастанию faiss_id), каждый диапазон ищется отдельно с границами, найденными
+        двоичным поиском, и просматриваются только подходящие вектора. Иначе используется битовая маска faiss_id
+
+        Returns
+        -------------
+        `List`
+            Параметры поиска (по одному на диапазон; пустой список, если фильтру ничего не удовлетворяет)
+        `List`
+            Селекторы и буферы, которые должны существовать, пока используются параметры
+        '''
+        if layout_names is None and resolutions is None:
+            return [self._get_search_parameters(nprobe)], []
+        if self.id_filter is None:
+            raise ValueError('Фильтр по подложке и разрешению недоступен: рядом с индексом нет данных плиток')
+
+        starts, ends = self.id_filter.get_runs(layout_names, resolutions)
+        if len(starts) == 0:
+            return [], []
+
+        max_ranges = max_ranges if max_ranges is not None else self.parameters.max_filter_ranges
+        is_ivf = faiss.try_extract_index_ivf(self.index) is not None
+        if is_ivf and len(starts) <= max_ranges:
+            assume_sorted = self._is_inverted_lists_sorted()
+            if assume_sorted or len(starts) == 1:
+                selectors = [faiss.IDSelectorRange(int(start), int(end), assume_sorted)
+                             for start, end in zip(starts, ends)]
+                return [self._get_search_parameters(nprobe, selector) for selector in selectors], selectors
+
+        bitmap = self.id_filter.get_bitmap(layout_names, resolutions)
+        selector = faiss.IDSelectorBitmap(len(self.id_filter), faiss.swig_ptr(bitmap))
+        return [self._get_search_parameters(nprobe, selector)], [selector, bitmap]
+
+    def _search_index(self, queries: np.ndarray, k: int, params: List, distances: np.ndarray, indices: np.ndarray):
+        '''Функция для поиска по индексу с одним или несколькими наборами параметров (результаты объединяются)'''
+        if not params:
+            distances[:] = MISSING_DISTANCE
+            indices[:] = -1
+        elif len(params) == 1:
+            self.index.search(queries, k, params=params[0], D=distances, I=indices)
+        else:
+            result_heap = faiss.ResultHeap(len(queries), k,
+                                           keep_max=self.index.metric_type == faiss.METRIC_INNER_PRODUCT)
+            for item in params:
+                result_heap.add_result(*self.index.search(queries, k, params=item))
+            result_heap.finalize()
+            distances[:] = result_heap.D
+            indices[:] = result_heap.I
+
+    def _sort_inverted_lists(self):
+        '''
+        Функция для восстановления возрастания идентификаторов в инвертированных списках: remove_ids переносит
+        на место удаленного вектора последний вектор списка, после чего фильтр по диапазонам faiss_id
+        не мог бы использовать двоичный поиск границ
+        '''
+        index_ivf = faiss.try_extract_index_ivf(self.index)
+        if index_ivf is None:
+            return
+        invlists = faiss.downcast_InvertedLists(index_ivf.invlists)
+        if not isinstance(invlists, (faiss.ArrayInvertedLists, faiss.OnDiskInvertedLists)):
+            return
+        code_size = invlists.code_size
+        for list_no in range(invlists.nlist):
+            list_size = invlists.list_size(list_no)
+            if list_size < 2:
+                continue
+            ids = faiss.rev_swig_ptr(invlists.get_ids(list_no), list_size)
+            if np.all(ids[1:] > ids[:-1]):
+                continue
+            order = np.argsort(ids, kind='stable')
+            sorted_ids = np.ascontiguousarray(ids[order])
+            codes = faiss.rev_swig_ptr(invlists.get_codes(list_no), list_size * code_size).reshape(list_size, code_size)
+            sorted_codes = np.ascontiguousarray(codes[order])
+            invlists.update_entries(list_no, 0, list_size, faiss.swig_ptr(sorted_ids), faiss.swig_ptr(sorted_codes))
+
+    def _is_inverted_lists_sorted(self) -> bool:
+        '''Функция для проверки, что идентификаторы в каждом инвертированном списке возрастают (результат кэшируется)'''
+        if self._sorted_inverted_lists is None:
+            invlists = faiss.extract_index_ivf(self.index).invlists
+            self._sorted_inverted_lists = True
+            for list_no in range(invlists.nlist):
+                list_size = invlists.list_size(list_no)
+                if list_size > 1:
+                    ids = faiss.rev_swig_ptr(invlists.get_ids(list_no), list_size)
+                    if not np.all(ids[1:] > ids[:-1]):
+                        self._sorted_inverted_lists = False
+                        break
+        return self._sorted_inverted_lists
 #
 #
 # if __name__ == "__main__":
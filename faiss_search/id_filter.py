@@ -0,0 +1,122 @@
+'''Данный модуль содержит фильтр идентификаторов индекса FAISS по подложке и разрешению плиток'''
+import json
+import os
+import shutil
+from typing import Dict, Iterable, List, Tuple
+import numpy as np
+
+# Колонки хранилища данных плиток (utils.metadata_store), необходимые для фильтрации
+FILTER_FILES = ('layout_id.npy', 'resolution_id.npy', 'dictionaries.json')
+
+
+class IdFilter:
+    '''
+    Класс реализует фильтр faiss_id по данным плиток, хранящимся рядом с индексом: номер подложки и номер
+    разрешения (dim_space_x, dim_space_y) для каждого faiss_id и словари подложек и разрешений.
+    Колонки отображаются в память и не читаются целиком при загрузке
+
+    Результат фильтра (диапазоны faiss_id и битовая маска) кэшируется для каждого набора подложек и разрешений,
+    поэтому повторные запросы с тем же фильтром не просматривают колонки заново
+
+    Parameters
+    -------------
+    path: `str`
+        Путь до каталога фильтра
+    max_cached_filters: `int`
+        Максимальное количество кэшируемых наборов подложек и разрешений
+    '''
+
+    def __init__(self, path: str, max_cached_filters: int = 16):
+        self.path = path
+        self.max_cached_filters = max_cached_filters
+        self._cache: Dict[Tuple, Dict[str, np.ndarray]] = {}
+        with open(os.path.join(path, 'dictionaries.json'), 'r') as f:
+            dictionaries = json.load(f)
+        self.layouts: List[str] = dictionaries['layouts']
+        self.resolutions: List[Tuple[int, int]] = [tuple(item) for item in dictionaries['resolutions']]
+        self.layout_id = np.load(os.path.join(path, 'layout_id.npy'), mmap_mode='r')
+        self.resolution_id = np.load(os.path.join(path, 'resolution_id.npy'), mmap_mode='r')
+
+    def __len__(self):
+        return len(self.layout_id)
+
+    @classmethod
+    def build(cls, path: str, path_to_metadata_store: str):
+        '''Функция для создания фильтра из хранилища данных плиток (копируются только нужные колонки)'''
+        path_to_tmp = path + '.tmp'
+        if os.path.exists(path_to_tmp):
+            shutil.rmtree(path_to_tmp)
+        os.makedirs(path_to_tmp)
+        for name in FILTER_FILES:
+            shutil.copyfile(os.path.join(path_to_metadata_store, name), os.path.join(path_to_tmp, name))
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        os.replace(path_to_tmp, path)
+        return cls(path)
+
+    def get_mask(self, layout_names: Iterable[str] = None,
+                 resolutions: Iterable[Tuple[int, int]] = None) -> np.ndarray:
+        '''
+        Функция для получения маски faiss_id, удовлетворяющих фильтру
+
+        Parameters
+        -------------
+        layout_names: `Iterable[str]`
+            Названия подложек: полные или в том виде, в котором они отправляются на сервер (первые две части имени)
+        resolutions: `Iterable[Tuple[int, int]]`
+            Разрешения (dim_space_x, dim_space_y)
+
+        Returns
+        -------------
+        `np.ndarray`
+            Маска bool (N,), элемент i - удовлетворяет ли фильтру faiss_id i
+        '''
+        bitmap = self.get_bitmap(layout_names, resolutions)
+        return np.unpackbits(bitmap, count=len(self), bitorder='little').astype(bool)
+
+    def get_runs(self, layout_names: Iterable[str] = None,
+                 resolutions: Iterable[Tuple[int, int]] = None) -> Tuple[np.ndarray, np.ndarray]:
+        '''Функция для получения непрерывных диапазонов [start, end) faiss_id, удовлетворяющих фильтру (только чтение)'''
+        selection = self._get_selection(layout_names, resolutions)
+        return selection['starts'], selection['ends']
+
+    def get_bitmap(self, layout_names: Iterable[str] = None,
+                   resolutions: Iterable[Tuple[int, int]] = None) -> np.ndarray:
+        '''Функция для получения маски faiss_id, удовлетворяющих фильтру, упакованной по биту на faiss_id (только чтение)'''
+        return self._get_selection(layout_names, resolutions)['bitmap']
+
+    def _get_selection(self, layout_names: Iterable[str] = None,
+                       resolutions: Iterable[Tuple[int, int]] = None) -> Dict[str, np.ndarray]:
+        '''Функция для получения диапазонов и битовой маски фильтра из кэша (при отсутствии они вычисляются)'''
+        if layout_names is not None:
+            layout_names = frozenset(layout_names)
+        if resolutions is not None:
+            resolutions = frozenset((int(x), int(y)) for x, y in resolutions)
+        key = (layout_names, resolutions)
+        selection = self._cache.get(key)
+        if selection is not None:
+            return selection
+
+        mask = np.ones(len(self), dtype=bool)
+        if layout_names is not None:
+            layout_ids = [ind for ind, name in enumerate(self.layouts)
+                          if name in layout_names or '_'.join(name.split('_')[:2]) in layout_names]
+            mask &= np.isin(self.layout_id, layout_ids)
+        if resolutions is not None:
+            resolution_ids = [ind for ind, item in enumerate(self.resolutions) if item in resolutions]
+            mask &= np.isin(self.resolution_id, resolution_ids)
+        starts, ends = get_id_runs(mask)
+        selection = {'starts': starts, 'ends': ends, 'bitmap': np.packbits(mask, bitorder='little')}
+        for array in selection.values():
+            array.flags.writeable = False
+
+        if len(self._cache) >= self.max_cached_filters:
+            # Вытесняется самый старый фильтр
+            self._cache.pop(next(iter(self._cache)))
+        self._cache[key] = selection
+        return selection
+
+def get_id_runs(mask: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    '''Функция для разбиения выбранных faiss_id на непрерывные диапазоны [start, end)'''
+    changes = np.flatnonzero(np.diff(np.concatenate(([False], mask, [False])).astype(np.int8)))
+    return changes[::2], changes[1::2]
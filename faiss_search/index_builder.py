@@ -0,0 +1,121 @@
+'''Данный модуль содержит построение индекса FAISS по мере извлечения векторов признаков'''
+import copy
+from typing import Callable
+import numpy as np
+from faiss_search.faiss_interface import FAISS
+from utils.reservoir import ReservoirSampler
+
+
+class IndexBuilder:
+    '''
+    Класс реализует построение индекса FAISS с обучением на резервуарной выборке ограниченного размера
+    (вместо всей матрицы векторов) и последующим добавлением всех векторов блоками с faiss_id = номер строки.
+
+    Если задан `train_after_vectors`, индекс обучается, как только извлечено столько векторов (выборка равномерна
+    по уже извлеченной части набора), а далее вектора добавляются в индекс по мере извлечения.
+    Если задан `num_block_workers`, вектора добавляются после извлечения параллельно блоками (`FAISS.add_blocks`).
+
+    Parameters
+    -------------
+    db_faiss: `FAISS`
+        Индекс FAISS (пересоздается, если размер векторов отличается от указанного в конфигурации)
+    sample_size: `int`
+        Размер выборки для обучения
+    train_after_vectors: `int`
+        Количество векторов, после которого индекс обучается не дожидаясь окончания извлечения (0 - не обучать заранее)
+    block_size: `int`
+        Количество векторов, добавляемых в индекс за раз
+    seed: `int`
+        Зерно генератора случайных чисел выборки
+    num_block_workers: `int`
+        Количество процессов построения блоков индекса (0 - вектора добавляются в текущем процессе)
+    '''
+
+    def __init__(self, db_faiss: FAISS, sample_size: int, train_after_vectors: int = 0, block_size: int = 1024,
+                 seed: int = 0, num_block_workers: int = 0):
+        self.db_faiss = db_faiss
+        self.num_block_workers = num_block_workers
+        self.sampler = ReservoirSampler(sample_size, seed)
+        self.train_after_vectors = train_after_vectors
+        self.block_size = block_size
+        self.num_added = 0
+
+    @property
+    def is_trained(self) -> bool:
+        return self.db_faiss.index.is_trained
+
+    def update(self, vectors: np.ndarray, all_vectors: np.ndarray):
+        '''
+        Функция для обработки очередного пакета извлеченных векторов
+
+        Parameters
+        -------------
+        vectors: `np.ndarray`
+            Пакет векторов (N, D)
+        all_vectors: `np.ndarray`
+            Все извлеченные к этому моменту вектора, включая пакет (например, memmap файла векторов)
+        '''
+        self._check_dim(vectors.shape[1])
+        self.sampler.add(vectors)
+
+        if not self.is_trained and 0 < self.train_after_vectors <= self.sampler.num_seen:
+            self.train()
+        if self.is_trained and not self.num_block_workers:
+            self.add_rows(all_vectors)
+
+    def update_from(self, all_vectors: np.ndarray, chunk_rows: int = 65536):
+        '''Функция для формирования выборки по уже извлеченным векторам, читая их порциями'''
+        for start in range(0, len(all_vectors), chunk_rows):
+            vectors = all_vectors[start: start + chunk_rows]
+            self._check_dim(vectors.shape[1])
+            self.sampler.add(vectors)
+
+    def train(self):
+        print(f'Обучение FAISS на выборке {self.sampler.sample.shape} из {self.sampler.num_seen} векторов...')
+        self.db_faiss.training(train_vectors=self.sampler.sample)
+        print('Обучение заверешно...')
+
+    def add_rows(self, all_vectors: np.ndarray, on_block: Callable[[int, int], None] = None):
+        '''
+        Функция для добавления в индекс блоками строк all_vectors, которые еще не были добавлены.
+        `on_block` вызывается с диапазоном строк [start, end) сразу после добавления каждого блока
+        '''
+        for start_block in range(self.num_added, len(all_vectors), self.block_size):
+            end_block = min(start_block + self.block_size, len(all_vectors))
+            self.db_faiss.add(all_vectors[start_block: end_block], ids=range(start_block, end_block))
+            if on_block is not None:
+                on_block(start_block, end_block)
+        self.num_added = max(self.num_added, len(all_vectors))
+
+    def finish(self, all_vectors: np.ndarray, path_to_vectors: str = None,
+               on_block: Callable[[int, int], None] = None) -> FAISS:
+        '''
+        Функция для завершения построения: обучение (если еще не было) и добавление оставшихся векторов.
+        Для построения блоками необходим путь до файла векторов `path_to_vectors`, который читают процессы.
+        `on_block` вызывается с диапазоном строк [start, end), как только он добавлен в индекс (строки, добавленные
+        во время извлечения или до продолжения построения (`num_added`), передаются первыми), что позволяет отправлять
+        данные блоков, не дожидаясь конца построения. При построении блоками в процессах строки попадают в индекс
+        только при объединении блоков, поэтому передаются одним диапазоном после него
+        '''
+        if not self.is_trained:
+            self.train()
+        if on_block is not None and self.num_added:
+            on_block(0, self.num_added)
+        if self.num_block_workers:
+            if self.num_added < len(all_vectors):
+                print(f'Построение индекса блоками в {self.num_block_workers} процессах...')
+                self.db_faiss.add_blocks(path_to_vectors, self.num_added, len(all_vectors), self.num_block_workers)
+                if on_block is not None:
+                    on_block(self.num_added, len(all_vectors))
+                self.num_added = len(all_vectors)
+        else:
+            self.add_rows(all_vectors, on_block)
+        return self.db_faiss
+
+    def _check_dim(self, vector_dim: int):
+        parameters = self.db_faiss.parameters
+        if vector_dim != parameters.vector_dim:
+            print(f'Был неверно указан размер векторов ({parameters.vector_dim}) и он автоматически исправлен на {vector_dim}')
+            parameters = copy.copy(parameters)
+            parameters.vector_dim = vector_dim
+            self.db_faiss = FAISS(parameters)
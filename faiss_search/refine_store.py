@@ -0,0 +1,159 @@
+'''Данный модуль содержит компактное хранилище векторов для точного переранжирования кандидатов индекса FAISS'''
+import json
+import os
+from typing import Tuple
+import faiss
+import numpy as np
+from utils.npy_store import NpyStore
+
+# Типы скалярного квантования: float16 (2 байта на координату) и int8 по диапазону каждой координаты (1 байт)
+QUANTIZER_TYPES = {'fp16': faiss.ScalarQuantizer.QT_fp16, 'int8': faiss.ScalarQuantizer.QT_8bit}
+MISSING_DISTANCE = -np.finfo(np.float32).max  # Сходство для отсутствующих результатов, как в FAISS
+
+
+def normalize_rows(vectors: np.ndarray) -> np.ndarray:
+    data = np.array(vectors, dtype=np.float32, order='C')
+    faiss.normalize_L2(data)
+    return data
+
+
+class RefineStore:
+    '''
+    Класс реализует хранилище нормализованных векторов (строка = faiss_id), сжатых скалярным квантованием
+    и отображенных в память. По нему сходство кандидатов, найденных по PQ кодам индекса, пересчитывается
+    точно, что позволяет искать с небольшим списком кандидатов и малым nprobe без потери качества
+
+    Parameters
+    -------------
+    path: `str`
+        Путь без расширения: коды хранятся в `{path}.npy`, параметры квантования - в `{path}.json`
+    '''
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path + '.json', 'r') as f:
+            parameters = json.load(f)
+        self.qtype = parameters['qtype']
+        self.vector_dim = parameters['vector_dim']
+        self.quantizer = self._create_quantizer(self.vector_dim, self.qtype, parameters['trained'])
+        self.codes = NpyStore.load(path + '.npy')
+
+    def __len__(self):
+        return len(self.codes)
+
+    @classmethod
+    def build(cls, path: str, vectors: np.ndarray, qtype: str = 'fp16', train_size: int = 100000,
+              chunk_rows: int = 65536, seed: int = 0):
+        '''
+        Функция для создания хранилища по всем векторам (например, memmap подготовленных векторов)
+
+        Parameters
+        -------------
+        path: `str`
+            Путь без расширения
+        vectors: `np.ndarray`
+            Вектора (N, D), строка - faiss_id
+        qtype: `str`
+            Тип квантования: `fp16` или `int8`
+        train_size: `int`
+            Размер случайной выборки для определения диапазонов координат (int8)
+        chunk_rows: `int`
+            Количество векторов, кодируемых за раз
+        seed: `int`
+            Зерно генератора случайных чисел выборки
+        '''
+        if qtype not in QUANTIZER_TYPES:
+            raise ValueError(f'Неизвестный тип квантования {qtype}, доступны: {", ".join(QUANTIZER_TYPES)}')
+
+        quantizer = cls._create_quantizer(vectors.shape[1], qtype)
+        rng = np.random.default_rng(seed)
+        train_rows = np.sort(rng.choice(len(vectors), size=min(train_size, len(vectors)), replace=False))
+        quantizer.train(normalize_rows(vectors[train_rows]))
+
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        code_store = NpyStore.create(path + '.npy', (quantizer.code_size,), dtype=np.uint8, chunk_rows=chunk_rows)
+        cls._encode(quantizer, vectors, code_store, chunk_rows)
+        code_store.close()
+
+        path_to_tmp = path + '.json.tmp'
+        with open(path_to_tmp, 'w') as f:
+            json.dump({'qtype': qtype, 'vector_dim': int(vectors.shape[1]),
+                       'trained': faiss.vector_to_array(quantizer.trained).tolist()}, f)
+        os.replace(path_to_tmp, path + '.json')
+        return cls(path)
+
+    def append(self, vectors: np.ndarray, chunk_rows: int = 65536):
+        '''Функция для дозаписи векторов (их faiss_id продолжают нумерацию хранилища)'''
+        if len(vectors) == 0:
+            return
+        code_store = NpyStore.open(self.path + '.npy', chunk_rows=chunk_rows)
+        self._encode(self.quantizer, vectors, code_store, chunk_rows)
+        code_store.close()
+        self.codes = NpyStore.load(self.path + '.npy')
+
+    def decode(self, rows: np.ndarray) -> np.ndarray:
+        '''Функция для получения нормализованных векторов по номерам строк (faiss_id)'''
+        return self.quantizer.decode(np.ascontiguousarray(self.codes[rows]))
+
+    def rerank(self, queries: np.ndarray, candidates: np.ndarray, k: int,
+               out: Tuple[np.ndarray, np.ndarray] = None, max_elements: int = 1 << 24) -> Tuple[np.ndarray, np.ndarray]:
+        '''
+        Функция для точного пересчета сходства кандидатов и выбора k лучших
+
+        Parameters
+        -------------
+        queries: `np.ndarray`
+            Нормализованные запросы (N, D)
+        candidates: `np.ndarray`
+            Кандидаты из индекса (N, M), -1 - отсутствующий кандидат
+        k: `int`
+            Количество возвращаемых векторов
+        out: `Tuple[np.ndarray, np.ndarray]`
+            Выходные массивы сходства float32 (N, k) и идентификаторов int64 (N, k)
+        max_elements: `int`
+            Ограничение количества чисел float32 в распакованных векторах кандидатов одной порции запросов
+
+        Returns
+        -------------
+        `np.ndarray`
+            Косинусное сходство (N, k)
+        `np.ndarray`
+            Идентификаторы (N, k), -1 если кандидатов меньше k
+        '''
+        num_queries, num_candidates = candidates.shape
+        if out is None:
+            out = (np.empty((num_queries, k), dtype=np.float32), np.empty((num_queries, k), dtype=np.int64))
+        distances, indices = out
+        num_top = min(k, num_candidates)
+        distances[:, num_top:] = MISSING_DISTANCE
+        indices[:, num_top:] = -1
+
+        step = max(1, max_elements // max(1, num_candidates * self.vector_dim))
+        for start in range(0, num_queries, step):
+            end = min(start + step, num_queries)
+            block_candidates = candidates[start: end]
+            valid = block_candidates >= 0
+            vectors = self.decode(np.where(valid, block_candidates, 0).ravel())
+            scores = np.einsum('nd,nmd->nm', queries[start: end],
+                               vectors.reshape(end - start, num_candidates, self.vector_dim))
+            scores[~valid] = MISSING_DISTANCE
+
+            top = np.argpartition(-scores, num_top - 1, axis=1)[:, :num_top] if num_top < num_candidates else \
+                np.broadcast_to(np.arange(num_candidates), scores.shape)
+            top = np.take_along_axis(top, np.argsort(-np.take_along_axis(scores, top, axis=1), axis=1, kind='stable'),
+                                     axis=1)
+            distances[start: end, :num_top] = np.take_along_axis(scores, top, axis=1)
+            indices[start: end, :num_top] = np.take_along_axis(np.where(valid, block_candidates, -1), top, axis=1)
+        return distances, indices
+
+    @staticmethod
+    def _create_quantizer(vector_dim: int, qtype: str, trained=None) -> faiss.ScalarQuantizer:
+        quantizer = faiss.ScalarQuantizer(vector_dim, QUANTIZER_TYPES[qtype])
+        if trained:
+            faiss.copy_array_to_vector(np.array(trained, dtype=np.float32), quantizer.trained)
+        return quantizer
+
+    @staticmethod
+    def _encode(quantizer: faiss.ScalarQuantizer, vectors: np.ndarray, code_store: NpyStore, chunk_rows: int):
+        for start in range(0, len(vectors), chunk_rows):
+            code_store.append(quantizer.compute_codes(normalize_rows(vectors[start: start + chunk_rows])))
@@ -0,0 +1,209 @@
+'''
+Данный скрипт содержит подбор фабрики индекса FAISS и параметров поиска по полноте (recall@k), скорости (QPS)
+и занимаемой памяти. Эталонные соседи отложенной выборки запросов ищутся точным перебором (IndexFlatIP)
+по остальным подготовленным векторам, Парето-оптимальные настройки сохраняются в `search_params.json`,
+откуда их применяет `FAISS.load`
+
+Запуск из корня репозитория:
+python -m faiss_search.tuning --factories "IVF{num_clusters},PQ64" "OPQ64,IVF{num_clusters},PQ64" "IVF{num_clusters},SQ8" HNSW32
+'''
+import argparse
+import json
+import os
+import tempfile
+import time
+from typing import Dict, Iterator, List, Tuple
+import faiss
+import numpy as np
+from config import ExtractingFeaturesConfig, FAISSConfig
+from faiss_search.faiss_interface import create_index, get_search_param_combinations, set_search_params
+
+
+def split_rows(num_rows: int, num_queries: int, max_database: int = 0,
+               seed: int = 0) -> Tuple[np.ndarray, np.ndarray]:
+    '''
+    Функция для разделения строк подготовленных векторов на отложенные запросы и базу для поиска
+
+    Parameters
+    -------------
+    num_rows: `int`
+        Количество подготовленных векторов
+    num_queries: `int`
+        Количество запросов
+    max_database: `int`
+        Максимальный размер базы (случайное подмножество строк, 0 - все строки кроме запросов)
+    seed: `int`
+        Зерно генератора случайных чисел
+
+    Returns
+    -------------
+    `np.ndarray`
+        Номера строк запросов
+    `np.ndarray`
+        Номера строк базы (они же faiss_id)
+    '''
+    rng = np.random.default_rng(seed)
+    query_rows = np.sort(rng.choice(num_rows, size=min(num_queries, num_rows), replace=False))
+    database_rows = np.setdiff1d(np.arange(num_rows), query_rows, assume_unique=True)
+    if 0 < max_database < len(database_rows):
+        database_rows = np.sort(rng.choice(database_rows, size=max_database, replace=False))
+    return query_rows, database_rows
+
+
+def read_normalized(vectors: np.ndarray, rows: np.ndarray) -> np.ndarray:
+    data = np.ascontiguousarray(vectors[rows], dtype=np.float32)
+    faiss.normalize_L2(data)
+    return data
+
+
+def iterate_database(vectors: np.ndarray, database_rows: np.ndarray,
+                     chunk_rows: int) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+    '''Функция для чтения базы порциями: номера строк и нормализованные вектора'''
+    for start in range(0, len(database_rows), chunk_rows):
+        rows = database_rows[start: start + chunk_rows]
+        yield rows, read_normalized(vectors, rows)
+
+
+def compute_ground_truth(vectors: np.ndarray, queries: np.ndarray, database_rows: np.ndarray, k: int,
+                         chunk_rows: int) -> np.ndarray:
+    '''Функция для точного поиска k ближайших соседей запросов (IndexFlatIP по порциям базы, память ограничена порцией)'''
+    result_heap = faiss.ResultHeap(len(queries), k, keep_max=True)
+    for rows, data in iterate_database(vectors, database_rows, chunk_rows):
+        index = faiss.IndexFlatIP(data.shape[1])
+        index.add(data)
+        distances, indices = index.search(queries, min(k, len(rows)))
+        result_heap.add_result(distances, np.where(indices >= 0, rows[np.maximum(indices, 0)], -1))
+    result_heap.finalize()
+    return result_heap.I
+
+
+def build_index(index_factory: str, faiss_config: FAISSConfig, vectors: np.ndarray, database_rows: np.ndarray,
+                chunk_rows: int, seed: int = 0) -> faiss.Index:
+    '''Функция для построения проверяемого индекса в памяти так же, как в pipeline: обучение на выборке, faiss_id = строка'''
+    index = create_index(vectors.shape[1], index_factory, faiss_config.num_clusters)
+    rng = np.random.default_rng(seed)
+    train_rows = np.sort(rng.choice(database_rows, size=min(faiss_config.train_sample_size, len(database_rows)),
+                                    replace=False))
+    index.train(read_normalized(vectors, train_rows))
+    for rows, data in iterate_database(vectors, database_rows, chunk_rows):
+        index.add_with_ids(data, rows.astype(np.int64))
+    return index
+
+
+def get_index_memory_mb(index: faiss.Index) -> float:
+    '''Функция для получения размера индекса (МБ) по размеру его файла'''
+    with tempfile.TemporaryDirectory() as path_to_tmp:
+        path_to_index = os.path.join(path_to_tmp, 'index.index')
+        faiss.write_index(index, path_to_index)
+        return os.path.getsize(path_to_index) / 2 ** 20
+
+
+def compute_recall(indices: np.ndarray, ground_truth: np.ndarray) -> float:
+    '''Функция для вычисления recall@k: доля эталонных k соседей, найденных среди k результатов'''
+    found = sum(len(np.intersect1d(result[result >= 0], truth)) for result, truth in zip(indices, ground_truth))
+    return found / ground_truth.size
+
+
+def evaluate(index: faiss.Index, queries: np.ndarray, ground_truth: np.ndarray, k: int,
+             repeats: int = 3) -> List[Dict]:
+    '''Функция для замера полноты и скорости поиска для каждого сочетания параметров поиска индекса'''
+    results = []
+    for params in get_search_param_combinations(index) or ['']:
+        set_search_params(index, params)
+        best_time = float('inf')
+        for _ in range(repeats):
+            start_time = time.perf_counter()
+            _, indices = index.search(queries, k)
+            best_time = min(best_time, time.perf_counter() - start_time)
+        results.append({'params': params,
+                        'recall': compute_recall(indices, ground_truth),
+                        'qps': len(queries) / best_time})
+    return results
+
+
+def get_pareto_front(results: List[Dict]) -> List[Dict]:
+    '''Функция для отбора Парето-оптимальных настроек: нет другой настройки не хуже по полноте, скорости и памяти'''
+    def dominates(first, second):
+        not_worse = first['recall'] >= second['recall'] and first['qps'] >= second['qps'] and \
+                    first['memory_mb'] <= second['memory_mb']
+        better = first['recall'] > second['recall'] or first['qps'] > second['qps'] or \
+                 first['memory_mb'] < second['memory_mb']
+        return not_worse and better
+
+    pareto = [item for item in results if not any(dominates(other, item) for other in results)]
+    return sorted(pareto, key=lambda item: (item['recall'], item['qps']))
+
+
+def tune(index_factories: List[str], k: int = 10, num_queries: int = 1000, max_database: int = 0,
+         repeats: int = 3) -> List[Dict]:
+    '''
+    Функция для подбора фабрики индекса и параметров поиска
+
+    Parameters
+    -------------
+    index_factories: `List[str]`
+        Проверяемые строки фабрики индекса (`{num_clusters}` подставляется из конфигурации)
+    k: `int`
+        Количество ближайших соседей
+    num_queries: `int`
+        Количество отложенных запросов (не добавляются в индекс)
+    max_database: `int`
+        Максимальное количество векторов базы (0 - все подготовленные вектора)
+    repeats: `int`
+        Количество повторов замера скорости, берется лучший результат
+
+    Returns
+    -------------
+    `List[Dict]`
+        Парето-оптимальные настройки
+    '''
+    faiss_config = FAISSConfig()
+    extracting_features_config = ExtractingFeaturesConfig()
+    chunk_rows = extracting_features_config.prepared_vectors_chunk_rows
+    vectors = np.load(extracting_features_config.path_to_prepared_vectors, mmap_mode='r')
+
+    query_rows, database_rows = split_rows(len(vectors), num_queries, max_database)
+    queries = read_normalized(vectors, query_rows)
+    print(f'Запросов: {len(queries)}, векторов в базе: {len(database_rows)}, k={k}')
+    print('Поиск эталонных соседей (IndexFlatIP)...')
+    ground_truth = compute_ground_truth(vectors, queries, database_rows, k, chunk_rows)
+
+    results = []
+    print(f'{"фабрика":<32}{"параметры":<36}{"recall@k":>10}{"QPS":>12}{"память, МБ":>12}')
+    for index_factory in index_factories:
+        index_factory = index_factory.format(num_clusters=int(faiss_config.num_clusters))
+        index = build_index(index_factory, faiss_config, vectors, database_rows, chunk_rows)
+        memory_mb = get_index_memory_mb(index)
+        for result in evaluate(index, queries, ground_truth, k, repeats):
+            result.update({'index_factory': index_factory, 'memory_mb': memory_mb})
+            results.append(result)
+            print(f'{index_factory:<32}{result["params"]:<36}{result["recall"]:>10.4f}'
+                  f'{result["qps"]:>12.1f}{memory_mb:>12.1f}')
+
+    pareto = get_pareto_front(results)
+    print('Парето-оптимальные настройки:')
+    for item in pareto:
+        print(f'\t{item["index_factory"]} {item["params"]}: recall@{k}={item["recall"]:.4f}, '
+              f'{item["qps"]:.1f} QPS, {item["memory_mb"]:.1f} МБ')
+
+    path_to_search_params = os.path.join(faiss_config.path_to_index, faiss_config.name_search_params)
+    os.makedirs(faiss_config.path_to_index, exist_ok=True)
+    with open(path_to_search_params, 'w') as f:
+        json.dump({'k': k, 'num_queries': len(queries), 'num_database': len(database_rows), 'pareto': pareto},
+                  f, indent=2, ensure_ascii=False)
+    print(f'Настройки сохранены в {path_to_search_params}')
+    return pareto
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Подбор фабрики индекса FAISS и параметров поиска')
+    parser.add_argument('--factories', type=str, nargs='+', default=[FAISSConfig.index_factory],
+                        help='Проверяемые строки фабрики индекса ({num_clusters} подставляется из конфигурации)')
+    parser.add_argument('--k', type=int, default=10, help='Количество ближайших соседей')
+    parser.add_argument('--num-queries', type=int, default=1000, help='Количество отложенных запросов')
+    parser.add_argument('--max-database', type=int, default=0,
+                        help='Максимальное количество векторов базы (0 - все подготовленные вектора)')
+    parser.add_argument('--repeats', type=int, default=3, help='Количество повторов замера скорости')
+    args = parser.parse_args()
+
+    tune(args.factories, args.k, args.num_queries, args.max_database, args.repeats)
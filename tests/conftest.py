@@ -0,0 +1,6 @@
+'''Общие настройки тестов'''
+import os
+import sys
+
+# Скрипты data_processing запускаются из своего каталога (см. *.Dockerfile) и импортируют соседние модули по имени
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'data_processing'))
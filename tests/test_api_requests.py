@@ -0,0 +1,38 @@
+'''Проверка фоновой очереди отправки данных на сервер'''
+import pytest
+
+from utils.api_requests import UploadQueue
+
+
+def send(data):
+    if data % 10 == 3:
+        raise ConnectionError(f'Запрос {data} не отправлен')
+    return {'data': data}
+
+
+def test_finished_requests_are_not_retained():
+    queue = UploadQueue(send, max_in_flight=2, fail_fast=False)
+    for data in range(100):
+        queue.submit(data)
+    with pytest.raises(ConnectionError, match='не отправлен'):
+        queue.close()
+    assert not queue._pending
+    assert queue._error is None
+
+
+def test_fail_fast_raises_on_next_submit():
+    queue = UploadQueue(send, max_in_flight=1)
+    queue.submit(3).exception()
+    with pytest.raises(ConnectionError):
+        queue.submit(4)
+    # Ошибка пробрасывается один раз
+    queue.submit(5)
+    queue.close()
+
+
+def test_on_done_receives_response():
+    responses = []
+    with UploadQueue(send, max_in_flight=2) as queue:
+        for data in (0, 1, 2):
+            queue.submit(data, on_done=responses.append)
+    assert sorted(response['data'] for response in responses) == [0, 1, 2]
@@ -0,0 +1,57 @@
+'''Проверка поиска почти одинаковых перекрывающихся плиток'''
+import numpy as np
+
+from utils.dedup import find_aliases, find_group_aliases, normalize_rows
+from utils.metadata_store import TileMetadataStore
+
+
+def tile_bounds(x: float, y: float, size: float = 1.0):
+    return [x, y, x + size, y + size]
+
+
+def test_find_group_aliases():
+    rng = np.random.default_rng(0)
+    base = rng.standard_normal((3, 8))
+    vectors = normalize_rows(np.stack([
+        base[0],                       # 0: представитель
+        base[0] + 0.01,                # 1: перекрывает 0 на 90% и почти совпадает с ним
+        base[1],                       # 2: перекрывает 0, но вектор другой
+        base[0] + 0.01,                # 3: перекрывает 0 только на 20%
+        base[0],                       # 4: такой же вектор далеко от 0 (например, однородная вода)
+        base[2], base[2] + 0.01,       # 5, 6: вторая группа
+    ]))
+    bounds = np.array([tile_bounds(0, 0), tile_bounds(0.1, 0), tile_bounds(0, 0.5), tile_bounds(0.8, 0),
+                       tile_bounds(10, 10), tile_bounds(5, 0), tile_bounds(5, 0.2)])
+
+    aliases = find_group_aliases(vectors, bounds, threshold=0.99, min_overlap=0.5)
+    np.testing.assert_array_equal(aliases, [0, 0, 2, 3, 4, 5, 5])
+
+    # С меньшей долей перекрытия к группе относится и плитка 3
+    np.testing.assert_array_equal(find_group_aliases(vectors, bounds, 0.99, 0.1), [0, 0, 2, 0, 4, 5, 5])
+    # С порогом сходства 1 плитки не объединяются
+    np.testing.assert_array_equal(find_group_aliases(vectors, bounds, 1.01, 0.5), np.arange(7))
+
+
+def test_find_aliases_by_layout_and_resolution(tmp_path):
+    rng = np.random.default_rng(0)
+    vector = rng.standard_normal(8)
+    # Строки 0-1 - первая подложка, 2-3 - вторая, 4-5 - первая подложка в другом разрешении, 6-7 - снова первая
+    items = [{'layout_name': layout, 'dim_space_x': resolution, 'dim_space_y': resolution, 'filename': f'{ind}.tif'}
+             for ind, (layout, resolution) in enumerate([('layout_1', 50)] * 2 + [('layout_2', 50)] * 2 +
+                                                        [('layout_1', 60)] * 2 + [('layout_1', 50)] * 2)]
+    corners = np.array([[[37.0, 55.0], [37.1, 55.0], [37.1, 55.1], [37.0, 55.1]]] * len(items))
+    vectors = np.tile(vector, (len(items), 1)) + rng.standard_normal((len(items), 8)) * 1e-3
+
+    store = TileMetadataStore.create(str(tmp_path / 'store'))
+    store.append(items, corners)
+    store.close()
+
+    # Одинаковые плитки разных подложек и разрешений не объединяются
+    np.testing.assert_array_equal(find_aliases(vectors, store, 0, 8, threshold=0.99), [0, 0, 2, 2, 4, 4, 0, 0])
+    # Номера строк отсчитываются от начала хранилища
+    np.testing.assert_array_equal(find_aliases(vectors, store, 3, 8, threshold=0.99), [3, 4, 4, 6, 6])
+    assert len(find_aliases(vectors, store, 8, 8, threshold=0.99)) == 0
+
+    # Удаленные строки не становятся представителями и представляют сами себя
+    store.mark_deleted([0, 4])
+    np.testing.assert_array_equal(find_aliases(vectors, store, 0, 8, threshold=0.99), [0, 1, 2, 2, 4, 5, 1, 1])
@@ -0,0 +1,51 @@
+'''Проверка уменьшения масштаба снимков окнами ограниченного размера'''
+import numpy as np
+import pytest
+import rasterio
+from rasterio.transform import from_origin
+
+import downscale
+import output_profile
+
+
+@pytest.fixture(params=['none', 'deflate'])
+def source(request, tmp_path, monkeypatch):
+    '''Небольшой снимок uint16 с плавными и резкими перепадами, записанный с заданным профилем записи'''
+    monkeypatch.setenv('OUTPUT_PROFILE', request.param)
+    rng = np.random.default_rng(0)
+    rows, cols = np.mgrid[0:301, 0:257]
+    data = np.stack([rows * 100 + cols, rng.integers(0, 10000, (301, 257)), (rows // 7 + cols // 5) % 2 * 5000])
+    path = str(tmp_path / 'layout_2021-06-15.tif')
+    with rasterio.open(path, 'w', driver='GTiff', width=257, height=301, count=3, dtype='uint16',
+                       crs='EPSG:3857', transform=from_origin(4000000, 7000000, 10, 10)) as dest:
+        dest.write(data.astype('uint16'))
+    return path
+
+
+def read(path):
+    with rasterio.open(path) as src:
+        return src.read(), src.profile
+
+
+@pytest.mark.parametrize('res', [(50, 50), (70, 80), (13, 11)])
+def test_windowed_matches_per_resolution(source, tmp_path, res):
+    downscale.save_raster_with_new_pixel_size_sync(source, str(tmp_path / 'full.tif'), res)
+    # Окно в несколько строк: снимок записывается многими полосами
+    downscale.save_raster_with_new_pixel_size_windowed_sync(source, str(tmp_path / 'windowed.tif'), res, 2 ** 14)
+
+    expected, expected_profile = read(str(tmp_path / 'full.tif'))
+    data, profile = read(str(tmp_path / 'windowed.tif'))
+    assert profile == expected_profile
+    np.testing.assert_array_equal(data, expected)
+
+
+def test_windowed_original_matches_full_rewrite(source, tmp_path):
+    downscale.copy_original(source, str(tmp_path / 'original_full.tif'))
+    downscale.copy_original(source, str(tmp_path / 'original_windowed.tif'), window_bytes=2 ** 14)
+
+    expected, expected_profile = read(str(tmp_path / 'original_full.tif'))
+    data, profile = read(str(tmp_path / 'original_windowed.tif'))
+    assert profile == expected_profile
+    assert profile.get('compress') == output_profile.get_output_profile_from_env().get('compress')
+    np.testing.assert_array_equal(data, read(source)[0])
+    np.testing.assert_array_equal(data, expected)
@@ -0,0 +1,162 @@
+'''Проверка продолжения прерванного построения индекса FAISS и отправки данных векторов на сервер'''
+import os
+from collections import Counter
+import numpy as np
+import pytest
+
+# config.py читает обязательные переменные окружения при импорте
+os.environ.setdefault('VECTOR_DIM', '16')
+os.environ.setdefault('NUM_CLUSTERS', '4')
+os.environ.setdefault('SERVER_PORT', '8000')
+
+import extracting_features_from_layout as pipeline
+from config import ExtractingFeaturesConfig, FAISSConfig
+from faiss_search.faiss_interface import FAISS
+from utils.api_requests import UploadQueue
+from utils.metadata_store import TileMetadataStore
+
+NUM_TILES = 17
+BLOCK_SIZE = 8
+
+
+class Crash(Exception):
+    '''Аварийное завершение запуска'''
+
+
+class Response:
+    status_code = 201
+
+
+class MockServer:
+    '''Заглушка метода добавления слоев: запоминает отправленные faiss_id, может не отвечать'''
+
+    def __init__(self):
+        self.sent = []
+        self.available = True
+
+    def send(self, layers):
+        if not self.available:
+            raise ConnectionError('Сервер недоступен')
+        self.sent.extend(layer['faiss_id'] for layer in layers)
+        return Response()
+
+
+@pytest.fixture
+def data(tmp_path, monkeypatch):
+    '''Подготовленные вектора и данные плиток, конфигурация с путями во временном каталоге'''
+    class Config(ExtractingFeaturesConfig):
+        path_to_prepared_vectors = str(tmp_path / 'prepared_vectors.npy')
+        path_to_prepared_vectors_data = str(tmp_path / 'prepared_vectors_data')
+        path_to_prepared_vectors_data_json = str(tmp_path / 'prepared_vectors_data.json')
+        path_to_upload_outbox = str(tmp_path / 'upload_outbox.jsonl')
+        load_prepared_vectors = True
+        incremental_update = False
+        upload_checkpoint_rows = BLOCK_SIZE
+        dedup_threshold = 0
+
+    class IndexConfig(FAISSConfig):
+        path_to_index = str(tmp_path / 'data_faiss')
+        path_to_block_index = str(tmp_path / 'data_faiss' / 'block')
+        vector_dim = 16
+        num_clusters = 2
+        index_factory = 'IVF{num_clusters},Flat'
+        block_size = BLOCK_SIZE
+        num_block_workers = 0
+        ondisk_index = False
+        mmap_index = False
+        refine_store = ''
+
+    monkeypatch.setattr(pipeline, 'ExtractingFeaturesConfig', Config)
+    monkeypatch.setattr(pipeline, 'FAISSConfig', IndexConfig)
+
+    np.save(Config.path_to_prepared_vectors,
+            np.random.default_rng(0).standard_normal((NUM_TILES, 16), dtype=np.float32))
+    records = [{'layout_name': 'layout_2021-06-15_crop', 'dim_space_x': 50, 'dim_space_y': 50,
+                'filename': f'tile_{row}.tif'} for row in range(NUM_TILES)]
+    corners = np.tile(np.array([[37.0, 55.0], [37.1, 55.0], [37.1, 55.1], [37.0, 55.1]]), (NUM_TILES, 1, 1))
+    store = TileMetadataStore.create(Config.path_to_prepared_vectors_data)
+    store.append(records, corners)
+    store.close()
+    return Config, IndexConfig
+
+
+def run_pipeline(server: MockServer, crash_at_row: int = None):
+    '''
+    Функция для запуска полного построения с заглушкой сервера. Если задан `crash_at_row`, запуск прерывается
+    при добавлении в индекс блока с этой строкой, а отправленные до этого блоки успевают получить ответ.
+
+    Returns
+    -------------
+    `List[Tuple[int, int]]`
+        Диапазоны строк, добавленные в индекс при запуске
+    '''
+    queues, added, add = [], [], FAISS.add
+
+    def create_upload_queue(extracting_features_config):
+        queues.append(UploadQueue(server.send, max_in_flight=1, fail_fast=False))
+        return queues[-1]
+
+    def add_with_crash(self, data, ids=None):
+        if crash_at_row is not None and crash_at_row in ids:
+            raise Crash()
+        added.append((ids.start, ids.stop))
+        return add(self, data, ids)
+
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        monkeypatch.setattr(pipeline, 'create_upload_queue', create_upload_queue)
+        monkeypatch.setattr(FAISS, 'add', add_with_crash)
+        try:
+            pipeline.pipeline_extracting_features('', '')
+        except Crash:
+            # Ответы на уже отправленные блоки успевают прийти (ошибки отправки остаются в журнале)
+            try:
+                queues[-1].close()
+            except ConnectionError:
+                pass
+    return added
+
+
+def test_resume_after_crash_sends_each_faiss_id_once(data, monkeypatch):
+    config, _ = data
+    server = MockServer()
+
+    assert run_pipeline(server, crash_at_row=BLOCK_SIZE) == [(0, BLOCK_SIZE)]
+    assert server.sent == list(range(BLOCK_SIZE))
+
+    # Повторный запуск не обучает индекс заново и добавляет только строки после сохраненных
+    monkeypatch.setattr(FAISS, 'training', lambda self, train_vectors: pytest.fail('Индекс обучается заново'))
+    added = run_pipeline(server)
+    assert added == [(BLOCK_SIZE, 2 * BLOCK_SIZE), (2 * BLOCK_SIZE, NUM_TILES)]
+
+    assert Counter(server.sent) == Counter(range(NUM_TILES))
+    assert not os.path.exists(config.path_to_upload_outbox)
+
+
+def test_resume_replays_unacknowledged_blocks(data):
+    config, index_config = data
+    server = MockServer()
+    server.available = False
+
+    run_pipeline(server, crash_at_row=BLOCK_SIZE)
+    assert server.sent == []
+
+    server.available = True
+    added = run_pipeline(server)
+    assert added == [(BLOCK_SIZE, 2 * BLOCK_SIZE), (2 * BLOCK_SIZE, NUM_TILES)]
+    assert Counter(server.sent) == Counter(range(NUM_TILES))
+
+    db_faiss = FAISS(index_config())
+    db_faiss.load()
+    assert db_faiss.index.ntotal == NUM_TILES
+    assert db_faiss.next_id == NUM_TILES
+
+
+def test_blocks_outside_saved_index_are_not_replayed(data):
+    config, _ = data
+    server = MockServer()
+    run_pipeline(server, crash_at_row=BLOCK_SIZE)
+
+    # Блок записан в журнал, но запуск прервался до сохранения индекса с ним: блок не отправлялся
+    pipeline.UploadOutbox(config.path_to_upload_outbox).add_pending([(BLOCK_SIZE, 2 * BLOCK_SIZE)])
+    run_pipeline(server)
+    assert Counter(server.sent) == Counter(range(NUM_TILES))
@@ -0,0 +1,216 @@
+'''Проверка сохранения и загрузки индекса FAISS'''
+import os
+import numpy as np
+import pytest
+
+# config.py читает обязательные переменные окружения при импорте
+os.environ.setdefault('VECTOR_DIM', '16')
+os.environ.setdefault('NUM_CLUSTERS', '4')
+os.environ.setdefault('SERVER_PORT', '8000')
+
+from config import FAISSConfig
+from faiss_search.faiss_interface import FAISS
+
+
+def create_config(path_to_index: str, index_factory: str = 'Flat', refine_store: str = '') -> FAISSConfig:
+    class Config(FAISSConfig):
+        pass
+
+    Config.path_to_index = path_to_index
+    Config.path_to_block_index = os.path.join(path_to_index, 'block')
+    Config.vector_dim = 16
+    Config.num_clusters = 4
+    Config.index_factory = index_factory
+    Config.refine_store = refine_store
+    Config.mmap_index = False
+    return Config()
+
+
+def test_load_restores_next_id_and_ntotal(tmp_path):
+    parameters = create_config(str(tmp_path))
+    vectors = np.random.default_rng(0).random((100, 16), dtype=np.float32)
+
+    db_faiss = FAISS(parameters)
+    db_faiss.add(vectors)
+    db_faiss.save()
+
+    loaded = FAISS(parameters)
+    loaded.load()
+    assert loaded.next_id == 100
+    assert loaded.ntotal == 100
+
+    ids = loaded.add(vectors[:5])
+    np.testing.assert_array_equal(ids, np.arange(100, 105))
+
+
+def test_load_keeps_next_id_after_remove(tmp_path):
+    parameters = create_config(str(tmp_path))
+    vectors = np.random.default_rng(0).random((100, 16), dtype=np.float32)
+
+    db_faiss = FAISS(parameters)
+    db_faiss.add(vectors)
+    db_faiss.save()
+
+    # Обновление, только удаляющее вектора, не должно сбрасывать счетчик идентификаторов
+    updated = FAISS(parameters)
+    updated.load()
+    updated.remove(list(range(90, 100)))
+    updated.save()
+
+    loaded = FAISS(parameters)
+    loaded.load()
+    assert loaded.next_id == 100
+    assert loaded.ntotal == 90
+
+
+@pytest.mark.parametrize('index_factory', ['IVF{num_clusters},PQ8x4', 'HNSW8'])
+@pytest.mark.parametrize('refine_store', ['fp16', 'int8'])
+def test_load_with_refine_store(tmp_path, index_factory, refine_store):
+    # IVF индекс хранит faiss_id в инвертированных списках, HNSW оборачивается в IDMap
+    parameters = create_config(str(tmp_path), index_factory, refine_store)
+    # Вектора с нулевым средним почти ортогональны, поэтому ближайший к каждому вектору - он сам
+    vectors = np.random.default_rng(0).standard_normal((600, 16), dtype=np.float32)
+    queries = vectors[:20]
+    nprobe = parameters.num_clusters if index_factory.startswith('IVF') else None  # Просматриваются все кластеры
+
+    db_faiss = FAISS(parameters)
+    db_faiss.training(vectors[:500])
+    db_faiss.add(vectors[:500], ids=range(500))
+    db_faiss.update_refine_store(vectors[:500], rebuild=True)
+    db_faiss.save()
+    expected = db_faiss.search(queries, k=5, refine_factor=50, nprobe=nprobe)
+
+    loaded = FAISS(parameters)
+    loaded.load()
+    assert loaded.next_id == 500
+    assert loaded.ntotal == 500
+    assert loaded.refine_store is not None and len(loaded.refine_store) == 500
+    distances, indices = loaded.search(queries, k=5, refine_factor=50, nprobe=nprobe)
+    np.testing.assert_array_equal(indices, expected[1])
+    np.testing.assert_allclose(distances, expected[0], rtol=1e-5)
+    np.testing.assert_array_equal(indices[:, 0], np.arange(20))
+
+    # Дозапись после загрузки продолжает идентификаторы и хранилище переранжирования
+    ids = loaded.add(vectors[500:])
+    np.testing.assert_array_equal(ids, np.arange(500, 600))
+    loaded.update_refine_store(vectors)
+    assert len(loaded.refine_store) == 600
+    loaded.save()
+
+    reloaded = FAISS(parameters)
+    reloaded.load()
+    assert reloaded.next_id == 600
+    assert reloaded.ntotal == 600
+    _, indices = reloaded.search(vectors[500:520], k=1, refine_factor=50, nprobe=nprobe)
+    np.testing.assert_array_equal(indices[:, 0], np.arange(500, 520))
+
+
+def create_id_filter_store(path: str, num_rows: int) -> str:
+    '''Функция для создания хранилища данных плиток: подложки и разрешения идут подряд, как при извлечении'''
+    from utils.metadata_store import TileMetadataStore
+
+    groups = [('layout_1_2021', (50, 50)), ('layout_1_2021', (100, 100)),
+              ('layout_2_2022', (50, 50)), ('layout_2_2022', (100, 100))]
+    records = [{'layout_name': groups[row * len(groups) // num_rows][0],
+                'dim_space_x': groups[row * len(groups) // num_rows][1][0],
+                'dim_space_y': groups[row * len(groups) // num_rows][1][1],
+                'filename': f'tile_{row}.tif'} for row in range(num_rows)]
+    corners = np.tile(np.array([[37.0, 55.0], [37.1, 55.0], [37.1, 55.1], [37.0, 55.1]]), (num_rows, 1, 1))
+    store = TileMetadataStore.create(path)
+    store.append(records, corners)
+    store.close()
+    return path
+
+
+@pytest.mark.parametrize('max_filter_ranges', [32, 1])
+def test_filtered_search_matches_brute_force(tmp_path, max_filter_ranges):
+    parameters = create_config(str(tmp_path / 'index'), 'IVF{num_clusters},Flat')
+    parameters.max_filter_ranges = max_filter_ranges
+    vectors = np.random.default_rng(0).standard_normal((400, 16), dtype=np.float32)
+    queries = np.random.default_rng(1).standard_normal((10, 16), dtype=np.float32)
+    removed = np.arange(0, 400, 7)
+
+    db_faiss = FAISS(parameters)
+    db_faiss.training(vectors)
+    db_faiss.add(vectors)
+    db_faiss.remove(removed)
+    db_faiss.update_id_filter(create_id_filter_store(str(tmp_path / 'store'), 400))
+    # После удаления идентификаторы в инвертированных списках снова возрастают
+    assert db_faiss._is_inverted_lists_sorted()
+
+    normalized = vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+    normalized_queries = queries / np.linalg.norm(queries, axis=1, keepdims=True)
+    is_live = np.ones(400, dtype=bool)
+    is_live[removed] = False
+    filters = [(['layout_1'], None), (None, [(100, 100)]), (['layout_2_2022'], [(50, 50)]),
+               (['layout_1', 'layout_2'], [(50, 50), (100, 100)])]
+    for layout_names, resolutions in filters:
+        mask = db_faiss.id_filter.get_mask(layout_names, resolutions) & is_live
+        subset = np.flatnonzero(mask)
+        expected = subset[np.argsort(-(normalized_queries @ normalized[subset].T), axis=1)[:, :5]]
+
+        for _ in range(2):  # Второй поиск использует кэшированный фильтр
+            distances, indices = db_faiss.search(queries, k=5, nprobe=parameters.num_clusters, refine_factor=1,
+                                                 layout_names=layout_names, resolutions=resolutions)
+            np.testing.assert_array_equal(indices, expected)
+            np.testing.assert_allclose(distances, np.take_along_axis(normalized_queries @ normalized.T, expected, 1),
+                                       rtol=1e-5)
+
+    assert db_faiss.search(queries, k=5, layout_names=['layout_3'])[1].max() == -1
+
+
+def test_add_with_explicit_ids(tmp_path):
+    parameters = create_config(str(tmp_path))
+    vectors = np.random.default_rng(0).standard_normal((40, 16), dtype=np.float32)
+    db_faiss = FAISS(parameters)
+
+    np.testing.assert_array_equal(db_faiss.add(vectors[:10], ids=range(100, 110)), np.arange(100, 110))
+    assert db_faiss.next_id == 110
+    # Меньшие идентификаторы не уменьшают счетчик
+    np.testing.assert_array_equal(db_faiss.add(vectors[10:15], ids=[5, 3, 1, 7, 9]), [5, 3, 1, 7, 9])
+    np.testing.assert_array_equal(db_faiss.add(vectors[15:20], ids=np.arange(20, 25, dtype=np.int32)),
+                                  np.arange(20, 25))
+    assert db_faiss.next_id == 110
+    # Без идентификаторов выделяется диапазон, начиная с next_id; один вектор можно передать как (D,)
+    np.testing.assert_array_equal(db_faiss.add(vectors[20]), [110])
+    assert db_faiss.add(vectors[:0], ids=[]).shape == (0,)
+    assert db_faiss.next_id == 111 and db_faiss.index.ntotal == 21
+
+    with pytest.raises(ValueError):
+        db_faiss.add(vectors[:3], ids=[1, 2])
+
+    _, indices = db_faiss.search(vectors[[0, 11, 16, 20]], k=1)
+    np.testing.assert_array_equal(indices[:, 0], [100, 3, 21, 110])
+
+
+@pytest.mark.parametrize('refine_store', ['', 'fp16'])
+def test_chunked_search_matches_unchunked(tmp_path, refine_store):
+    parameters = create_config(str(tmp_path), 'IVF{num_clusters},PQ8x4', refine_store)
+    vectors = np.random.default_rng(0).standard_normal((500, 16), dtype=np.float32)
+    queries = np.random.default_rng(1).standard_normal((23, 16), dtype=np.float32)
+    queries_copy = queries.copy()
+
+    db_faiss = FAISS(parameters)
+    db_faiss.training(vectors)
+    db_faiss.add(vectors)
+    if refine_store:
+        db_faiss.update_refine_store(vectors, rebuild=True)
+    expected = db_faiss.search(queries, k=7, nprobe=2, chunk_size=len(queries))
+
+    for chunk_size in (1, 5, 23, 100):
+        out = (np.full((23, 7), np.nan, dtype=np.float32), np.full((23, 7), -2, dtype=np.int64))
+        result = db_faiss.search(queries, k=7, nprobe=2, chunk_size=chunk_size, out=out)
+        # Результаты записываются в переданные массивы
+        assert result[0] is out[0] and result[1] is out[1]
+        np.testing.assert_array_equal(out[1], expected[1])
+        np.testing.assert_allclose(out[0], expected[0], rtol=1e-6)
+    np.testing.assert_array_equal(queries, queries_copy)
+
+    distances, indices = db_faiss.search(queries[3], k=7, nprobe=2)
+    np.testing.assert_array_equal(indices, expected[1][3:4])
+
+    for out in [(np.empty((23, 7), dtype=np.float64), np.empty((23, 7), dtype=np.int64)),
+                (np.empty((23, 6), dtype=np.float32), np.empty((23, 7), dtype=np.int64)),
+                (np.empty((7, 23), dtype=np.float32).T, np.empty((23, 7), dtype=np.int64))]:
+        with pytest.raises(ValueError):
+            db_faiss.search(queries, k=7, out=out)
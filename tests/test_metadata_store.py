@@ -0,0 +1,100 @@
+'''Проверка колоночного хранилища данных плиток'''
+import numpy as np
+from shapely.geometry import Polygon
+
+from utils.metadata_store import TileMetadataStore
+
+
+def make_tiles(layout_name, resolution, names, shift=0.0):
+    items = [{'layout_name': layout_name, 'dim_space_x': resolution[0], 'dim_space_y': resolution[1],
+              'filename': name} for name in names]
+    corners = np.array([[[37.0 + shift + ind, 55.0], [37.1 + shift + ind, 55.0], [37.1 + shift + ind, 55.1],
+                         [37.0 + shift + ind, 55.1]] for ind in range(len(names))])
+    return items, corners
+
+
+def test_append_and_reopen(tmp_path):
+    store = TileMetadataStore.create(str(tmp_path / 'store'), chunk_rows=2)
+    store.append(*make_tiles('layout_2021-06-15_crop', (50, 50), ['a.tif', 'плитка.tif', 'c.tif']))
+    store.append(*make_tiles('layout_2022-01-01_crop', (60, 70), ['d.tif'], shift=3))
+    assert len(store) == 4
+    assert store.filename(1) == 'плитка.tif'
+    store.close()
+
+    reopened = TileMetadataStore(str(tmp_path / 'store'))
+    assert len(reopened) == 4
+    assert reopened.layouts == ['layout_2021-06-15_crop', 'layout_2022-01-01_crop']
+    assert reopened.resolutions == [(50, 50), (60, 70)]
+    assert reopened.get_record(3) == {
+        'faiss_id': 3,
+        'polygon_coordinates': str(Polygon([(40.0, 55.0), (40.1, 55.0), (40.1, 55.1), (40.0, 55.1)])),
+        'layout_name': 'layout_2022-01-01_crop',
+        'dim_space_x': 60,
+        'dim_space_y': 70,
+        'filename': 'd.tif',
+    }
+    assert [record['filename'] for record in reopened.get_records(0, 4)] == ['a.tif', 'плитка.tif', 'c.tif', 'd.tif']
+
+    # Дозапись после повторного открытия продолжает словари и имена файлов
+    reopened.append(*make_tiles('layout_2021-06-15_crop', (60, 70), ['e.tif']))
+    reopened.close()
+    assert TileMetadataStore(str(tmp_path / 'store')).get_record(4)['filename'] == 'e.tif'
+    assert reopened.resolution(4) == (60, 70)
+    assert reopened.layout_name(4) == 'layout_2021-06-15_crop'
+
+
+def test_extend_recodes_dictionaries(tmp_path):
+    store = TileMetadataStore.create(str(tmp_path / 'store'))
+    store.append(*make_tiles('layout_1', (50, 50), ['a.tif', 'b.tif']))
+    store.close()
+
+    # В другом хранилище (например, шарде) те же подложки и разрешения имеют другие номера
+    other = TileMetadataStore.create(str(tmp_path / 'other'))
+    other.append(*make_tiles('layout_2', (70, 70), ['c.tif']))
+    other.append(*make_tiles('layout_1', (50, 50), ['d.tif']))
+    other.close()
+
+    store.extend(TileMetadataStore(str(tmp_path / 'other')))
+    store.close()
+    records = TileMetadataStore(str(tmp_path / 'store')).get_records(0, 4)
+    assert [(record['layout_name'], record['dim_space_x'], record['filename']) for record in records] == [
+        ('layout_1', 50, 'a.tif'), ('layout_1', 50, 'b.tif'), ('layout_2', 70, 'c.tif'), ('layout_1', 50, 'd.tif')]
+
+
+def test_mark_deleted_and_layout_rows(tmp_path):
+    store = TileMetadataStore.create(str(tmp_path / 'store'))
+    store.append(*make_tiles('layout_1', (50, 50), ['a.tif', 'b.tif', 'c.tif']))
+    store.append(*make_tiles('layout_2', (50, 50), ['d.tif', 'e.tif']))
+    store.close()
+    assert len(store.deleted_rows()) == 0
+
+    store.mark_deleted([2, 0])
+    store.mark_deleted([])
+    store.mark_deleted([2, 3])
+    np.testing.assert_array_equal(store.deleted_rows(), [0, 2, 3])
+    np.testing.assert_array_equal(store.layout_rows(['layout_1']), [1])
+    np.testing.assert_array_equal(store.layout_rows(['layout_2', 'layout_3']), [4])
+    # Строки не удаляются, чтобы не сдвигать faiss_id
+    assert len(store) == 5
+
+    # Пересоздание хранилища сбрасывает пометки
+    assert len(TileMetadataStore.create(str(tmp_path / 'store')).deleted_rows()) == 0
+
+
+def test_set_aliases(tmp_path):
+    store = TileMetadataStore.create(str(tmp_path / 'store'))
+    store.append(*make_tiles('layout_1', (50, 50), [f'{ind}.tif' for ind in range(8)]))
+    store.close()
+    np.testing.assert_array_equal(store.aliases(), np.arange(8))
+
+    # Строки до start без записанного представителя представляют сами себя
+    store.set_aliases(2, [2, 2, 4])
+    np.testing.assert_array_equal(store.aliases(), [0, 1, 2, 2, 4, 5, 6, 7])
+
+    # Дозапись после записанных строк
+    store.set_aliases(6, [6, 4])
+    np.testing.assert_array_equal(store.aliases(), [0, 1, 2, 2, 4, 5, 6, 4])
+
+    # Перезапись ранее записанных строк
+    store.set_aliases(3, [3, 3])
+    np.testing.assert_array_equal(store.aliases(), [0, 1, 2, 3, 3, 5, 6, 7])
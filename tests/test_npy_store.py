@@ -0,0 +1,61 @@
+'''Проверка дописываемого массива .npy на диске'''
+import os
+import numpy as np
+import pytest
+
+from utils.npy_store import NpyStore
+
+
+def test_append_flush_and_close_trims_file(tmp_path):
+    path = str(tmp_path / 'vectors.npy')
+    rows = np.random.default_rng(0).random((23, 4), dtype=np.float32)
+
+    store = NpyStore.create(path, (4,), chunk_rows=5)
+    assert store.append(rows[:3]) == 0
+    assert store.append(rows[3:]) == 3  # Запись через границы нескольких порций
+    assert len(store) == 23
+    np.testing.assert_array_equal(store.array, rows)
+
+    # После сброса файл читается через np.load, хотя размечен с запасом
+    store.flush()
+    np.testing.assert_array_equal(np.load(path), rows)
+    header_size = os.path.getsize(path) - 25 * rows[0].nbytes
+
+    store.close()
+    assert os.path.getsize(path) == header_size + rows.nbytes
+    np.testing.assert_array_equal(NpyStore.load(path), rows)
+
+
+def test_reopen_and_append(tmp_path):
+    path = str(tmp_path / 'corners.npy')
+    rows = np.arange(2 * 7 * 4 * 2, dtype=np.float64).reshape(14, 4, 2)
+
+    store = NpyStore.create(path, (4, 2), np.float64, chunk_rows=4)
+    store.append(rows[:7])
+    store.close()
+
+    store = NpyStore.open(path, chunk_rows=4)
+    assert (store.row_shape, store.dtype, len(store)) == ((4, 2), np.float64, 7)
+    assert store.append(rows[7:]) == 7
+    store.close()
+    np.testing.assert_array_equal(np.load(path), rows)
+
+
+def test_open_file_saved_by_numpy(tmp_path):
+    path = str(tmp_path / 'vectors.npy')
+    rows = np.random.default_rng(0).random((10, 3), dtype=np.float32)
+    # Заголовок np.save не имеет запаса под рост первой размерности и переписывается при открытии
+    np.save(path, rows[:6])
+
+    store = NpyStore.open(path, chunk_rows=2)
+    store.append(rows[6:])
+    store.close()
+    np.testing.assert_array_equal(np.load(path), rows)
+    assert not os.path.exists(path + '.tmp')
+
+
+def test_open_fortran_order_raises(tmp_path):
+    path = str(tmp_path / 'vectors.npy')
+    np.save(path, np.asfortranarray(np.ones((4, 3), dtype=np.float32)))
+    with pytest.raises(ValueError):
+        NpyStore.open(path)
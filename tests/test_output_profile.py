@@ -0,0 +1,62 @@
+'''Проверка профиля записи GeoTIFF'''
+import numpy as np
+import pytest
+import rasterio
+from rasterio.transform import from_origin
+
+from output_profile import apply_output_profile, get_output_profile, get_output_profile_from_env
+
+META = {'driver': 'GTiff', 'width': 300, 'height': 200, 'count': 2, 'dtype': 'uint16', 'crs': 'EPSG:3857',
+        'transform': from_origin(4000000, 7000000, 10, 10)}
+
+
+def test_get_output_profile():
+    assert get_output_profile() == {}
+    assert get_output_profile('deflate') == {'tiled': True, 'blocksize': 256, 'compress': 'deflate', 'predictor': 'auto'}
+    assert get_output_profile('zstd', blocksize=512, level=None)['blocksize'] == 512
+    # Без сжатия предиктор и уровень сжатия не задаются
+    assert get_output_profile('lzw', compress='none', level=9) == {'tiled': True, 'blocksize': 256}
+    with pytest.raises(ValueError):
+        get_output_profile('jpeg')
+
+
+def test_apply_output_profile():
+    assert apply_output_profile(META, {}) == META
+
+    meta = apply_output_profile(META, get_output_profile('deflate', level=6, num_threads='ALL_CPUS'))
+    assert meta == dict(META, tiled=True, blockxsize=256, blockysize=256, compress='deflate', predictor=2,
+                        zlevel=6, num_threads='ALL_CPUS')
+    meta = apply_output_profile(dict(META, dtype='float32'), get_output_profile('zstd', level=9, num_threads=4))
+    assert (meta['predictor'], meta['zstd_level'], meta['num_threads']) == (3, 9, '4')
+    assert apply_output_profile(META, get_output_profile('lzw', level=9, predictor=1))['predictor'] == 1
+    assert 'level' not in apply_output_profile(META, get_output_profile('lzw', level=9))
+
+
+def test_profile_is_read_from_env_on_each_call(monkeypatch):
+    monkeypatch.delenv('OUTPUT_PROFILE', raising=False)
+    assert apply_output_profile(META) == META
+
+    monkeypatch.setenv('OUTPUT_PROFILE', 'zstd')
+    monkeypatch.setenv('OUTPUT_TILED', 'false')
+    monkeypatch.setenv('OUTPUT_LEVEL', '9')
+    monkeypatch.setenv('OUTPUT_PREDICTOR', '1')
+    monkeypatch.setenv('OUTPUT_NUM_THREADS', 'ALL_CPUS')
+    assert get_output_profile_from_env() == {'tiled': False, 'blocksize': 256, 'compress': 'zstd', 'predictor': 1,
+                                             'level': 9, 'num_threads': 'ALL_CPUS'}
+    meta = apply_output_profile(META)
+    assert 'tiled' not in meta
+    assert (meta['compress'], meta['predictor'], meta['zstd_level']) == ('zstd', 1, 9)
+
+
+@pytest.mark.parametrize('name', ['deflate', 'zstd', 'lzw'])
+def test_written_file_uses_creation_options(tmp_path, name):
+    path = str(tmp_path / 'tile.tif')
+    data = np.arange(2 * 200 * 300, dtype='uint16').reshape(2, 200, 300)
+    with rasterio.open(path, 'w', **apply_output_profile(META, get_output_profile(name))) as dest:
+        dest.write(data)
+
+    with rasterio.open(path) as src:
+        assert src.profile['tiled'] and src.block_shapes[0] == (256, 256)
+        assert src.tags(ns='IMAGE_STRUCTURE')['COMPRESSION'] == name.upper()
+        assert src.tags(ns='IMAGE_STRUCTURE')['PREDICTOR'] == '2'
+        np.testing.assert_array_equal(src.read(), data)
@@ -0,0 +1,48 @@
+'''Проверка резервуарной выборки векторов'''
+import numpy as np
+
+from utils.reservoir import ReservoirSampler
+
+
+def stream(num_vectors: int) -> np.ndarray:
+    '''Поток векторов, первая координата которых - порядковый номер вектора'''
+    return np.repeat(np.arange(num_vectors, dtype=np.float32)[:, None], 3, axis=1)
+
+
+def test_sample_size():
+    sampler = ReservoirSampler(10)
+    assert len(sampler) == 0 and sampler.sample.shape == (0, 0)
+
+    sampler.add(stream(4))
+    sampler.add(np.empty((0, 3), dtype=np.float32))
+    assert len(sampler) == 4
+    np.testing.assert_array_equal(sampler.sample, stream(4))
+
+    vectors = stream(1000)
+    for start in range(4, 1000, 97):
+        sampler.add(vectors[start: start + 97])
+    assert sampler.num_seen == 1000
+    assert sampler.sample.shape == (10, 3)
+    # Выборка без возвращения: каждый вектор попадает в нее не больше одного раза
+    assert len(np.unique(sampler.sample[:, 0])) == 10
+
+
+def test_sample_is_uniform():
+    num_vectors, capacity, num_trials = 50, 10, 4000
+    counts = np.zeros(num_vectors, dtype=np.int64)
+    vectors = stream(num_vectors)
+    for seed in range(num_trials):
+        sampler = ReservoirSampler(capacity, seed=seed)
+        # Разбиение потока на пакеты не должно влиять на вероятность попадания в выборку
+        bounds = np.sort(np.random.default_rng(seed).choice(np.arange(1, num_vectors), 4, replace=False))
+        for batch in np.split(vectors, bounds):
+            sampler.add(batch)
+        counts[sampler.sample[:, 0].astype(np.int64)] += 1
+
+    # Каждый вектор попадает в выборку с вероятностью capacity / num_vectors
+    probability = capacity / num_vectors
+    expected = num_trials * probability
+    std = np.sqrt(num_trials * probability * (1 - probability))
+    assert np.all(np.abs(counts - expected) < 5 * std)
+    # Критерий хи-квадрат с 49 степенями свободы (критическое значение для уровня 0.001 - около 85)
+    assert np.sum((counts - expected) ** 2 / expected) / (1 - probability) < 85
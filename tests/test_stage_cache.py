@@ -0,0 +1,123 @@
+'''Проверка кэша этапов обработки снимков'''
+import os
+import pytest
+
+from stage_cache import StageCache, prepare_output_path
+
+
+@pytest.fixture
+def paths(tmp_path):
+    input_path = tmp_path / 'input.tif'
+    input_path.write_bytes(b'layout')
+    (tmp_path / 'output').mkdir()
+    return str(tmp_path / 'cache'), str(input_path), str(tmp_path / 'output')
+
+
+def produce(output_path, content):
+    '''Функция задачи, записывающая выходной файл с заданным содержимым, как этапы обработки снимков'''
+    calls = []
+
+    def run():
+        calls.append(output_path)
+        prepare_output_path(output_path)
+        with open(output_path, 'wb') as f:
+            f.write(content)
+        return [output_path]
+    return run, calls
+
+
+def test_hit_and_miss(paths):
+    cache_dir, input_path, output_dir = paths
+    output_path = os.path.join(output_dir, 'tile.tif')
+    run, calls = produce(output_path, b'tile')
+
+    cache = StageCache(cache_dir, 'crop')
+    assert cache.run(output_path, input_path, {'crop_size': 256}, run)
+    assert not cache.run(output_path, input_path, {'crop_size': 256}, run)
+
+    # Манифест читается при следующем запуске
+    cache = StageCache(cache_dir, 'crop')
+    assert not cache.run(output_path, input_path, {'crop_size': 256}, run)
+    # Изменение параметров этапа
+    assert cache.run(output_path, input_path, {'crop_size': 512}, run)
+    # Изменение времени изменения без изменения содержимого не сбрасывает ключ по содержимому
+    os.utime(input_path, ns=(0, 0))
+    assert not cache.run(output_path, input_path, {'crop_size': 512}, run)
+    # Изменение содержимого входного файла
+    with open(input_path, 'wb') as f:
+        f.write(b'new layout')
+    assert cache.run(output_path, input_path, {'crop_size': 512}, run)
+    assert len(calls) == 3
+
+
+def test_stat_mode_uses_size_and_mtime(paths):
+    cache_dir, input_path, output_dir = paths
+    output_path = os.path.join(output_dir, 'tile.tif')
+    run, calls = produce(output_path, b'tile')
+
+    cache = StageCache(cache_dir, 'crop', 'stat')
+    assert cache.run(output_path, input_path, {}, run)
+    assert not cache.run(output_path, input_path, {}, run)
+    os.utime(input_path, ns=(0, 0))
+    assert cache.run(output_path, input_path, {}, run)
+
+    with pytest.raises(ValueError):
+        StageCache(cache_dir, 'crop', 'md5')
+
+
+def test_restore_deleted_or_modified_output(paths):
+    cache_dir, input_path, output_dir = paths
+    output_path = os.path.join(output_dir, 'tile.tif')
+    run, calls = produce(output_path, b'tile')
+
+    cache = StageCache(cache_dir, 'crop')
+    cache.run(output_path, input_path, {}, run)
+    os.remove(output_path)
+    assert not cache.run(output_path, input_path, {}, run)
+    with open(output_path, 'rb') as f:
+        assert f.read() == b'tile'
+
+    # Запись поверх выходного файла после prepare_output_path не изменяет объект кэша
+    prepare_output_path(output_path)
+    with open(output_path, 'wb') as f:
+        f.write(b'changed')
+    assert not cache.run(output_path, input_path, {}, run)
+    with open(output_path, 'rb') as f:
+        assert f.read() == b'tile'
+    assert len(calls) == 1
+
+
+def test_identical_outputs_are_stored_once_and_unused_objects_are_removed(paths):
+    cache_dir, input_path, output_dir = paths
+    first, second = os.path.join(output_dir, 'first.tif'), os.path.join(output_dir, 'second.tif')
+
+    cache = StageCache(cache_dir, 'crop')
+    cache.run(first, input_path, {}, produce(first, b'tile')[0])
+    cache.run(second, input_path, {}, produce(second, b'tile')[0])
+    assert os.path.samefile(first, second)
+    objects = [os.path.join(root, file) for root, _, files in os.walk(cache.objects_dir) for file in files]
+    assert len(objects) == 1 and os.stat(objects[0]).st_nlink == 3
+
+    # Объект, на который больше не ссылается ни один выходной файл, удаляется при сохранении
+    cache.run(first, input_path, {'version': 2}, produce(first, b'new tile')[0])
+    cache.run(second, input_path, {'version': 2}, produce(second, b'new tile')[0])
+    cache.save()
+    objects = [os.path.join(root, file) for root, _, files in os.walk(cache.objects_dir) for file in files]
+    assert len(objects) == 1 and os.path.samefile(objects[0], first)
+
+    # Сохраненный манифест содержит только актуальные записи
+    with open(cache.path) as f:
+        assert len(f.readlines()) == 3
+    assert not StageCache(cache_dir, 'crop').run(first, input_path, {'version': 2}, produce(first, b'')[0])
+
+
+def test_truncated_manifest_line_is_ignored(paths):
+    cache_dir, input_path, output_dir = paths
+    output_path = os.path.join(output_dir, 'tile.tif')
+    run, calls = produce(output_path, b'tile')
+
+    StageCache(cache_dir, 'crop').run(output_path, input_path, {}, run)
+    with open(os.path.join(cache_dir, 'crop.jsonl'), 'a') as f:
+        f.write('{"task": "')
+    assert not StageCache(cache_dir, 'crop').run(output_path, input_path, {}, run)
+    assert len(calls) == 1
@@ -0,0 +1,47 @@
+'''Проверка журнала отправки данных векторов на сервер'''
+from utils.upload_outbox import UploadOutbox
+
+
+def test_pending_ack_round_trip(tmp_path):
+    outbox = UploadOutbox(str(tmp_path / 'outbox.jsonl'))
+    assert outbox.pending() == []
+    assert outbox.last_checkpoint() is None
+
+    outbox.add_pending([(0, 8), (8, 16)])
+    outbox.add_checkpoint(16)
+    outbox.ack(0, 8)
+
+    # Журнал читается заново, как при следующем запуске
+    reopened = UploadOutbox(outbox.path)
+    assert reopened.pending() == [(8, 16)]
+    assert reopened.last_checkpoint() == 16
+
+    reopened.add_pending([(16, 17)])
+    reopened.ack(8, 16)
+    assert reopened.pending() == [(16, 17)]
+    # Блок записан, но индекс с ним еще не сохранен
+    assert reopened.last_checkpoint() == 16
+
+    reopened.ack(16, 17)
+    assert reopened.pending() == []
+    reopened.clear()
+    assert not (tmp_path / 'outbox.jsonl').exists()
+    assert reopened.last_checkpoint() is None
+
+
+def test_pending_keeps_order_and_ignores_repeated_blocks(tmp_path):
+    outbox = UploadOutbox(str(tmp_path / 'outbox.jsonl'))
+    outbox.add_pending([(16, 24), (0, 8)])
+    outbox.add_pending([(0, 8), (8, 16)])
+    assert outbox.pending() == [(16, 24), (0, 8), (8, 16)]
+
+
+def test_truncated_last_line_is_ignored(tmp_path):
+    outbox = UploadOutbox(str(tmp_path / 'outbox.jsonl'))
+    outbox.add_pending([(0, 8), (8, 16)])
+    outbox.add_checkpoint(16)
+    with open(outbox.path, 'a') as f:
+        f.write('{"ack": [0, ')
+
+    assert outbox.pending() == [(0, 8), (8, 16)]
+    assert outbox.last_checkpoint() == 16
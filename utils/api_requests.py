@@ -1,64 +1,195 @@
+import gzip
+import json
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from typing import Callable, Optional, Set
 import requests
+from requests.adapters import HTTPAdapter
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
-def retry_request(max_attempts, time_sleep, initial_delay=1.5, backoff_factor=1.5):
-    def decorator(func):
-        def wrapper(*args, **kwargs):
-            delay = initial_delay
-            exception = None
-            for attempt in range(max_attempts):
-                try:
-                    result = func(*args, **kwargs)
-                    return result
-                except Exception as e:
-                    print(f"Попытка {attempt + 1} Ошибка:", e)
-                    exception = e
-                    if attempt < max_attempts - 1:
-                        # print(f"Повторная попытка через {delay} секунд...")
-                        # time.sleep(time_sleep)
-                        delay += backoff_factor
 
-            raise RuntimeError(
-                f"Не удалось выполнить функцию {func.__name__} после {max_attempts} попыток. Ошибка: {exception}")
+def dumps(data) -> bytes:
+    '''Функция для сериализации данных запроса в JSON (orjson, если установлен)'''
+    if orjson is not None:
+        return orjson.dumps(data)
+    return json.dumps(data, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
 
-        return wrapper
 
-    return decorator
+class ApiClient:
+    '''
+    Класс реализует функционал взаимодействия с API сервера. Запросы отправляются через одну сессию
+    с пулом keep-alive соединений, при ошибке соединения или ответе 429/5xx запрос повторяется
+    с экспоненциальной задержкой
 
+    Parameters
+    -------------
+    server_url: `str`
+        Адрес сервера
+    pool_size: `int`
+        Максимальное количество открытых соединений (не меньше количества одновременных запросов)
+    compress: `bool`
+        True если сжимать тело запроса gzip (сервер должен поддерживать Content-Encoding: gzip)
+    max_attempts: `int`
+        Количество попыток отправки запроса
+    initial_delay: `float`
+        Задержка перед второй попыткой (с), далее умножается на `backoff_factor`
+    backoff_factor: `float`
+        Множитель задержки
+    timeout: `float`
+        Время ожидания ответа сервера (с)
+    '''
 
-@retry_request(3, 3)
-def send_request(url, method="GET", data=None):
-    """
-    Отправляет запрос на сервер.
+    RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
 
-    Аргументы:
-    url (str): URL сервера.
-    method (str): HTTP метод запроса. По умолчанию "GET".
-    data (dict): Данные запроса. По умолчанию None.
+    def __init__(self, server_url: str, pool_size: int = 4, compress: bool = False, max_attempts: int = 3,
+                 initial_delay: float = 1.5, backoff_factor: float = 2.0, timeout: float = 60):
+        self.server_url = server_url
+        self.compress = compress
+        self.max_attempts = max_attempts
+        self.initial_delay = initial_delay
+        self.backoff_factor = backoff_factor
+        self.timeout = timeout
 
-    Возвращает:
-    response (requests.Response): Ответ сервера.
-    """
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
 
-    if method.upper() == "GET":
-        response = requests.get(url)
-    elif method.upper() == "POST":
-        response = requests.post(url, json=data)
-    elif method.upper() == "DELETE":
-        response = requests.delete(url)
-    else:
-        raise ValueError("Неподдерживаемый HTTP метод. Поддерживаются только GET и POST.")
+    def add_layer(self, data):
+        '''Фунция для добавления ифнормации о подложке в БД'''
+        return self.post('/api/v1/layers', data)
 
-    return response
+    def post(self, path: str, data) -> requests.Response:
+        '''Функция для отправки POST запроса с телом в JSON'''
+        body = dumps(data)
+        headers = {'Content-Type': 'application/json'}
+        if self.compress:
+            body = gzip.compress(body, compresslevel=1)
+            headers['Content-Encoding'] = 'gzip'
 
+        delay = self.initial_delay
+        for attempt in range(self.max_attempts):
+            try:
+                response = self.session.post(self.server_url + path, data=body, headers=headers, timeout=self.timeout)
+                if response.status_code not in self.RETRY_STATUS_CODES:
+                    return response
+                error = f'код ответа {response.status_code}'
+            except requests.RequestException as e:
+                error = e
+            print(f"Попытка {attempt + 1} Ошибка:", error)
+            if attempt < self.max_attempts - 1:
+                time.sleep(delay)
+                delay *= self.backoff_factor
 
-class ApiClient:
-    '''Класс реализует функционал взаимодействия с API сервера'''
+        raise RuntimeError(f'Не удалось отправить запрос {path} после {self.max_attempts} попыток. Ошибка: {error}')
 
-    def __init__(self, server_url: str):
-        self.server_url = server_url
+    def close(self):
+        self.session.close()
 
-    def add_layer(self, data):
-        '''Фунция для добавления ифнормации о подложке в БД'''
-        response = send_request(self.server_url + '/api/v1/layers', 'POST', data)
-        return response
+
+class UploadQueue:
+    '''
+    Класс реализует фоновую отправку данных на сервер: `submit` возвращается сразу, пока одновременно
+    отправляется меньше `max_in_flight` запросов, иначе ждет завершения одного из них. Это позволяет
+    добавлять следующие блоки в индекс FAISS, пока отправляются предыдущие
+
+    Parameters
+    -------------
+    send: `Callable`
+        Функция отправки одного запроса, возвращающая ответ сервера (например, `ApiClient.add_layer`)
+    max_in_flight: `int`
+        Максимальное количество одновременно отправляемых запросов
+    fail_fast: `bool`
+        True если пробрасывать ошибку отправки при следующей постановке в очередь, иначе только при ожидании очереди
+    '''
+
+    def __init__(self, send: Callable, max_in_flight: int = 4, fail_fast: bool = True):
+        self.send = send
+        self.fail_fast = fail_fast
+        self._executor = ThreadPoolExecutor(max_workers=max_in_flight)
+        self._slots = threading.BoundedSemaphore(max_in_flight)
+        # Хранятся только незавершенные запросы и первая ошибка, чтобы ответы сервера не копились до join
+        self._lock = threading.Lock()
+        self._pending: Set[Future] = set()
+        self._error: Optional[BaseException] = None
+
+    def submit(self, data, on_done: Callable = None) -> Future:
+        '''
+        Функция для постановки запроса в очередь отправки
+
+        Parameters
+        -------------
+        data:
+            Данные запроса
+        on_done: `Callable`
+            Функция, вызываемая с ответом сервера после успешной отправки (в потоке отправки)
+        '''
+        if self.fail_fast:
+            self._raise_failed()
+        self._slots.acquire()
+        try:
+            future = self._executor.submit(self._send, data, on_done)
+        except BaseException:
+            self._slots.release()
+            raise
+        with self._lock:
+            self._pending.add(future)
+        future.add_done_callback(self._on_done)
+        return future
+
+    def join(self):
+        '''Функция для ожидания отправки всех запросов, после чего пробрасывается первая ошибка отправки'''
+        with self._lock:
+            futures = list(self._pending)
+        wait(futures)
+        # Обратные вызовы завершения могут выполниться позже пробуждения wait
+        for future in futures:
+            self._on_done(future)
+        self._raise_failed()
+
+    def close(self):
+        try:
+            self.join()
+        finally:
+            self._executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self._executor.shutdown(wait=True)
+
+    def _send(self, data, on_done: Callable = None):
+        try:
+            response = self.send(data)
+            if on_done is not None:
+                on_done(response)
+            return response
+        finally:
+            self._slots.release()
+
+    def _on_done(self, future: Future):
+        '''Функция для удаления завершенного запроса из очереди с запоминанием первой ошибки отправки'''
+        error = None if future.cancelled() else future.exception()
+        with self._lock:
+            # Запрос учитывается один раз: обратный вызов и join могут обработать его оба
+            if future not in self._pending:
+                return
+            self._pending.remove(future)
+            if error is not None and self._error is None:
+                self._error = error
+
+    def _raise_failed(self):
+        '''Функция для проброса ошибки уже завершившихся запросов, чтобы не продолжать отправку после сбоя'''
+        with self._lock:
+            error, self._error = self._error, None
+        if error is not None:
+            raise error
@@ -4,6 +4,7 @@ from pathlib import Path
 import rasterio
 import numpy as np
 import logging
+from typing import Sequence
 from tqdm import tqdm
 # import cv2 as cv
 from PIL import Image
@@ -14,10 +15,21 @@ PATH_TO_IMAGES = f'{os.getcwd()}/data/18. Sitronics/1_20'
 PATH_TO_OUTPUT_DIR = 'output_crop'
 MAX_PIXEL_VALUE = 4096  # Max. pixel value, used to normalize the image
 BANDS = [1, 2, 3]
+# Нормирование входа модели, как в тестовых преобразованиях DTLSiameseNetwork (ToTensor + Normalize)
+NORMALIZE_MEAN = 0.1307
+NORMALIZE_STD = 0.3081
 
 
 def convert_tif2img(path, bands):
-    img = rasterio.open(path).read(bands).transpose((1, 2, 0))
+    with rasterio.open(path) as dataset:
+        img = dataset.read(bands)
+
+    return convert_array2img(img)
+
+
+def convert_array2img(img):
+    '''Функция для преобразования прочитанных каналов плитки (C, H, W) в 3-х канальное изображение'''
+    img = img.transpose((1, 2, 0))
 
     def normalize(image):
         # max_value = 4096
@@ -36,6 +48,50 @@ def convert_tif2img(path, bands):
     return image
 
 
+def convert_arrays2batch(images: Sequence[np.ndarray], out: np.ndarray = None) -> np.ndarray:
+    '''
+    Функция для векторизованного преобразования пакета плиток (C, H, W) одного размера во вход модели (N, C, H, W)
+    без промежуточных изображений PIL. Выполняет те же операции, что convert_array2img + ToTensor + Normalize:
+    log1p-нормирование по каждой плитке, приведение к uint8, перестановку каналов в BGR и нормирование
+
+    Parameters
+    -------------
+    images: `Sequence[np.ndarray]`
+        Прочитанные каналы плиток (C, H, W)
+    out: `np.ndarray`
+        Предвыделенный буфер float32 (не меньше N, C, H, W), в который записывается результат.
+        Если не задан или не подходит по размеру, выделяется новый
+
+    Returns
+    -------------
+    `np.ndarray`
+        Пакет float32 (N, C, H, W) - первые N строк буфера
+    '''
+    shape = (len(images),) + images[0].shape
+    if out is None or out.dtype != np.float32 or out.shape[0] < shape[0] or out.shape[1:] != shape[1:]:
+        out = np.empty(shape, dtype=np.float32)
+    batch = out[:shape[0]]
+
+    # Перестановка каналов в BGR и приведение к float32 за одно копирование
+    for ind, image in enumerate(images):
+        batch[ind] = image[::-1]
+
+    np.log1p(batch, out=batch)
+    min_value = batch.min(axis=(1, 2, 3), keepdims=True)
+    value_range = batch.max(axis=(1, 2, 3), keepdims=True) - min_value
+    value_range[value_range == 0] = 1
+    # линейное преобразование для нормирования пикселей, отбрасывание дробной части как при astype(np.uint8)
+    batch -= min_value
+    batch /= value_range
+    batch *= 255
+    np.trunc(batch, out=batch)
+
+    batch /= 255
+    batch -= NORMALIZE_MEAN
+    batch /= NORMALIZE_STD
+    return batch
+
+
 # def read_image(path, bands):
 #     img = rasterio.open(path).read(bands).transpose((1, 2, 0))
 #     # img = np.float32(img) / MAX_PIXEL_VALUE
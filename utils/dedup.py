@@ -0,0 +1,111 @@
+'''Данный модуль содержит поиск почти одинаковых перекрывающихся плиток для исключения их из индекса'''
+from collections import defaultdict
+import numpy as np
+from utils.metadata_store import TileMetadataStore
+
+
+def normalize_rows(vectors: np.ndarray) -> np.ndarray:
+    data = np.array(vectors, dtype=np.float32)
+    data /= np.maximum(np.linalg.norm(data, axis=1, keepdims=True), 1e-12)
+    return data
+
+
+def get_overlap(bounds: np.ndarray, ind: int, candidates: np.ndarray) -> np.ndarray:
+    '''Функция для вычисления доли площади плитки ind, покрытой каждой из плиток candidates (по ограничивающим прямоугольникам)'''
+    width = np.minimum(bounds[ind, 2], bounds[candidates, 2]) - np.maximum(bounds[ind, 0], bounds[candidates, 0])
+    height = np.minimum(bounds[ind, 3], bounds[candidates, 3]) - np.maximum(bounds[ind, 1], bounds[candidates, 1])
+    area = (bounds[ind, 2] - bounds[ind, 0]) * (bounds[ind, 3] - bounds[ind, 1])
+    return np.clip(width, 0, None) * np.clip(height, 0, None) / max(area, 1e-24)
+
+
+def find_group_aliases(vectors: np.ndarray, bounds: np.ndarray, threshold: float, min_overlap: float) -> np.ndarray:
+    '''
+    Функция для группировки почти одинаковых плиток одной подложки и одного разрешения
+
+    Плитки перебираются по порядку, первая неотнесенная к группе плитка становится представителем,
+    к ее группе относятся еще не распределенные плитки, которые перекрывают ее не меньше чем на `min_overlap`
+    и косинусное сходство векторов с ней не меньше `threshold`. Кандидаты ищутся по сетке с шагом в размер плитки,
+    поэтому сравниваются только соседние плитки, а плитки с похожими векторами в разных местах
+    (например, однородная вода) не объединяются и точность локализации не снижается
+
+    Parameters
+    -------------
+    vectors: `np.ndarray`
+        Нормализованные вектора плиток (N, D)
+    bounds: `np.ndarray`
+        Ограничивающие прямоугольники плиток (N, 4): min_x, min_y, max_x, max_y
+    threshold: `float`
+        Минимальное косинусное сходство с представителем
+    min_overlap: `float`
+        Минимальная доля площади представителя, перекрытая плиткой
+
+    Returns
+    -------------
+    `np.ndarray`
+        Номер представителя для каждой плитки (N,), для представителя - собственный номер
+    '''
+    num_tiles = len(vectors)
+    cell_x = max(float(np.median(bounds[:, 2] - bounds[:, 0])), 1e-12)
+    cell_y = max(float(np.median(bounds[:, 3] - bounds[:, 1])), 1e-12)
+    cells_x = np.floor(bounds[:, 0] / cell_x).astype(np.int64)
+    cells_y = np.floor(bounds[:, 1] / cell_y).astype(np.int64)
+    cells = defaultdict(list)
+    for ind in range(num_tiles):
+        cells[(cells_x[ind], cells_y[ind])].append(ind)
+
+    aliases = np.full(num_tiles, -1, dtype=np.int64)
+    for ind in range(num_tiles):
+        if aliases[ind] >= 0:
+            continue
+        aliases[ind] = ind
+        candidates = np.array([other for dx in (-1, 0, 1) for dy in (-1, 0, 1)
+                               for other in cells.get((cells_x[ind] + dx, cells_y[ind] + dy), ())], dtype=np.int64)
+        candidates = candidates[aliases[candidates] < 0]
+        if len(candidates) == 0:
+            continue
+        candidates = candidates[get_overlap(bounds, ind, candidates) >= min_overlap]
+        similarity = vectors[candidates] @ vectors[ind]
+        aliases[candidates[similarity >= threshold]] = ind
+    return aliases
+
+
+def find_aliases(vectors: np.ndarray, metadata_store: TileMetadataStore, start: int, end: int,
+                 threshold: float, min_overlap: float = 0.5) -> np.ndarray:
+    '''
+    Функция для поиска почти одинаковых плиток среди строк [start, end) отдельно для каждой подложки и разрешения.
+    Удаленные строки не группируются: они не могут быть представителями и представляют сами себя
+
+    Parameters
+    -------------
+    vectors: `np.ndarray`
+        Все подготовленные вектора (например, memmap), строка - faiss_id
+    metadata_store: `TileMetadataStore`
+        Хранилище данных плиток
+    start: `int`
+        Первая проверяемая строка
+    end: `int`
+        Строка, следующая за последней проверяемой
+    threshold: `float`
+        Минимальное косинусное сходство с представителем группы
+    min_overlap: `float`
+        Минимальная доля площади представителя, перекрытая плиткой группы
+
+    Returns
+    -------------
+    `np.ndarray`
+        Номер строки представителя для каждой строки [start, end), для представителя - собственный номер
+    '''
+    aliases = np.arange(start, end, dtype=np.int64)
+    if end <= start:
+        return aliases
+
+    corners = np.asarray(metadata_store.column('corners')[start: end])
+    bounds = np.concatenate([corners.min(axis=1), corners.max(axis=1)], axis=1)
+    groups = np.asarray(metadata_store.column('layout_id')[start: end], dtype=np.int64) << 16 | \
+        np.asarray(metadata_store.column('resolution_id')[start: end], dtype=np.int64)
+    is_deleted = np.isin(np.arange(start, end), metadata_store.deleted_rows())
+    for group in np.unique(groups[~is_deleted]):
+        rows = np.flatnonzero((groups == group) & ~is_deleted)
+        group_aliases = find_group_aliases(normalize_rows(vectors[start + rows]), bounds[rows], threshold, min_overlap)
+        aliases[rows] = start + rows[group_aliases]
+    return aliases
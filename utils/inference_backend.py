@@ -0,0 +1,186 @@
+'''Данный модуль содержит бэкенды инференса модели извлечения признаков: eager PyTorch, TorchScript и ONNX Runtime'''
+import copy
+import inspect
+import os
+import time
+from typing import Dict, List
+import numpy as np
+import torch
+import torch.nn as nn
+
+BACKENDS = ('eager', 'torchscript', 'onnx')
+
+
+def set_num_threads(num_intra_threads: int = 0, num_inter_threads: int = 0):
+    '''Функция для настройки количества потоков PyTorch внутри операции (intra-op) и между операциями (inter-op)'''
+    if num_intra_threads > 0:
+        torch.set_num_threads(num_intra_threads)
+    if num_inter_threads > 0:
+        try:
+            torch.set_num_interop_threads(num_inter_threads)
+        except RuntimeError as e:
+            # Количество inter-op потоков можно задать только до первого параллельного вычисления
+            print(f'Не удалось изменить количество inter-op потоков: {e}')
+
+
+class EmbeddingBackend:
+    '''
+    Класс реализует вычисление векторов признаков пакета изображений выбранным бэкендом
+
+    Parameters
+    -------------
+    embedding_net: `nn.Module`
+        Ветвь SiameseNet, вычисляющая вектор признаков
+    backend: `str`
+        Бэкенд инференса: `eager`, `torchscript` или `onnx`
+    quantize: `bool`
+        True если применять динамическое int8 квантование весов
+        (для eager и TorchScript квантуются только полносвязные слои, для ONNX Runtime - свертки и матричные умножения)
+    device: `torch.device`
+        Устройство для eager и TorchScript бэкендов. Квантованные модели и ONNX Runtime работают на CPU
+    image_size: `int`
+        Размер входного изображения, используется для трассировки модели
+    path_to_export: `str`
+        Путь (без расширения) для сохранения экспортированной модели. Если не задан, модель не сохраняется
+    num_intra_threads: `int`
+        Количество потоков внутри операции (0 - по умолчанию)
+    num_inter_threads: `int`
+        Количество потоков между операциями (0 - по умолчанию)
+    '''
+
+    def __init__(self, embedding_net: nn.Module, backend: str = 'eager', quantize: bool = False,
+                 device: torch.device = torch.device('cpu'), image_size: int = 256, path_to_export: str = None,
+                 num_intra_threads: int = 0, num_inter_threads: int = 0):
+        if backend not in BACKENDS:
+            raise ValueError(f'Неизвестный бэкенд инференса {backend}. Поддерживаются: {", ".join(BACKENDS)}')
+
+        self.backend = backend
+        self.quantize = quantize
+        self.device = torch.device('cpu') if quantize or backend == 'onnx' else device
+        set_num_threads(num_intra_threads, num_inter_threads)
+
+        if next(embedding_net.parameters()).device != self.device:
+            # Копия нужна, чтобы не переносить исходную модель на другое устройство
+            embedding_net = copy.deepcopy(embedding_net)
+        embedding_net = embedding_net.eval().to(self.device)
+        example_input = torch.zeros((1, 3, image_size, image_size), device=self.device)
+
+        if backend == 'eager':
+            self._model = self._quantize_torch(embedding_net)
+        elif backend == 'torchscript':
+            self._model = self._export_torchscript(embedding_net, example_input, path_to_export)
+        else:
+            self._session = self._export_onnx(embedding_net, example_input, path_to_export,
+                                              num_intra_threads, num_inter_threads)
+
+    @property
+    def name(self) -> str:
+        return f'{self.backend}-int8' if self.quantize else self.backend
+
+    def __call__(self, batch: torch.Tensor) -> np.ndarray:
+        '''Функция для вычисления векторов признаков пакета (N, 3, H, W)'''
+        if self.backend == 'onnx':
+            return self._session.run(None, {'input': batch.cpu().numpy()})[0]
+
+        with torch.no_grad():
+            return self._model(batch.to(self.device)).cpu().numpy()
+
+    def _quantize_torch(self, embedding_net: nn.Module) -> nn.Module:
+        if not self.quantize:
+            return embedding_net
+        return torch.ao.quantization.quantize_dynamic(embedding_net, {nn.Linear}, dtype=torch.qint8)
+
+    def _export_torchscript(self, embedding_net: nn.Module, example_input: torch.Tensor, path_to_export: str):
+        with torch.no_grad():
+            traced = torch.jit.trace(self._quantize_torch(embedding_net), example_input)
+            traced = torch.jit.optimize_for_inference(torch.jit.freeze(traced))
+
+        if path_to_export is not None:
+            os.makedirs(os.path.dirname(os.path.abspath(path_to_export)), exist_ok=True)
+            torch.jit.save(traced, f'{path_to_export}_int8.pt' if self.quantize else f'{path_to_export}.pt')
+        return traced
+
+    def _export_onnx(self, embedding_net: nn.Module, example_input: torch.Tensor, path_to_export: str,
+                     num_intra_threads: int, num_inter_threads: int):
+        # torch.onnx.export требует пакет onnx, инференс - onnxruntime (оба есть в requirements.txt)
+        try:
+            import onnx  # noqa: F401
+            import onnxruntime
+        except ImportError as e:
+            raise ImportError(f'Для бэкенда onnx (INFERENCE_BACKEND=onnx) необходимо установить пакеты onnx и onnxruntime: '
+                              f'pip install onnx onnxruntime ({e})') from e
+
+        path_to_onnx = f'{path_to_export or "/tmp/embedding_net"}.onnx'
+        os.makedirs(os.path.dirname(os.path.abspath(path_to_onnx)), exist_ok=True)
+        export_kwargs = {}
+        if 'dynamo' in inspect.signature(torch.onnx.export).parameters:
+            # В новых версиях PyTorch по умолчанию используется экспорт через dynamo, нужен классический трассировщик
+            export_kwargs['dynamo'] = False
+        torch.onnx.export(embedding_net, example_input, path_to_onnx, input_names=['input'], output_names=['output'],
+                          dynamic_axes={'input': {0: 'batch'}, 'output': {0: 'batch'}}, **export_kwargs)
+
+        if self.quantize:
+            from onnxruntime.quantization import quantize_dynamic, QuantType
+
+            path_to_quantized = path_to_onnx.replace('.onnx', '_int8.onnx')
+            quantize_dynamic(path_to_onnx, path_to_quantized, weight_type=QuantType.QInt8)
+            path_to_onnx = path_to_quantized
+
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if num_intra_threads > 0:
+            options.intra_op_num_threads = num_intra_threads
+        if num_inter_threads > 0:
+            options.inter_op_num_threads = num_inter_threads
+        return onnxruntime.InferenceSession(path_to_onnx, options, providers=['CPUExecutionProvider'])
+
+
+def compare_backends(reference: EmbeddingBackend, backends: List[EmbeddingBackend], batches: List[torch.Tensor],
+                     repeats: int = 3) -> Dict[str, Dict[str, float]]:
+    '''
+    Функция для сравнения бэкендов инференса с эталонным (eager float32): замеряется скорость (изобр./сек)
+    и отклонение векторов признаков по косинусному сходству
+
+    Parameters
+    -------------
+    reference: `EmbeddingBackend`
+        Эталонный бэкенд
+    backends: `List[EmbeddingBackend]`
+        Сравниваемые бэкенды
+    batches: `List[torch.Tensor]`
+        Пакеты изображений, на которых производится сравнение
+    repeats: `int`
+        Количество повторов замера скорости, берется лучший результат
+
+    Returns
+    -------------
+    `Dict[str, Dict[str, float]]`
+        Для каждого бэкенда: скорость, среднее и минимальное косинусное сходство с эталоном
+    '''
+    num_images = sum(len(batch) for batch in batches)
+
+    def normalize(vectors):
+        return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+    reference_vectors = normalize(np.vstack([reference(batch) for batch in batches]))
+
+    results = {}
+    for backend in [reference] + backends:
+        backend(batches[0])  # Прогрев
+        best_time = float('inf')
+        for _ in range(repeats):
+            start_time = time.perf_counter()
+            vectors = [backend(batch) for batch in batches]
+            best_time = min(best_time, time.perf_counter() - start_time)
+
+        similarity = np.sum(normalize(np.vstack(vectors)) * reference_vectors, axis=1)
+        results[backend.name] = {
+            'images_per_sec': num_images / best_time,
+            'mean_cosine_similarity': float(np.mean(similarity)),
+            'min_cosine_similarity': float(np.min(similarity)),
+        }
+        print(f'{backend.name:>16}: {results[backend.name]["images_per_sec"]:.1f} изобр./сек, '
+              f'косинусное сходство с эталоном: среднее {results[backend.name]["mean_cosine_similarity"]:.6f}, '
+              f'минимальное {results[backend.name]["min_cosine_similarity"]:.6f}')
+
+    return results
@@ -0,0 +1,263 @@
+'''Данный модуль содержит колоночное хранилище данных плиток, строка i которого соответствует faiss_id i'''
+import json
+import os
+import shutil
+from typing import Dict, List, Tuple
+import numpy as np
+from shapely.geometry import Polygon
+from shapely import wkt
+from utils.npy_store import NpyStore
+
+
+class TileMetadataStore:
+    '''
+    Класс реализует колоночное хранилище данных плиток в каталоге:
+    - corners.npy - координаты 4-х углов плитки (EPSG:4326), float64 (N, 4, 2);
+    - layout_id.npy - номер подложки в словаре подложек, int32 (N,);
+    - resolution_id.npy - номер разрешения (dim_space_x, dim_space_y) в словаре разрешений, int16 (N,);
+    - filename_end.npy и filenames.bin - имена файлов в кодировке utf-8, записанные подряд, и смещения их концов;
+    - dictionaries.json - словари подложек и разрешений;
+    - deleted_rows.npy - номера строк, вектора которых удалены из индекса, int64 (создается при первом удалении);
+    - alias.npy - номер строки представителя группы почти одинаковых плиток, int64 (N,) (создается при поиске дубликатов).
+
+    Колонки дописываются порциями через memmap и загружаются лениво (только при обращении),
+    поэтому получение строки по номеру не требует чтения всего хранилища.
+    Строки не удаляются, чтобы не сдвигать faiss_id, а только помечаются удаленными.
+
+    Parameters
+    -------------
+    path: `str`
+        Путь до каталога хранилища
+    chunk_rows: `int`
+        Количество строк, на которое увеличиваются колонки при заполнении
+    '''
+    COLUMNS = {
+        'corners': ((4, 2), np.float64),
+        'layout_id': ((), np.int32),
+        'resolution_id': ((), np.int16),
+        'filename_end': ((), np.int64),
+    }
+
+    def __init__(self, path: str, chunk_rows: int = 65536):
+        self.path = path
+        self.chunk_rows = chunk_rows
+
+        with open(self._path_to_dictionaries, 'r') as f:
+            dictionaries = json.load(f)
+        self.layouts: List[str] = dictionaries['layouts']
+        self.resolutions: List[Tuple[int, int]] = [tuple(item) for item in dictionaries['resolutions']]
+        self._layout_ids = {name: ind for ind, name in enumerate(self.layouts)}
+        self._resolution_ids = {item: ind for ind, item in enumerate(self.resolutions)}
+
+        self._columns: Dict[str, np.ndarray] = {}
+        self._writers: Dict[str, NpyStore] = {}
+        self._filenames = None
+
+    @classmethod
+    def create(cls, path: str, chunk_rows: int = 65536):
+        '''Функция для создания пустого хранилища (существующее хранилище перезаписывается)'''
+        os.makedirs(path, exist_ok=True)
+        for name, (row_shape, dtype) in cls.COLUMNS.items():
+            NpyStore.create(os.path.join(path, f'{name}.npy'), row_shape, dtype, chunk_rows=1).close()
+        open(os.path.join(path, 'filenames.bin'), 'wb').close()
+        for name in ('deleted_rows.npy', 'alias.npy'):
+            if os.path.exists(os.path.join(path, name)):
+                os.remove(os.path.join(path, name))
+        with open(os.path.join(path, 'dictionaries.json'), 'w') as f:
+            json.dump({'layouts': [], 'resolutions': []}, f)
+        return cls(path, chunk_rows)
+
+    @classmethod
+    def from_records(cls, path: str, records: List[Dict], chunk_rows: int = 65536):
+        '''Функция для создания хранилища из списка словарей (формат prepared_vectors_data.json)'''
+        store = cls.create(path, chunk_rows)
+        for start in range(0, len(records), chunk_rows):
+            block = records[start: start + chunk_rows]
+            corners = np.array([wkt.loads(item['polygon_coordinates']).exterior.coords[:4] for item in block])
+            store.append(block, corners)
+        store.close()
+        return store
+
+    def __len__(self):
+        if 'layout_id' in self._writers:
+            return len(self._writers['layout_id'])
+        return len(self.column('layout_id'))
+
+    def column(self, name: str) -> np.ndarray:
+        '''Функция для ленивой загрузки колонки (без копирования в память)'''
+        if name in self._writers:
+            return self._writers[name].array
+        if name not in self._columns:
+            self._columns[name] = NpyStore.load(os.path.join(self.path, f'{name}.npy'))
+        return self._columns[name]
+
+    def append(self, items: List[Dict], corners: np.ndarray):
+        '''
+        Функция для дозаписи данных плиток
+
+        Parameters
+        -------------
+        items: `List[Dict]`
+            Данные плиток: layout_name, dim_space_x, dim_space_y, filename
+        corners: `np.ndarray`
+            Координаты углов плиток (N, 4, 2)
+        '''
+        self._open_writers()
+
+        filenames = [item['filename'].encode('utf-8') for item in items]
+        filename_start = self._writers['filename_end'].array[-1] if len(self._writers['filename_end']) else 0
+        with open(os.path.join(self.path, 'filenames.bin'), 'ab') as f:
+            f.write(b''.join(filenames))
+
+        self._writers['corners'].append(corners)
+        self._writers['layout_id'].append([self._encode_layout(item['layout_name']) for item in items])
+        self._writers['resolution_id'].append(
+            [self._encode_resolution((item['dim_space_x'], item['dim_space_y'])) for item in items])
+        self._writers['filename_end'].append(filename_start + np.cumsum([len(name) for name in filenames]))
+
+    def extend(self, other: 'TileMetadataStore'):
+        '''Функция для дозаписи всех строк другого хранилища (номера в словарях пересчитываются)'''
+        self._open_writers()
+        layout_ids = np.array([self._encode_layout(name) for name in other.layouts], dtype=np.int32)
+        resolution_ids = np.array([self._encode_resolution(item) for item in other.resolutions], dtype=np.int16)
+
+        filename_start = self._writers['filename_end'].array[-1] if len(self._writers['filename_end']) else 0
+        with open(os.path.join(self.path, 'filenames.bin'), 'ab') as f_out, \
+                open(os.path.join(other.path, 'filenames.bin'), 'rb') as f_in:
+            shutil.copyfileobj(f_in, f_out)
+
+        for start in range(0, len(other), self.chunk_rows):
+            end = start + self.chunk_rows
+            self._writers['corners'].append(other.column('corners')[start:end])
+            self._writers['layout_id'].append(layout_ids[other.column('layout_id')[start:end]])
+            self._writers['resolution_id'].append(resolution_ids[other.column('resolution_id')[start:end]])
+            self._writers['filename_end'].append(filename_start + other.column('filename_end')[start:end])
+
+    def flush(self):
+        for writer in self._writers.values():
+            writer.flush()
+        path_to_tmp = self._path_to_dictionaries + '.tmp'
+        with open(path_to_tmp, 'w') as f:
+            json.dump({'layouts': self.layouts, 'resolutions': self.resolutions}, f)
+        os.replace(path_to_tmp, self._path_to_dictionaries)
+
+    def close(self):
+        '''Функция для завершения записи: колонки обрезаются до фактического количества строк'''
+        self.flush()
+        for writer in self._writers.values():
+            writer.close()
+        self._writers = {}
+
+    def layout_name(self, row: int) -> str:
+        return self.layouts[self.column('layout_id')[row]]
+
+    def resolution(self, row: int) -> Tuple[int, int]:
+        return self.resolutions[self.column('resolution_id')[row]]
+
+    def filename(self, row: int) -> str:
+        filename_end = self.column('filename_end')
+        start = int(filename_end[row - 1]) if row > 0 else 0
+        if self._filenames is None:
+            path_to_filenames = os.path.join(self.path, 'filenames.bin')
+            if os.path.getsize(path_to_filenames) == 0:
+                return ''
+            self._filenames = np.memmap(path_to_filenames, dtype=np.uint8, mode='r')
+        return self._filenames[start: int(filename_end[row])].tobytes().decode('utf-8')
+
+    def polygon(self, row: int) -> Polygon:
+        return Polygon(self.column('corners')[row])
+
+    def get_record(self, row: int) -> Dict:
+        '''Функция для получения данных плитки по faiss_id в формате, который отправляется на сервер'''
+        dim_space_x, dim_space_y = self.resolution(row)
+        return {
+            'faiss_id': row,
+            'polygon_coordinates': str(self.polygon(row)),
+            'layout_name': self.layout_name(row),
+            'dim_space_x': int(dim_space_x),
+            'dim_space_y': int(dim_space_y),
+            'filename': self.filename(row),
+        }
+
+    def get_records(self, start: int, end: int) -> List[Dict]:
+        return [self.get_record(row) for row in range(start, end)]
+
+    def layout_rows(self, layout_names: List[str]) -> np.ndarray:
+        '''Функция для получения номеров неудаленных строк указанных подложек'''
+        layout_ids = [self._layout_ids[name] for name in layout_names if name in self._layout_ids]
+        rows = np.flatnonzero(np.isin(self.column('layout_id'), layout_ids))
+        return np.setdiff1d(rows, self.deleted_rows(), assume_unique=True)
+
+    def mark_deleted(self, rows: List[int]):
+        '''Функция для пометки строк удаленными'''
+        rows = np.asarray(rows, dtype=np.int64)
+        if len(rows) == 0:
+            return
+        if os.path.exists(self._path_to_deleted_rows):
+            deleted_store = NpyStore.open(self._path_to_deleted_rows, self.chunk_rows)
+        else:
+            deleted_store = NpyStore.create(self._path_to_deleted_rows, (), np.int64, self.chunk_rows)
+        deleted_store.append(rows)
+        deleted_store.close()
+
+    def deleted_rows(self) -> np.ndarray:
+        '''Функция для получения отсортированных номеров удаленных строк'''
+        if not os.path.exists(self._path_to_deleted_rows):
+            return np.empty(0, dtype=np.int64)
+        return np.unique(NpyStore.load(self._path_to_deleted_rows))
+
+    def set_aliases(self, start: int, aliases: np.ndarray):
+        '''
+        Функция для записи представителей строк [start, start + len(aliases)) (ранее записанные с start заменяются).
+        Вектор строки, представитель которой не она сама, не добавляется в индекс.
+        Строки до start без записанного представителя представляют сами себя
+        '''
+        previous = NpyStore.load(self._path_to_aliases) if os.path.exists(self._path_to_aliases) else None
+        if previous is not None and len(previous) <= start:
+            alias_store = NpyStore.open(self._path_to_aliases, self.chunk_rows)
+        else:
+            # Представители строк от start записываются заново
+            previous = np.array(previous[:start]) if previous is not None else np.empty(0, dtype=np.int64)
+            alias_store = NpyStore.create(self._path_to_aliases, (), np.int64, self.chunk_rows)
+            alias_store.append(previous)
+        alias_store.append(np.arange(len(alias_store), start, dtype=np.int64))
+        alias_store.append(np.asarray(aliases, dtype=np.int64))
+        alias_store.close()
+
+    def aliases(self) -> np.ndarray:
+        '''Функция для получения номера строки представителя для каждой строки'''
+        aliases = NpyStore.load(self._path_to_aliases) if os.path.exists(self._path_to_aliases) \
+            else np.empty(0, dtype=np.int64)
+        return np.concatenate([aliases, np.arange(len(aliases), len(self), dtype=np.int64)])
+
+    def _open_writers(self):
+        if not self._writers:
+            self._columns.clear()
+            self._filenames = None
+            self._writers = {name: NpyStore.open(os.path.join(self.path, f'{name}.npy'), self.chunk_rows)
+                             for name in self.COLUMNS}
+
+    @property
+    def _path_to_dictionaries(self):
+        return os.path.join(self.path, 'dictionaries.json')
+
+    @property
+    def _path_to_deleted_rows(self):
+        return os.path.join(self.path, 'deleted_rows.npy')
+
+    @property
+    def _path_to_aliases(self):
+        return os.path.join(self.path, 'alias.npy')
+
+    def _encode_layout(self, layout_name: str) -> int:
+        if layout_name not in self._layout_ids:
+            self._layout_ids[layout_name] = len(self.layouts)
+            self.layouts.append(layout_name)
+        return self._layout_ids[layout_name]
+
+    def _encode_resolution(self, resolution: Tuple[int, int]) -> int:
+        resolution = (int(resolution[0]), int(resolution[1]))
+        if resolution not in self._resolution_ids:
+            self._resolution_ids[resolution] = len(self.resolutions)
+            self.resolutions.append(resolution)
+        return self._resolution_ids[resolution]
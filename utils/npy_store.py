@@ -0,0 +1,159 @@
+'''Данный модуль содержит дописываемый массив .npy на диске, заполняемый порциями через memmap'''
+import os
+from io import BytesIO
+from typing import Tuple
+import numpy as np
+
+
+class NpyStore:
+    '''
+    Класс реализует массив формата .npy, который дописывается построчно без накопления всего массива в памяти.
+    Файл размечается порциями по `chunk_rows` строк и отображается в память (memmap), заголовок .npy
+    переписывается на месте при каждом сбросе на диск, поэтому файл в любой момент читается через `np.load`.
+
+    Parameters
+    -------------
+    path: `str`
+        Путь до файла .npy
+    row_shape: `Tuple[int, ...]`
+        Размерность одной строки массива
+    dtype: `np.dtype`
+        Тип элементов массива
+    chunk_rows: `int`
+        Количество строк, на которое увеличивается файл при заполнении
+    '''
+
+    def __init__(self, path: str, row_shape: Tuple[int, ...], dtype=np.float32, chunk_rows: int = 65536):
+        self.path = path
+        self.row_shape = tuple(row_shape)
+        self.dtype = np.dtype(dtype)
+        self.chunk_rows = chunk_rows
+
+        self._num_rows = 0
+        self._capacity = 0
+        self._offset = None
+        self._memmap = None
+
+    @classmethod
+    def create(cls, path: str, row_shape: Tuple[int, ...], dtype=np.float32, chunk_rows: int = 65536):
+        '''Функция для создания пустого хранилища (существующий файл перезаписывается)'''
+        store = cls(path, row_shape, dtype, chunk_rows)
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path, 'wb') as f:
+            store._write_header(f)
+            store._offset = f.tell()
+        store._resize(chunk_rows)
+        return store
+
+    @classmethod
+    def open(cls, path: str, chunk_rows: int = 65536):
+        '''Функция для открытия существующего файла .npy на дозапись'''
+        with open(path, 'rb') as f:
+            version = np.lib.format.read_magic(f)
+            if version == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+            else:
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+            offset = f.tell()
+
+        if fortran_order:
+            raise ValueError(f'Массив {path} хранится в порядке Fortran и не может быть дописан')
+
+        store = cls(path, shape[1:], dtype, chunk_rows)
+        store._num_rows = store._capacity = shape[0]
+        store._offset = offset
+
+        # Заголовки, записанные без запаса под рост первой размерности, переписываются вместе с данными
+        if len(store._header_bytes()) != offset:
+            store._rewrite()
+
+        store._resize(store._num_rows + chunk_rows)
+        return store
+
+    @staticmethod
+    def load(path: str) -> np.ndarray:
+        '''Функция для загрузки массива без копирования в память (только чтение)'''
+        return np.load(path, mmap_mode='r')
+
+    def __len__(self):
+        return self._num_rows
+
+    @property
+    def array(self) -> np.ndarray:
+        '''Записанная часть массива'''
+        return self._memmap[:self._num_rows]
+
+    def append(self, rows: np.ndarray) -> int:
+        '''Функция для дозаписи строк в конец массива. Возвращает индекс первой записанной строки'''
+        rows = np.asarray(rows).reshape((-1,) + self.row_shape)
+        start = self._num_rows
+        end = start + rows.shape[0]
+        if end > self._capacity:
+            num_chunks = (end - self._capacity + self.chunk_rows - 1) // self.chunk_rows
+            self._resize(self._capacity + num_chunks * self.chunk_rows)
+
+        self._memmap[start:end] = rows
+        self._num_rows = end
+        return start
+
+    def flush(self):
+        '''Функция для сброса записанных строк на диск и обновления заголовка'''
+        if self._memmap is not None:
+            self._memmap.flush()
+        with open(self.path, 'r+b') as f:
+            self._write_header(f)
+
+    def close(self):
+        '''Функция для завершения записи: файл обрезается до фактического количества строк'''
+        self.flush()
+        self._memmap = None
+        with open(self.path, 'r+b') as f:
+            f.truncate(self._offset + self._num_rows * self._row_nbytes)
+        self._capacity = self._num_rows
+
+    @property
+    def _row_nbytes(self):
+        return int(np.prod(self.row_shape, dtype=np.int64)) * self.dtype.itemsize
+
+    def _header_bytes(self) -> bytes:
+        header = BytesIO()
+        np.lib.format.write_array_header_1_0(header, {
+            'descr': np.lib.format.dtype_to_descr(self.dtype),
+            'fortran_order': False,
+            'shape': (self._num_rows,) + self.row_shape,
+        })
+        return header.getvalue()
+
+    def _write_header(self, f):
+        header = self._header_bytes()
+        # Заголовок .npy дополняется пробелами с запасом под рост первой размерности, поэтому его длина постоянна
+        if self._offset is not None and len(header) != self._offset:
+            raise RuntimeError(f'Не удалось обновить заголовок {self.path}: изменилась его длина')
+        f.seek(0)
+        f.write(header)
+
+    def _resize(self, capacity: int):
+        if self._memmap is not None:
+            self._memmap.flush()
+        self._memmap = None
+        with open(self.path, 'r+b') as f:
+            f.truncate(self._offset + capacity * self._row_nbytes)
+        self._capacity = capacity
+        if capacity:
+            self._memmap = np.memmap(self.path, dtype=self.dtype, mode='r+', offset=self._offset,
+                                     shape=(capacity,) + self.row_shape)
+
+    def _rewrite(self):
+        '''Функция для перезаписи файла с заголовком нового формата (данные копируются порциями)'''
+        old_offset = self._offset
+        source = np.memmap(self.path, dtype=self.dtype, mode='r', offset=old_offset,
+                           shape=(self._num_rows,) + self.row_shape)
+        path_to_tmp = self.path + '.tmp'
+        with open(path_to_tmp, 'wb') as f:
+            self._offset = None
+            self._write_header(f)
+            self._offset = f.tell()
+            for start in range(0, self._num_rows, self.chunk_rows):
+                f.write(np.ascontiguousarray(source[start: start + self.chunk_rows]).tobytes())
+        del source
+        os.replace(path_to_tmp, self.path)
@@ -0,0 +1,55 @@
+'''Данный модуль содержит резервуарную выборку векторов фиксированного размера из потока неизвестной длины'''
+import numpy as np
+
+
+class ReservoirSampler:
+    '''
+    Класс реализует равномерную выборку без возвращения из потока векторов (алгоритм R, векторизованный по пакетам).
+    Память ограничена размером выборки независимо от количества просмотренных векторов
+
+    Parameters
+    -------------
+    capacity: `int`
+        Размер выборки
+    seed: `int`
+        Зерно генератора случайных чисел
+    '''
+
+    def __init__(self, capacity: int, seed: int = 0):
+        self.capacity = capacity
+        self.num_seen = 0
+        self._rng = np.random.default_rng(seed)
+        self._reservoir = None
+
+    def __len__(self):
+        return min(self.num_seen, self.capacity)
+
+    @property
+    def sample(self) -> np.ndarray:
+        '''Текущая выборка (float32, не более capacity строк)'''
+        if self._reservoir is None:
+            return np.empty((0, 0), dtype=np.float32)
+        return self._reservoir[:len(self)]
+
+    def add(self, vectors: np.ndarray):
+        '''Функция для добавления пакета векторов (N, D) в поток'''
+        num_vectors = len(vectors)
+        if num_vectors == 0:
+            return
+        if self._reservoir is None:
+            self._reservoir = np.empty((self.capacity, vectors.shape[1]), dtype=np.float32)
+
+        # Пока выборка не заполнена, вектора записываются подряд
+        num_fill = max(0, min(self.capacity - self.num_seen, num_vectors))
+        if num_fill:
+            self._reservoir[self.num_seen: self.num_seen + num_fill] = vectors[:num_fill]
+
+        # Вектор с порядковым номером i заменяет случайный элемент выборки с вероятностью capacity / (i + 1).
+        # При совпадении позиций побеждает последний вектор, как и при последовательной обработке
+        if num_fill < num_vectors:
+            positions = np.arange(self.num_seen + num_fill, self.num_seen + num_vectors)
+            slots = (self._rng.random(len(positions)) * (positions + 1)).astype(np.int64)
+            selected = np.flatnonzero(slots < self.capacity)
+            self._reservoir[slots[selected]] = vectors[num_fill + selected]
+
+        self.num_seen += num_vectors
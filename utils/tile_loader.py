@@ -0,0 +1,71 @@
+'''Данный модуль содержит загрузчик плиток (кропов), читающий GeoTIFF в фоновых потоках с ограниченной предвыборкой'''
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from typing import Any, Iterator, Sequence, Tuple
+import rasterio
+
+# Пакет прочитанных плиток: пиксели выбранных каналов (C, H, W), геопривязка и сопутствующие данные каждой плитки
+TileBatch = namedtuple('TileBatch', ['pixels', 'transforms', 'items'])
+
+
+def read_tile(path_to_tile: str, bands: Tuple[int, ...] = (1, 2, 3)):
+    '''Функция для чтения плитки за одно открытие файла. Возвращает пиксели выбранных каналов и геопривязку'''
+    with rasterio.open(path_to_tile) as dataset:
+        return dataset.read(bands), dataset.transform
+
+
+class TileLoader:
+    '''
+    Класс реализует загрузку плиток пакетами. Чтение и декодирование GeoTIFF выполняется пулом фоновых потоков
+    (rasterio освобождает GIL на время чтения), поэтому следующий пакет готовится, пока модель обрабатывает текущий.
+    Количество плиток, прочитанных заранее, ограничено `prefetch_batches * batch_size`.
+
+    Parameters
+    -------------
+    items: `Sequence[Tuple[str, Any]]`
+        Пары (путь до плитки, сопутствующие данные плитки)
+    batch_size: `int`
+        Количество плиток в пакете
+    num_workers: `int`
+        Количество потоков чтения
+    prefetch_batches: `int`
+        Количество пакетов, читаемых заранее
+    bands: `Tuple[int, ...]`
+        Читаемые каналы
+    '''
+
+    def __init__(self, items: Sequence[Tuple[str, Any]], batch_size: int, num_workers: int = 4,
+                 prefetch_batches: int = 2, bands: Tuple[int, ...] = (1, 2, 3)):
+        self.items = items
+        self.batch_size = batch_size
+        self.num_workers = num_workers
+        self.prefetch_batches = prefetch_batches
+        self.bands = bands
+
+    def __len__(self):
+        return (len(self.items) + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self) -> Iterator[TileBatch]:
+        max_pending = max(self.prefetch_batches, 1) * self.batch_size
+        items = iter(self.items)
+        pending = deque()
+
+        with ThreadPoolExecutor(max_workers=self.num_workers) as executor:
+            def submit():
+                for path_to_tile, item in islice(items, max_pending - len(pending)):
+                    pending.append((item, executor.submit(read_tile, path_to_tile, self.bands)))
+
+            submit()
+            batch = TileBatch([], [], [])
+            while pending:
+                item, future = pending.popleft()
+                pixels, transform = future.result()
+                batch.pixels.append(pixels)
+                batch.transforms.append(transform)
+                batch.items.append(item)
+                submit()
+
+                if len(batch.items) == self.batch_size or not pending:
+                    yield batch
+                    batch = TileBatch([], [], [])
@@ -0,0 +1,79 @@
+'''Данный модуль содержит манифест плиток, по которому определяются новые и измененные плитки набора данных'''
+import json
+import os
+from typing import Dict, List, Tuple
+
+
+class TileManifest:
+    '''
+    Класс реализует манифест обработанных плиток: для каждого пути хранится размер файла, время его изменения
+    и номер строки вектора признаков (он же faiss_id)
+
+    Parameters
+    -------------
+    entries: `Dict[str, List[int]]`
+        Записи манифеста вида {путь: [размер, время изменения (нс), номер строки]}
+    '''
+
+    def __init__(self, entries: Dict[str, List[int]] = None):
+        self.entries = entries if entries is not None else {}
+
+    @staticmethod
+    def stat(path_to_tile: str) -> Tuple[int, int]:
+        '''Функция для получения отпечатка файла: размер и время изменения'''
+        stat = os.stat(path_to_tile)
+        return stat.st_size, stat.st_mtime_ns
+
+    @classmethod
+    def load(cls, path: str):
+        with open(path, 'r') as f:
+            return cls(json.load(f))
+
+    def save(self, path: str):
+        path_to_tmp = path + '.tmp'
+        with open(path_to_tmp, 'w') as f:
+            json.dump(self.entries, f)
+        os.replace(path_to_tmp, path)
+
+    def add(self, path_to_tile: str, row: int, fingerprint: Tuple[int, int] = None):
+        size, mtime_ns = fingerprint if fingerprint is not None else self.stat(path_to_tile)
+        self.entries[path_to_tile] = [size, mtime_ns, row]
+
+    def diff(self, paths: List[str]) -> Tuple[List[str], List[int]]:
+        '''
+        Функция для сравнения текущего списка плиток с манифестом
+
+        Returns
+        -------------
+        `List[str]`
+            Пути новых и измененных плиток
+        `List[int]`
+            Номера строк, которые больше не актуальны (плитка изменена или удалена)
+        '''
+        changed, stale_rows = [], []
+        for path_to_tile in paths:
+            entry = self.entries.get(path_to_tile)
+            if entry is None:
+                changed.append(path_to_tile)
+            elif tuple(entry[:2]) != self.stat(path_to_tile):
+                changed.append(path_to_tile)
+                stale_rows.append(entry[2])
+
+        current_paths = set(paths)
+        for path_to_tile, entry in self.entries.items():
+            if path_to_tile not in current_paths:
+                stale_rows.append(entry[2])
+
+        return changed, stale_rows
+
+    def remove_missing(self, paths: List[str]):
+        '''Функция для удаления из манифеста плиток, которых больше нет в наборе данных'''
+        current_paths = set(paths)
+        for path_to_tile in [path for path in self.entries if path not in current_paths]:
+            del self.entries[path_to_tile]
+
+    def remove_rows(self, rows: List[int]):
+        '''Функция для удаления из манифеста плиток с указанными номерами строк'''
+        rows = set(rows)
+        for path_to_tile in [path for path, entry in self.entries.items() if entry[2] in rows]:
+            del self.entries[path_to_tile]
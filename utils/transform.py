@@ -1,11 +1,21 @@
+from functools import lru_cache
+from typing import Sequence
+import numpy as np
+from affine import Affine
 from shapely.geometry import Polygon
 from shapely.ops import transform
 from pyproj import Transformer
 
 
+@lru_cache(maxsize=None)
+def get_transformer(from_crs: str, to_crs: str) -> Transformer:
+    '''Функция возвращает трансформер для пары систем координат (создается один раз и переиспользуется)'''
+    return Transformer.from_crs(from_crs, to_crs, always_xy=True)
+
+
 def transform_polygon(polygon: Polygon, from_crs: str, to_crs: str) -> Polygon:
-    # Создание трансформера для преобразования координат
-    transformer = Transformer.from_crs(from_crs, to_crs, always_xy=True)
+    # Получение трансформера для преобразования координат
+    transformer = get_transformer(from_crs, to_crs)
 
     # Функция для преобразования координат
     def transform_coords(x, y):
@@ -17,6 +27,41 @@ def transform_polygon(polygon: Polygon, from_crs: str, to_crs: str) -> Polygon:
     return transformed_polygon
 
 
+def transform_footprints(transforms: Sequence[Affine], widths: Sequence[int], heights: Sequence[int],
+                         from_crs: str, to_crs: str) -> np.ndarray:
+    '''
+    Функция для вычисления координат углов множества плиток по их геопривязке за один вызов pyproj
+
+    Parameters
+    -------------
+    transforms: `Sequence[Affine]`
+        Геопривязка плиток
+    widths: `Sequence[int]`
+        Ширина плиток в пикселях
+    heights: `Sequence[int]`
+        Высота плиток в пикселях
+    from_crs: `str`
+        Система координат плиток
+    to_crs: `str`
+        Система координат результата
+
+    Returns
+    -------------
+    `np.ndarray`
+        Координаты углов (N, 4, 2) в порядке: левый верхний, правый верхний, правый нижний, левый нижний
+    '''
+    coefficients = np.array([tuple(item)[:6] for item in transforms], dtype=np.float64).reshape(-1, 6)
+    left, top = coefficients[:, 2], coefficients[:, 5]
+    right = left + coefficients[:, 0] * np.asarray(widths, dtype=np.float64)
+    bottom = top + coefficients[:, 4] * np.asarray(heights, dtype=np.float64)
+
+    xs = np.stack([left, right, right, left], axis=1)
+    ys = np.stack([top, top, bottom, bottom], axis=1)
+    xs, ys = get_transformer(from_crs, to_crs).transform(xs.ravel(), ys.ravel())
+
+    return np.stack([xs, ys], axis=1).reshape(-1, 4, 2)
+
+
 '''
 # Пример использования
 # Создание полигона в системе координат EPSG:32637
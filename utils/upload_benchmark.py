@@ -0,0 +1,158 @@
+'''
+Данный скрипт содержит локальную заглушку метода сервера `/api/v1/layers` и замер скорости отправки данных векторов:
+последовательные запросы без сессии (как раньше) и очередь фоновой отправки через пул соединений
+с разным количеством одновременных запросов, с gzip и без
+
+Запуск из корня репозитория: python -m utils.upload_benchmark --num-layers 20000 --delay-ms 20 --max-in-flight 1 4 8
+'''
+import argparse
+import gzip
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List
+import numpy as np
+from utils.api_requests import ApiClient, UploadQueue
+
+
+class LayersHandler(BaseHTTPRequestHandler):
+    '''Класс реализует заглушку метода добавления слоев: тело запроса разбирается, слои подсчитываются'''
+    protocol_version = 'HTTP/1.1'  # keep-alive соединения
+    disable_nagle_algorithm = True  # Заголовки и тело ответа пишутся отдельно, без этого ответ ждет подтверждения TCP
+    delay = 0.0  # Искусственная задержка ответа (с), имитирующая сеть и запись в БД
+    lock = threading.Lock()
+    num_layers = 0
+    num_bytes = 0
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        num_bytes = len(body)
+        if self.headers.get('Content-Encoding') == 'gzip':
+            body = gzip.decompress(body)
+        layers = json.loads(body)['layers']
+        with self.lock:
+            LayersHandler.num_layers += len(layers)
+            LayersHandler.num_bytes += num_bytes
+        if self.delay:
+            time.sleep(self.delay)
+
+        self.send_response(201)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write(b'{}')
+
+    def log_message(self, *args):
+        pass
+
+
+def start_mock_server(host: str = '127.0.0.1', port: int = 0, delay_ms: float = 0) -> ThreadingHTTPServer:
+    '''Функция для запуска заглушки сервера в фоновом потоке (port=0 - любой свободный порт)'''
+    LayersHandler.delay = delay_ms / 1000
+    server = ThreadingHTTPServer((host, port), LayersHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def make_layers(num_layers: int, seed: int = 0) -> List[Dict]:
+    '''Функция для создания данных векторов в том формате, в котором они отправляются на сервер'''
+    rng = np.random.default_rng(seed)
+    layers = []
+    for faiss_id in range(num_layers):
+        x, y = rng.uniform(30, 40), rng.uniform(50, 60)
+        layers.append({
+            'faiss_id': faiss_id,
+            'polygon_coordinates': f'POLYGON (({x} {y}, {x + 0.01} {y}, {x + 0.01} {y + 0.01}, {x} {y + 0.01}, {x} {y}))',
+            'layout_name': 'layout_2021-06-15',
+            'dim_space_x': 50,
+            'dim_space_y': 50,
+            'filename': f'tile_{faiss_id}.tif',
+        })
+    return layers
+
+
+def upload_sequential(server_url: str, blocks: List[List[Dict]]):
+    '''Функция для отправки блоков по одному, каждый запрос в новом соединении'''
+    for block in blocks:
+        api_client = ApiClient(server_url, pool_size=1)
+        api_client.add_layer({'layers': block})
+        api_client.close()
+
+
+def upload_queued(server_url: str, blocks: List[List[Dict]], max_in_flight: int, compress: bool):
+    '''Функция для отправки блоков через очередь фоновой отправки и пул соединений'''
+    api_client = ApiClient(server_url, pool_size=max_in_flight, compress=compress)
+    with UploadQueue(api_client.add_layer, max_in_flight) as upload_queue:
+        for block in blocks:
+            upload_queue.submit({'layers': block})
+    api_client.close()
+
+
+def benchmark_uploads(num_layers: int = 20000, block_size: int = 1024, delay_ms: float = 20,
+                      max_in_flight: List[int] = (1, 4, 8), server_url: str = None) -> Dict[str, float]:
+    '''
+    Функция для замера скорости отправки данных векторов
+
+    Parameters
+    -------------
+    num_layers: `int`
+        Количество отправляемых слоев
+    block_size: `int`
+        Количество слоев в одном запросе
+    delay_ms: `float`
+        Задержка ответа заглушки (мс)
+    max_in_flight: `List[int]`
+        Проверяемые количества одновременных запросов
+    server_url: `str`
+        Адрес сервера. Если не задан, запускается локальная заглушка
+
+    Returns
+    -------------
+    `Dict[str, float]`
+        Скорость отправки (слоев/сек) для каждого режима
+    '''
+    server = None
+    if server_url is None:
+        server = start_mock_server(delay_ms=delay_ms)
+        server_url = f'http://127.0.0.1:{server.server_address[1]}'
+
+    layers = make_layers(num_layers)
+    blocks = [layers[start: start + block_size] for start in range(0, len(layers), block_size)]
+    modes = [('последовательно, без сессии', lambda: upload_sequential(server_url, blocks))]
+    for num_in_flight in max_in_flight:
+        for compress in (False, True):
+            modes.append((f'очередь, {num_in_flight} запр.{", gzip" if compress else ""}',
+                          lambda num_in_flight=num_in_flight, compress=compress:
+                          upload_queued(server_url, blocks, num_in_flight, compress)))
+
+    print(f'Слоев: {num_layers}, в запросе: {block_size}, задержка заглушки: {delay_ms} мс')
+    print(f'{"режим":<36}{"время, с":>10}{"слоев/сек":>12}{"отправлено, МБ":>16}')
+    results = {}
+    for name, upload in modes:
+        LayersHandler.num_layers, LayersHandler.num_bytes = 0, 0
+        start_time = time.perf_counter()
+        upload()
+        elapsed = time.perf_counter() - start_time
+        results[name] = num_layers / elapsed
+        sent_mb = f'{LayersHandler.num_bytes / 2 ** 20:>16.2f}' if server is not None else f'{"-":>16}'
+        print(f'{name:<36}{elapsed:>10.2f}{results[name]:>12.0f}{sent_mb}')
+
+    if server is not None:
+        server.shutdown()
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Замер скорости отправки данных векторов на сервер')
+    parser.add_argument('--num-layers', type=int, default=20000, help='Количество отправляемых слоев')
+    parser.add_argument('--block-size', type=int, default=1024, help='Количество слоев в одном запросе')
+    parser.add_argument('--delay-ms', type=float, default=20, help='Задержка ответа локальной заглушки (мс)')
+    parser.add_argument('--max-in-flight', type=int, nargs='+', default=[1, 4, 8],
+                        help='Проверяемые количества одновременных запросов')
+    parser.add_argument('--server-url', type=str, default=None,
+                        help='Адрес сервера (по умолчанию запускается локальная заглушка)')
+    args = parser.parse_args()
+
+    benchmark_uploads(args.num_layers, args.block_size, args.delay_ms, args.max_in_flight, args.server_url)
@@ -0,0 +1,83 @@
+'''Данный модуль содержит журнал отправки данных векторов на сервер, по которому неподтвержденные блоки отправляются повторно'''
+import json
+import os
+import threading
+from typing import Iterator, List, Optional, Tuple
+
+
+class UploadOutbox:
+    '''
+    Класс реализует журнал отправки на диске (JSON Lines, только дозапись): перед сохранением индекса FAISS
+    в журнал записываются диапазоны faiss_id, которые необходимо отправить на сервер (`pending`), а после
+    ответа сервера - подтвержденные диапазоны (`ack`), а после сохранения индекса - отметка `checkpoint` со следующим
+    свободным faiss_id сохраненного индекса. Если запуск прервался, неподтвержденные диапазоны, вошедшие в сохраненный
+    индекс, отправляются повторно без повторного извлечения признаков и заполнения индекса
+
+    Parameters
+    -------------
+    path: `str`
+        Путь до файла журнала
+    '''
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def add_pending(self, ranges: List[Tuple[int, int]]):
+        '''Функция для записи диапазонов [start, end), которые необходимо отправить'''
+        self._write([{'pending': [int(start), int(end)]} for start, end in ranges])
+
+    def ack(self, start: int, end: int):
+        '''Функция для записи диапазона, подтвержденного сервером (вызывается из потоков отправки)'''
+        self._write([{'ack': [int(start), int(end)]}])
+
+    def add_checkpoint(self, next_id: int):
+        '''Функция для записи отметки о сохранении индекса, содержащего faiss_id до `next_id`'''
+        self._write([{'checkpoint': int(next_id)}])
+
+    def last_checkpoint(self) -> Optional[int]:
+        '''
+        Функция для получения следующего свободного faiss_id индекса, сохраненного последним с этим журналом
+        (None, если индекс с журналом не сохранялся: его блоки еще не отправлялись)
+        '''
+        next_id = None
+        for entry in self._read():
+            if 'checkpoint' in entry:
+                next_id = entry['checkpoint']
+        return next_id
+
+    def pending(self) -> List[Tuple[int, int]]:
+        '''Функция для получения неподтвержденных диапазонов в порядке записи'''
+        pending, acked = {}, set()
+        for entry in self._read():
+            if 'pending' in entry:
+                pending[tuple(entry['pending'])] = None
+            elif 'ack' in entry:
+                acked.add(tuple(entry['ack']))
+        return [item for item in pending if item not in acked]
+
+    def clear(self):
+        '''Функция для удаления журнала после подтверждения всех диапазонов'''
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def _read(self) -> Iterator[dict]:
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, 'r') as f:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError:
+                    # Последняя строка могла быть записана не полностью при аварийном завершении
+                    continue
+
+    def _write(self, entries: List[dict]):
+        if not entries:
+            return
+        with self._lock:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            with open(self.path, 'a') as f:
+                f.write(''.join(json.dumps(entry) + '\n' for entry in entries))
+                f.flush()
+                os.fsync(f.fileno())